@@ -0,0 +1,51 @@
+"""
+Benchmark of token checks as the number of active sessions grows.
+Run from src with `python3 -m benchmarks.auth_bench`.
+H11A-quadruples, April 2020.
+"""
+
+import timeit
+from database.database import AUTH_DATABASE
+from database import helpers_auth, indexes
+from funcs.other import workspace_reset
+
+SESSION_COUNTS = [100, 1000, 10000, 50000]
+CHECKS = 2000
+
+def seed_sessions(count):
+    """
+    Fill "active_tokens" with count fake sessions.
+
+    Args:
+        count (int): Number of sessions to create.
+    Returns:
+        The token of the most recently created session.
+    """
+    workspace_reset()
+    auth_data = AUTH_DATABASE.get()
+    for u_id in range(count):
+        auth_data["active_tokens"].append({"token": f"token{u_id}", "u_id": u_id})
+    AUTH_DATABASE.update(auth_data)
+    indexes.TOKENS.rebuild()
+    return f"token{count - 1}"
+
+def main():
+    """
+    Time is_token_valid() and find_u_id() with and without the token index.
+    """
+    print(f"{'sessions':>10} {'scan (us)':>12} {'index (us)':>12}")
+    for count in SESSION_COUNTS:
+        token = seed_sessions(count)
+        scan = timeit.timeit(
+            lambda: helpers_auth.is_token_valid(token) and helpers_auth.find_u_id(token),
+            number=CHECKS
+        )
+        index = timeit.timeit(
+            lambda: indexes.is_token_valid(token) and indexes.find_u_id(token),
+            number=CHECKS
+        )
+        print(f"{count:>10} {scan / CHECKS * 1e6:>12.2f} {index / CHECKS * 1e6:>12.2f}")
+    workspace_reset()
+
+if __name__ == "__main__":
+    main()
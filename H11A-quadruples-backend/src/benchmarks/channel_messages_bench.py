@@ -0,0 +1,65 @@
+"""
+Benchmark of fetching one page of a channel's messages as the total
+number of messages in the workspace grows.
+Run from src with `python3 -m benchmarks.channel_messages_bench`.
+H11A-quadruples, April 2020.
+"""
+
+import timeit
+from database.database import MESSAGES_DATABASE
+from database import indexes
+from funcs.other import workspace_reset
+
+WORKSPACE_SIZES = [1000, 10000, 100000, 1000000]
+CHANNEL_COUNT = 100
+PAGES = 200
+
+def seed_messages(count):
+    """
+    Fill the messages table with count messages spread over CHANNEL_COUNT channels.
+
+    Args:
+        count (int): Number of messages to create.
+    """
+    workspace_reset()
+    messages_data = MESSAGES_DATABASE.get()
+    for m_id in range(count):
+        messages_data["messages"].append({
+            "channel_id": m_id % CHANNEL_COUNT,
+            "message_id": m_id,
+            "u_id": 1,
+            "message": f"message {m_id}",
+            "time_created": m_id,
+            "reacts": [],
+            "is_pinned": False
+        })
+    MESSAGES_DATABASE.update(messages_data)
+    indexes.MESSAGES.rebuild()
+    indexes.TIMELINES.rebuild()
+
+def scan_page(channel_id, start):
+    """
+    Build a page by filtering the whole messages table, as channel_messages() did.
+    """
+    in_channel = [
+        message for message in MESSAGES_DATABASE.get()["messages"]
+        if message["channel_id"] == channel_id
+    ]
+    in_channel.reverse()
+    return in_channel[start:start + 50]
+
+def main():
+    """
+    Time a 50-message page with a full scan and with the channel timelines.
+    """
+    print(f"{'messages':>10} {'scan (us)':>12} {'timeline (us)':>14}")
+    for count in WORKSPACE_SIZES:
+        seed_messages(count)
+        assert scan_page(7, 50) == indexes.channel_page(7, 50)
+        scan = timeit.timeit(lambda: scan_page(7, 50), number=PAGES)
+        timeline = timeit.timeit(lambda: indexes.channel_page(7, 50), number=PAGES)
+        print(f"{count:>10} {scan / PAGES * 1e6:>12.2f} {timeline / PAGES * 1e6:>14.2f}")
+    workspace_reset()
+
+if __name__ == "__main__":
+    main()
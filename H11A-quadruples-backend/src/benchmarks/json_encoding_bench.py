@@ -0,0 +1,75 @@
+"""
+Benchmark of encoding the bodies of the largest responses: a page of
+/channel/messages and /users/all for workspaces of growing size.
+Run from src with `python3 -m benchmarks.json_encoding_bench`.
+H11A-quadruples, April 2020.
+"""
+
+import json
+import timeit
+import responses
+
+USER_COUNTS = [100, 1000, 5000]
+ENCODES = 200
+
+def messages_page():
+    """
+    Returns:
+        A /channel/messages response body with a full page of messages.
+    """
+    return {
+        "messages": [{
+            "message_id": m_id,
+            "u_id": m_id % 7,
+            "message": f"message number {m_id} with some text in it",
+            "time_created": 1587000000 + m_id,
+            "reacts": [{"react_id": 1, "u_ids": [1, 2, 3], "is_this_user_reacted": True}],
+            "is_pinned": m_id % 10 == 0
+        } for m_id in range(50)],
+        "start": 0,
+        "end": 50
+    }
+
+def users_all(count):
+    """
+    Returns:
+        A /users/all response body with count users.
+    """
+    return {"users": [{
+        "u_id": u_id,
+        "email": f"user{u_id}@unsw.edu.au",
+        "name_first": "First",
+        "name_last": f"Last{u_id}",
+        "handle_str": f"firstlast{u_id}",
+        "profile_img_url": f"http://127.0.0.1:8080/imgurl/{u_id:020x}.jpg"
+    } for u_id in range(count)]}
+
+def time_encoding(payload):
+    """
+    Returns:
+        Microseconds taken to encode the payload with the json module as the
+        routes used to, and with encode_json() (None without orjson).
+    """
+    stdlib = timeit.timeit(lambda: json.dumps(payload), number=ENCODES)
+    fast = None
+    if responses.orjson is not None:
+        assert json.loads(responses.encode_json(payload)) == payload
+        fast = timeit.timeit(lambda: responses.encode_json(payload), number=ENCODES)
+    return stdlib / ENCODES * 1e6, fast and fast / ENCODES * 1e6
+
+def main():
+    """
+    Time encoding each body with the json module and with encode_json().
+    """
+    if responses.orjson is None:
+        print("orjson is not installed; encode_json() uses the json module")
+    print(f"{'body':>22} {'json (us)':>12} {'encode_json (us)':>17}")
+    bodies = [("50 messages", messages_page())]
+    bodies += [(f"{count} users", users_all(count)) for count in USER_COUNTS]
+    for name, payload in bodies:
+        stdlib, fast = time_encoding(payload)
+        fast = "-" if fast is None else f"{fast:.2f}"
+        print(f"{name:>22} {stdlib:>12.2f} {fast:>17}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of the CPU time and memory taken to crop a 12 megapixel JPG
+for a profile picture, decoding it whole and in draft mode.
+Run from src with `python3 -m benchmarks.photo_crop_bench`.
+H11A-quadruples, April 2020.
+"""
+
+import multiprocessing
+import resource
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
+from funcs.user_profile_uploadphoto import crop_photo, MAX_PHOTO_SIZE
+
+PHOTOS = 5
+WIDTH, HEIGHT = 4000, 3000
+## Crops from the whole photo down to one that needs no shrinking
+CROPS = {
+    "whole": (0, 0, WIDTH, HEIGHT),
+    "centre": (1000, 500, 3000, 2500),
+    "small": (1800, 1300, 1800 + MAX_PHOTO_SIZE, 1300 + MAX_PHOTO_SIZE),
+}
+
+def make_photo(seed):
+    """
+    Returns:
+        A 12 megapixel JPG (bytes) of noise and shapes, which compresses
+        about as well as a photo.
+    """
+    image = Image.effect_noise((WIDTH, HEIGHT), 40 + seed).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for number in range(40):
+        x, y = (seed * 997 + number * 331) % WIDTH, (seed * 661 + number * 193) % HEIGHT
+        draw.ellipse((x, y, x + 600, y + 400), fill=(number * 6 % 256, seed * 40 % 256, 120))
+    image = image.filter(ImageFilter.GaussianBlur(2))
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+def full_decode(image, box):
+    """
+    Crop by decoding the photo whole, as before draft mode was used.
+    """
+    cropped = image.crop(box)
+    if max(cropped.size) > MAX_PHOTO_SIZE:
+        cropped.thumbnail((MAX_PHOTO_SIZE, MAX_PHOTO_SIZE), Image.LANCZOS)
+    return cropped
+
+def measure(crop, box, photos, results):
+    """
+    Crop every photo in a fresh process and report the CPU time per photo
+    and the growth in peak memory.
+    """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.process_time()
+    for photo in photos:
+        with Image.open(BytesIO(photo)) as image:
+            crop(image, box)
+    results.put((
+        (time.process_time() - start) / len(photos),
+        (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+    ))
+
+def main():
+    """
+    Compare per-upload CPU time and peak memory of each way of cropping.
+    """
+    photos = [make_photo(seed) for seed in range(PHOTOS)]
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    print(f"{'crop':>8} {'decode':>8} {'cpu (ms)':>10} {'peak +MB':>10}")
+    for crop_name, box in CROPS.items():
+        for decode, crop in (("whole", full_decode), ("draft", crop_photo)):
+            process = context.Process(target=measure, args=(crop, box, photos, results))
+            process.start()
+            cpu, memory = results.get()
+            process.join()
+            print(f"{crop_name:>8} {decode:>8} {cpu * 1e3:>10.1f} {memory:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark of request latency while the databases are being saved, with
+the save done all at once and with only the pickling holding the locks.
+Run from src with `python3 -m benchmarks.save_latency_bench`.
+H11A-quadruples, April 2020.
+"""
+
+import threading
+import time
+from database.database import MESSAGES_DATABASE
+from database import indexes
+from database.locks import all_tables
+from database.snapshots import save_databases, start_save, finish_save
+from funcs.auth import auth_register
+from funcs.channels import channels_create
+from funcs.message import message_send
+from funcs.other import workspace_reset
+
+MESSAGE_COUNT = 500000
+SAVES = 3
+
+def seed_messages(channel_id, count):
+    """
+    Fill the messages table with count messages in one channel.
+    """
+    messages_data = MESSAGES_DATABASE.get()
+    for m_id in range(count):
+        messages_data["messages"].append({
+            "channel_id": channel_id,
+            "message_id": -m_id - 1,
+            "u_id": 1,
+            "message": f"message {m_id}",
+            "time_created": m_id,
+            "reacts": [],
+            "is_pinned": False
+        })
+    MESSAGES_DATABASE.update(messages_data)
+    for index in (indexes.MESSAGES, indexes.TIMELINES, indexes.SEARCH):
+        index.rebuild()
+
+def save_blocking():
+    """
+    Save every database with the table locks held throughout, as
+    MemoryBackend.save() does.
+    """
+    with all_tables():
+        save_databases()
+
+def percentile(latencies, fraction):
+    """
+    Returns:
+        The latency (float) below which fraction of latencies fall.
+    """
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def measure(save):
+    """
+    Send messages back to back while save() runs SAVES times in another thread.
+
+    Args:
+        save (function): Saves every database.
+    Returns:
+        A list of message_send() latencies in seconds.
+    """
+    token = auth_register("bench@unsw.edu.au", "password123", "Bench", "Mark")["token"]
+    channel_id = channels_create(token, "bench", True)["channel_id"]
+    seed_messages(channel_id, MESSAGE_COUNT)
+
+    saver = threading.Thread(target=lambda: [save() for _ in range(SAVES)])
+    latencies = []
+    saver.start()
+    while saver.is_alive():
+        start = time.perf_counter()
+        message_send(token, channel_id, "hello")
+        latencies.append(time.perf_counter() - start)
+    saver.join()
+    workspace_reset()
+    return latencies
+
+def main():
+    """
+    Compare p50 and p99 message_send() latency during blocking and background saves.
+    """
+    workspace_reset()
+    results = {
+        "blocking": measure(save_blocking),
+        "background": measure(lambda: finish_save(start_save())),
+    }
+    print(f"{'save':>12} {'sends':>8} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for name, latencies in results.items():
+        print(
+            f"{name:>12} {len(latencies):>8} "
+            f"{percentile(latencies, 0.5) * 1e3:>10.3f} {percentile(latencies, 0.99) * 1e3:>10.3f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of delivery latency for a backlog of sendlater messages that all
+fall due at once, as after a restart, delivered in a batch and one by one.
+Run from src with `python3 -m benchmarks.sendlater_backlog_bench`.
+H11A-quadruples, April 2020.
+"""
+
+import time
+from database.indexes import TIMELINES
+from database.scheduler import SCHEDULER
+from funcs.auth import auth_register
+from funcs.channels import channels_create
+from funcs.message import message_sendlater, deliver_sendlater, deliver_sendlater_batch
+from funcs.other import workspace_reset
+
+BACKLOG = 10000
+DELAY = 3
+
+def measure():
+    """
+    Queue BACKLOG messages due at the same second and record when each is delivered.
+
+    Returns:
+        A list of delivery latencies in seconds, from the time the messages fell due.
+    """
+    workspace_reset()
+    token = auth_register("bench@unsw.edu.au", "password123", "Bench", "Mark")["token"]
+    channel_id = channels_create(token, "bench", True)["channel_id"]
+    time_sent = int(time.time()) + DELAY
+    for number in range(BACKLOG):
+        message_sendlater(token, channel_id, f"message {number}", time_sent)
+    assert time.time() < time_sent, "backlog took longer than DELAY to queue"
+
+    ## Poll the channel's timeline to see when each message arrives
+    delivered_at = []
+    while len(delivered_at) < BACKLOG:
+        count = TIMELINES.count(channel_id)
+        now = time.time()
+        delivered_at.extend([now] * (count - len(delivered_at)))
+    return [delivered - time_sent for delivered in delivered_at]
+
+def percentile(latencies, fraction):
+    """
+    Returns:
+        The latency (float) below which fraction of latencies fall.
+    """
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def main():
+    """
+    Compare the latency of delivering the backlog in a batch and one message at a time.
+    """
+    results = {}
+    SCHEDULER.register(deliver_sendlater)
+    results["one by one"] = measure()
+    SCHEDULER.register(deliver_sendlater, batch=deliver_sendlater_batch)
+    results["batched"] = measure()
+    workspace_reset()
+
+    print(f"{'delivery':>12} {'p50 (ms)':>10} {'p99 (ms)':>10} {'last (ms)':>10}")
+    for name, latencies in results.items():
+        print(
+            f"{name:>12} {percentile(latencies, 0.5) * 1e3:>10.1f} "
+            f"{percentile(latencies, 0.99) * 1e3:>10.1f} {max(latencies) * 1e3:>10.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
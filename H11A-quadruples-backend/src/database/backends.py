@@ -0,0 +1,520 @@
+"""
+Storage backends that the databases are persisted to.
+H11A-quadruples, April 2020.
+"""
+
+import atexit
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+from database.journal import JOURNAL, DATABASES, apply_entry, split_group
+from database.locks import all_tables
+from database.workers import WORKERS
+from database.snapshots import save_databases, load_databases, start_save, finish_save
+from constants import AUTH_DB_PATH
+
+SQLITE_DB_PATH = os.path.join(os.path.dirname(AUTH_DB_PATH), "slackr.sqlite3")
+
+## Tables of rows that get their own SQL table, by database and table name:
+## the SQL table, the key of each row, and the other fields that are indexed
+ROW_TABLES = {
+    ("auth", "registered_users"): ("users", "u_id", ()),
+    ("auth", "active_tokens"): ("tokens", "token", ("u_id",)),
+    ("auth", "deleted_users"): ("deleted_users", "u_id", ()),
+    ("channels", "channels"): ("channels", "channel_id", ()),
+    ("channels", "channel_changes"): ("channel_changes", "channel_id", ()),
+    ("messages", "messages"): ("messages", "message_id", ("channel_id", "u_id")),
+    ("messages", "removed_messages"): ("removed_messages", "message_id", ()),
+    ("messages", "queued_messages"): ("queued_messages", "message_id", ()),
+    ("messages", "scheduled_jobs"): ("scheduled_jobs", "job_id", ()),
+}
+
+## Tables of plain values that get their own SQL table
+VALUE_TABLES = {
+    ("messages", "queued_message_ids"): "queued_message_ids",
+}
+
+## Seconds the SQLite writer waits before trying a failed batch again, and
+## the longest that compact() waits for queued entries to be written
+WRITE_RETRY = 1
+FLUSH_TIMEOUT = 10
+
+
+class StorageBackend:
+    """
+    Where the databases are persisted. The databases themselves are always
+    the dicts behind database.database's get/update API, so the funcs run
+    the same whichever backend is in use.
+    """
+
+    def load(self):
+        """
+        Load the persisted databases.
+
+        Raises:
+            FileNotFoundError: if nothing has been persisted yet.
+        """
+        raise NotImplementedError
+
+    def save(self):
+        """
+        Persist the whole of every database.
+        """
+        raise NotImplementedError
+
+    def checkpoint(self):
+        """
+        Make the databases as load() left them persist on their own, eg. by
+        folding changes replayed from a journal into a fresh save.
+        """
+        raise NotImplementedError
+
+    def open(self):
+        """
+        Persist every change made from now on.
+        """
+        raise NotImplementedError
+
+    def compact(self):
+        """
+        Periodic housekeeping, called every SAVE_INTERVAL seconds.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Stop persisting changes.
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Pickled snapshots of the databases, with the changes made since the
+    last snapshot kept in the journal.
+    """
+
+    def load(self):
+        load_databases()
+        JOURNAL.recover()
+
+    def save(self):
+        with all_tables(), JOURNAL.lock:
+            save_databases()
+            JOURNAL.truncate()
+
+    def checkpoint(self):
+        self.save()
+
+    def open(self):
+        JOURNAL.open()
+
+    def compact(self):
+        """
+        Snapshot the parts of the databases that have changed and discard
+        the journal entries that the snapshot now covers. Does nothing if
+        nothing has changed.
+
+        The databases are pickled while the journal is rotated, with every
+        table lock held so that no table or index is pickled half way
+        through a change, and the snapshot files are written after the locks
+        are let go, so requests are only paused for the pickling rather than
+        for the whole snapshot. When processes share the databases (see
+        WorkerSync), no other process changes them while they are pickled or
+        removes the old journal while another is loading the snapshot it
+        belongs with, and the journal is left for a later compaction while
+        another process is still reading an older one.
+        """
+        with WORKERS.exclusive(), all_tables(), JOURNAL.lock:
+            if WORKERS.others_behind():
+                return
+            old_journal, dirty = JOURNAL.rotate()
+            if not dirty:
+                return
+            try:
+                files = start_save(dirty)
+            except Exception:
+                JOURNAL.restore_dirty(dirty)
+                raise
+        if not finish_save(files):
+            JOURNAL.restore_dirty(dirty)
+            return
+        with WORKERS.exclusive():
+            if os.path.exists(old_journal):
+                os.remove(old_journal)
+
+    def close(self):
+        JOURNAL.close()
+
+
+class SqliteBackend(StorageBackend):
+    """
+    An SQLite database in WAL mode, with one row per user, token, channel
+    and message. It is where the databases are persisted, not where they
+    are served from: load() reads every row back into the dicts behind
+    database.database, which the funcs and indexes work on just as they do
+    with the memory backend, so the databases must still fit in memory.
+
+    Each journal entry is queued as it is recorded, and a writer thread
+    applies the queue in batches of one transaction each, so a change only
+    writes the rows it touched and is never written while JOURNAL.lock is
+    held. An entry for a table that is not in ROW_TABLES or VALUE_TABLES is
+    kept as it was recorded, and replayed over the pickled base row of its
+    database on load(), until compact() rewrites the base rows.
+
+    Every entry is also appended to the journal file before the change
+    returns, and load() replays the journal over the SQLite database, so
+    entries still queued when the process is killed are not lost. The
+    journal is discarded by compact() once the writer has caught up. The
+    durability window is therefore that of the journal: a change survives
+    the process being killed as soon as it returns, but one that the
+    operating system has not yet written to disk may be lost if the
+    machine itself goes down, unless SLACKR_JOURNAL_FSYNC is set (see
+    journal.FSYNC).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        ## Held while using the connection, which the writer thread shares
+        self._connection_lock = threading.RLock()
+        ## Pickled entries waiting for the writer thread, and how many
+        ## entries have been queued and written so far
+        self._pending = threading.Condition()
+        self._queue = []
+        self._queued = 0
+        self._written = 0
+        self._writer = None
+        self._closing = False
+        ## Number of journal entries load() replayed over the SQLite database
+        self._replayed = 0
+
+    def connect(self):
+        """
+        Returns:
+            The connection to the SQLite database, created with its schema
+            on first use.
+        """
+        with self._connection_lock:
+            if self._connection is None:
+                self._connection = self._create()
+            return self._connection
+
+    def _create(self):
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS bases (name TEXT PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(position INTEGER PRIMARY KEY, name TEXT NOT NULL, entry BLOB NOT NULL)"
+        )
+        for sql_table, key, indexed in ROW_TABLES.values():
+            columns = "".join(f", {field}" for field in indexed)
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {sql_table} (position INTEGER PRIMARY KEY, "
+                f"{key} NOT NULL UNIQUE{columns}, data BLOB NOT NULL)"
+            )
+            for field in indexed:
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {sql_table}_{field} ON {sql_table} ({field})"
+                )
+        for sql_table in VALUE_TABLES.values():
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {sql_table} "
+                "(position INTEGER PRIMARY KEY, value NOT NULL UNIQUE)"
+            )
+        return connection
+
+    def load(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        with self._connection_lock:
+            connection = self.connect()
+            loaded = {}
+            for name in DATABASES:
+                base = connection.execute(
+                    "SELECT data FROM bases WHERE name = ?", (name,)
+                ).fetchone()
+                if base is None:
+                    raise FileNotFoundError(self.path)
+                data = pickle.loads(base[0])
+                for (database, table), (sql_table, _, _) in ROW_TABLES.items():
+                    if database == name:
+                        rows = connection.execute(
+                            f"SELECT data FROM {sql_table} ORDER BY position"
+                        )
+                        data[table] = [pickle.loads(row) for row, in rows]
+                for (database, table), sql_table in VALUE_TABLES.items():
+                    if database == name:
+                        rows = connection.execute(
+                            f"SELECT value FROM {sql_table} ORDER BY position"
+                        )
+                        data[table] = [value for value, in rows]
+                loaded[name] = data
+            entries = [
+                pickle.loads(entry)
+                for entry, in connection.execute("SELECT entry FROM entries ORDER BY position")
+            ]
+        for name, data in loaded.items():
+            DATABASES[name].update(data)
+        tables = {}
+        for entry in entries:
+            apply_entry(entry, tables)
+        ## Entries that were journaled but not yet written to SQLite
+        self._replayed = JOURNAL.recover()
+
+    def save(self):
+        ## Write what is queued first, so that it is not written over the save
+        self.flush()
+        with all_tables(), JOURNAL.lock:
+            self.flush()
+            with self._connection_lock:
+                connection = self.connect()
+                with connection:
+                    connection.execute("BEGIN")
+                    for name, database in DATABASES.items():
+                        self._replace(name, database.get())
+            JOURNAL.truncate()
+
+    def checkpoint(self):
+        """
+        Write the databases whole if load() replayed any of the journal, so
+        that the SQLite database holds every change again.
+        """
+        if self._replayed:
+            self.save()
+            self._replayed = 0
+
+    def open(self):
+        JOURNAL.open()
+        self.connect()
+        with self._pending:
+            self._closing = False
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_queued, daemon=True)
+                self._writer.start()
+                ## The writer is a daemon, so finish its queue on the way out
+                atexit.register(self.flush, FLUSH_TIMEOUT)
+        JOURNAL.subscribe(self.write)
+
+    def compact(self):
+        """
+        Rewrite the base rows (folding in the entries kept for tables without
+        their own SQL table) and checkpoint the WAL into the database file.
+        Once every queued entry has been written, the SQLite database holds
+        everything in the journal, so the journal is discarded, unless
+        another process is still reading an older one.
+
+        Raises:
+            TimeoutError: if queued entries could not be written within
+                FLUSH_TIMEOUT seconds, eg. because the disk is full.
+        """
+        with WORKERS.exclusive(), all_tables(), JOURNAL.lock:
+            if not self.flush(FLUSH_TIMEOUT):
+                raise TimeoutError("Journal entries are still waiting to be written")
+            with self._connection_lock:
+                connection = self.connect()
+                with connection:
+                    connection.execute("BEGIN")
+                    for name in DATABASES:
+                        self._write_base(name)
+            if not WORKERS.others_behind():
+                old_journal, _ = JOURNAL.rotate()
+                if os.path.exists(old_journal):
+                    os.remove(old_journal)
+        with self._connection_lock:
+            self.connect().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with JOURNAL.lock:
+            JOURNAL.unsubscribe(self.write)
+        self.flush()
+        JOURNAL.close()
+        with self._pending:
+            self._closing = True
+            self._pending.notify_all()
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.join()
+        with self._connection_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def write(self, data):
+        """
+        Queue a journal entry for the writer thread. Called while
+        JOURNAL.lock is held, so entries are queued in the order they were
+        recorded.
+
+        Args:
+            data (bytes): The pickled entry (see Journal.record()).
+        """
+        with self._pending:
+            self._queue.append(data)
+            self._queued += 1
+            self._pending.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait for the writer thread to write every entry queued so far.
+
+        Args:
+            timeout (float): Longest to wait in seconds, or None for no limit.
+        Returns:
+            True if the entries have been written, else False.
+        """
+        with self._pending:
+            queued = self._queued
+            return self._pending.wait_for(
+                lambda: self._written >= queued or self._writer is None, timeout
+            )
+
+    def _write_queued(self):
+        """
+        Write queued entries until close() is called, each batch in one
+        transaction. A batch that fails (eg. because the disk is full) is
+        tried again, ahead of anything queued since.
+        """
+        while True:
+            with self._pending:
+                self._pending.wait_for(lambda: self._queue or self._closing)
+                if not self._queue:
+                    return
+                batch, self._queue = self._queue, []
+            try:
+                with self._connection_lock:
+                    connection = self.connect()
+                    with connection:
+                        connection.execute("BEGIN")
+                        for data in batch:
+                            entry = pickle.loads(data)
+                            if entry[0] == "group":
+                                for grouped in split_group(entry):
+                                    self._apply(grouped)
+                            else:
+                                self._apply(entry, data)
+            except sqlite3.Error:
+                traceback.print_exc()
+                with self._pending:
+                    self._queue[:0] = batch
+                time.sleep(WRITE_RETRY)
+                continue
+            with self._pending:
+                self._written += len(batch)
+                self._pending.notify_all()
+
+    def _apply(self, entry, data=None):
+        """
+        Apply a journal entry to the SQLite database, inside a transaction.
+
+        Args:
+            entry (tuple): The entry, as passed to Journal.record().
+            data (bytes): The entry, pickled, if it has been already.
+        """
+        connection = self.connect()
+        operation, name = entry[0], entry[1]
+        if operation == "replace":
+            self._replace(name, entry[2])
+        elif (name, entry[2]) in ROW_TABLES:
+            sql_table, key, indexed = ROW_TABLES[(name, entry[2])]
+            if operation == "put":
+                self._put(sql_table, key, indexed, entry[4])
+            elif operation == "delete":
+                connection.execute(f"DELETE FROM {sql_table} WHERE {key} = ?", (entry[4],))
+        elif (name, entry[2]) in VALUE_TABLES:
+            sql_table = VALUE_TABLES[(name, entry[2])]
+            if operation == "add":
+                connection.execute(
+                    f"INSERT OR IGNORE INTO {sql_table} (value) VALUES (?)", (entry[3],)
+                )
+            elif operation == "discard":
+                connection.execute(f"DELETE FROM {sql_table} WHERE value = ?", (entry[3],))
+        else:
+            ## A table without its own SQL table lives in the base row,
+            ## which compact() rewrites; until then, keep the entry
+            if data is None:
+                data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+            connection.execute("INSERT INTO entries (name, entry) VALUES (?, ?)", (name, data))
+
+    def _put(self, sql_table, key, indexed, row):
+        fields = (key,) + indexed
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" * (len(fields) + 1))
+        updates = "".join(f", {field} = excluded.{field}" for field in indexed)
+        data = pickle.dumps(row, protocol=pickle.HIGHEST_PROTOCOL)
+        self.connect().execute(
+            f"INSERT INTO {sql_table} ({columns}, data) VALUES ({placeholders}) "
+            f"ON CONFLICT ({key}) DO UPDATE SET data = excluded.data{updates}",
+            tuple(row[field] for field in fields) + (data,)
+        )
+
+    def _write_base(self, name, data=None):
+        """
+        Rewrite the base row of a database, which then covers every entry
+        kept for it. Called inside a transaction.
+
+        Args:
+            name (str): Name of the database.
+            data (dict): Its contents, or None for the live databases.
+        """
+        if data is None:
+            data = DATABASES[name].get()
+        tables = {
+            table for database, table in list(ROW_TABLES) + list(VALUE_TABLES) if database == name
+        }
+        base = {key: value for key, value in data.items() if key not in tables}
+        connection = self.connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO bases (name, data) VALUES (?, ?)",
+            (name, pickle.dumps(base, protocol=pickle.HIGHEST_PROTOCOL))
+        )
+        connection.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+    def _replace(self, name, data):
+        """
+        Replace every row of a database. Called inside a transaction.
+
+        Args:
+            name (str): Name of the database.
+            data (dict): Its new contents.
+        """
+        connection = self.connect()
+        for (database, table), (sql_table, key, indexed) in ROW_TABLES.items():
+            if database == name:
+                connection.execute(f"DELETE FROM {sql_table}")
+                for row in data.get(table, []):
+                    self._put(sql_table, key, indexed, row)
+        for (database, table), sql_table in VALUE_TABLES.items():
+            if database == name:
+                connection.execute(f"DELETE FROM {sql_table}")
+                connection.executemany(
+                    f"INSERT OR IGNORE INTO {sql_table} (value) VALUES (?)",
+                    [(value,) for value in data.get(table, [])]
+                )
+        self._write_base(name, data)
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": lambda: SqliteBackend(SQLITE_DB_PATH)
+}
+
+def get_backend(name):
+    """
+    Args:
+        name (str): "memory" or "sqlite".
+    Raises:
+        ValueError: if there is no backend called name.
+    Returns:
+        A new StorageBackend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {name}")
+    return BACKENDS[name]()
@@ -0,0 +1,1022 @@
+"""
+Hash indexes over the list-based tables in the databases.
+H11A-quadruples, April 2020.
+"""
+
+import secrets
+import threading
+from collections import OrderedDict
+from database.database import AUTH_DATABASE, CHANNELS_DATABASE, MESSAGES_DATABASE
+from database import helpers_auth
+from database.journal import JOURNAL
+from database.positions import Positions
+from database.locks import TABLE_LOCKS, CHANNEL_LOCKS
+
+class TableIndex:
+    """
+    A dictionary index over one table (a list of row dictionaries) of a
+    database, keyed on a unique field of each row.
+
+    Rows are indexed by reference, so a row returned by get() is the same
+    dictionary that is stored in the table. The index rebuilds itself if the
+    table is replaced (eg. by workspace_reset() or data_reload()), and picks
+    up rows that another helper appends to the table behind its back.
+    Removing a row keeps the rest of the table in order without searching
+    it (see Positions).
+
+    Rows added or removed through the index are written to the journal;
+    call save() after changing a row in place. Changes to the table and the
+    index are made while holding the table's lock (or the lock of the table
+    it belongs with), and each one changes the index's version.
+
+    If group is given, the keys are also grouped by that field of each row
+    (eg. active tokens by u_id), which must not be changed in place, so
+    that every row with a given value can be found without a scan.
+    """
+
+    def __init__(self, database, table, key, lock=None, group=None):
+        self._database = database
+        self._table = table
+        self._key = key
+        self._group = group
+        self._index = {}
+        self._groups = {}
+        self._positions = Positions()
+        self._source = None
+        self._version = 0
+        self.lock = TABLE_LOCKS[table] if lock is None else lock
+
+    def _group_add(self, row):
+        if self._group is not None:
+            self._groups.setdefault(row[self._group], set()).add(row[self._key])
+
+    def _group_discard(self, row):
+        if self._group is not None:
+            keys = self._groups.get(row[self._group], set())
+            keys.discard(row[self._key])
+            if not keys:
+                self._groups.pop(row[self._group], None)
+
+    def _reindex(self, rows):
+        """
+        Index every row of the table.
+
+        Args:
+            rows (list): The live table.
+        """
+        self._index = {row[self._key]: row for row in rows}
+        self._groups = {}
+        for row in rows:
+            self._group_add(row)
+        self._positions.reset([row[self._key] for row in rows])
+        self._source = rows
+        self._version += 1
+
+    def _rows(self):
+        """
+        Returns:
+            The live table, bringing the index up to date with it first.
+        """
+        rows = self._database.get().setdefault(self._table, [])
+        if rows is not self._source or len(rows) < len(self._index):
+            self._reindex(rows)
+        elif len(rows) > len(self._index):
+            ## Helpers append their new rows, so index just those
+            new_rows = rows[len(self._index):]
+            if any(row[self._key] in self._index for row in new_rows):
+                self._reindex(rows)
+            else:
+                for row in new_rows:
+                    self._index[row[self._key]] = row
+                    self._group_add(row)
+                    self._positions.append(row[self._key])
+                self._version += 1
+        return rows
+
+    def rebuild(self):
+        """
+        Forget the current index so that it is rebuilt on the next access.
+        """
+        self._source = None
+
+    @property
+    def version(self):
+        """
+        A number that changes whenever a row is added, removed or saved
+        through the index, or the table is replaced, so that anything derived
+        from the table can tell when it is out of date.
+        """
+        with self.lock:
+            self._rows()
+            return self._version
+
+    def get(self, key):
+        """
+        Args:
+            key: Value of the indexed field.
+        Returns:
+            The row with the given key, or None if there is no such row.
+        """
+        with self.lock:
+            self._rows()
+            return self._index.get(key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        """
+        Returns:
+            A list of every key currently in the table.
+        """
+        with self.lock:
+            self._rows()
+            return list(self._index)
+
+    def grouped(self, value):
+        """
+        Args:
+            value: Value of the group field.
+        Returns:
+            A list of the keys of every row whose group field has that value.
+        """
+        with self.lock:
+            self._rows()
+            return list(self._groups.get(value, ()))
+
+    def insert(self, row, journal=True):
+        """
+        Append a row to the table and index it.
+
+        Args:
+            row (dict): Row being added.
+            journal (bool): Whether to record the row in the journal.
+        """
+        with self.lock:
+            rows = self._rows()
+            rows.append(row)
+            self._index[row[self._key]] = row
+            self._group_add(row)
+            self._positions.append(row[self._key])
+            self._version += 1
+            if journal:
+                JOURNAL.put(self._database, self._table, self._key, row)
+
+    def track(self, key):
+        """
+        Index a row that another helper has already appended to the table.
+
+        Args:
+            key: Value of the indexed field of the new row.
+        """
+        with self.lock:
+            self._rows()
+            self.save(key)
+
+    def save(self, key, journal=True):
+        """
+        Write the current contents of a row to the journal after it has
+        been changed in place.
+
+        Args:
+            key: Value of the indexed field.
+            journal (bool): Whether to record the row in the journal.
+        """
+        with self.lock:
+            row = self.get(key)
+            if row is not None:
+                self._version += 1
+                if journal:
+                    JOURNAL.put(self._database, self._table, self._key, row)
+
+    def remove(self, key, journal=True):
+        """
+        Remove the row with the given key from the table and the index.
+
+        Args:
+            key: Value of the indexed field.
+            journal (bool): Whether to record the removal in the journal.
+        Returns:
+            The removed row, or None if there was no such row.
+        """
+        with self.lock:
+            rows = self._rows()
+            row = self._index.pop(key, None)
+            if row is not None:
+                self._group_discard(row)
+                del rows[self._positions.pop(key)]
+                if self._positions.stale:
+                    self._positions.reset([row[self._key] for row in rows])
+                self._version += 1
+                if journal:
+                    JOURNAL.delete(self._database, self._table, self._key, row)
+            return row
+
+
+class ValueIndex:
+    """
+    An index over one table of a database that is a list of plain values
+    (eg. the queued_message_ids), so that a value can be found and removed
+    without searching the list (see Positions). Values are unique, and are
+    only added and removed through the index while holding lock.
+    """
+
+    def __init__(self, database, table, lock):
+        self._database = database
+        self._table = table
+        self._values = set()
+        self._positions = Positions()
+        self._source = None
+        self.lock = lock
+
+    def _list(self):
+        """
+        Returns:
+            The live list, re-indexing it first if it has been replaced.
+        """
+        values = self._database.get().setdefault(self._table, [])
+        if values is not self._source or len(values) != len(self._values):
+            self._values = set(values)
+            self._positions.reset(values)
+            self._source = values
+        return values
+
+    def __contains__(self, value):
+        with self.lock:
+            self._list()
+            return value in self._values
+
+    def add(self, value, journal=True):
+        """
+        Append a value to the list, unless it is already there.
+
+        Args:
+            value: Value being added.
+            journal (bool): Whether to record the value in the journal.
+        """
+        with self.lock:
+            values = self._list()
+            if value in self._values:
+                return
+            values.append(value)
+            self._values.add(value)
+            self._positions.append(value)
+            if journal:
+                JOURNAL.add(self._database, self._table, value)
+
+    def discard(self, value, journal=True):
+        """
+        Remove a value from the list, if it is there.
+
+        Args:
+            value: Value being removed.
+            journal (bool): Whether to record the removal in the journal.
+        """
+        with self.lock:
+            values = self._list()
+            if value not in self._values:
+                return
+            self._values.discard(value)
+            del values[self._positions.pop(value)]
+            if self._positions.stale:
+                self._positions.reset(values)
+            if journal:
+                JOURNAL.discard(self._database, self._table, value)
+
+
+class MessageIndex:
+    """
+    Base class for indexes derived from the "messages" table.
+
+    The index follows the table: append() and remove() are called after a
+    row has been added to or removed from it, and the index is rebuilt if
+    the table is replaced or changes size without it. Subclasses implement
+    _clear(), _add() and _discard(), and hold lock (the messages table's
+    lock) while reading the index.
+    """
+
+    def __init__(self, database):
+        self._database = database
+        self._size = 0
+        self._source = None
+        self.lock = TABLE_LOCKS["messages"]
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _add(self, message):
+        raise NotImplementedError
+
+    def _discard(self, message):
+        raise NotImplementedError
+
+    def _sync(self):
+        """
+        Rebuild the index if it no longer matches the messages table.
+        """
+        rows = self._database.get()["messages"]
+        if rows is not self._source or len(rows) != self._size:
+            self._clear()
+            for row in rows:
+                self._add(row)
+            self._size = len(rows)
+            self._source = rows
+
+    def rebuild(self):
+        """
+        Forget the current index so that it is rebuilt on the next access.
+        """
+        self._source = None
+
+    def append(self, message):
+        """
+        Add a message that has just been appended to the messages table.
+
+        Args:
+            message (dict): The new message.
+        """
+        with self.lock:
+            if self._database.get()["messages"] is not self._source:
+                self._sync()
+                return
+            self._add(message)
+            self._size += 1
+
+    def remove(self, message):
+        """
+        Drop a message that has just been removed from the messages table.
+
+        Args:
+            message (dict): The removed message.
+        """
+        with self.lock:
+            if self._database.get()["messages"] is not self._source:
+                self._sync()
+                return
+            self._discard(message)
+            self._size -= 1
+
+
+class ChannelTimelines(MessageIndex):
+    """
+    Per-channel lists of message_ids in the order the messages were sent,
+    so that a page of a channel's history is a slice rather than a scan of
+    every message. Removing a message does not search its channel's list
+    (see Positions).
+    """
+
+    def __init__(self, database):
+        super().__init__(database)
+        self._timelines = {}
+        self._positions = {}
+
+    def _clear(self):
+        self._timelines = {}
+        self._positions = {}
+
+    def _add(self, message):
+        channel_id = message["channel_id"]
+        self._timelines.setdefault(channel_id, []).append(message["message_id"])
+        self._positions.setdefault(channel_id, Positions()).append(message["message_id"])
+
+    def _discard(self, message):
+        channel_id = message["channel_id"]
+        if channel_id not in self._timelines:
+            return
+        timeline = self._timelines[channel_id]
+        positions = self._positions[channel_id]
+        index = positions.pop(message["message_id"])
+        if index is not None:
+            del timeline[index]
+            if positions.stale:
+                positions.reset(timeline)
+
+    def count(self, channel_id):
+        """
+        Args:
+            channel_id (int): id of the channel.
+        Returns:
+            The number of messages in the channel.
+        """
+        with self.lock:
+            self._sync()
+            return len(self._timelines.get(channel_id, []))
+
+    def channel_ids(self):
+        """
+        Returns:
+            A list of the ids of every channel with at least one message.
+        """
+        with self.lock:
+            self._sync()
+            return [channel_id for channel_id, timeline in self._timelines.items() if timeline]
+
+    def message_ids(self, channel_id):
+        """
+        Args:
+            channel_id (int): id of the channel.
+        Returns:
+            A list of the channel's message_ids from least recent to most recent.
+        """
+        with self.lock:
+            self._sync()
+            return list(self._timelines.get(channel_id, []))
+
+    def newest(self, channel_id, sort_key, before=None, chunk=256):
+        """
+        Walk a channel's messages from most recent to least recent, taking
+        lock for one chunk of the timeline at a time so that messages can
+        be sent between chunks. Messages are sent in order of sort_key, so
+        the timeline is in that order; each chunk carries on from the key
+        the last one ended at, wherever removals have moved it since.
+
+        Args:
+            channel_id (int): id of the channel.
+            sort_key (function): Gives the key of a message from its
+                message_id while lock is held, eg. (time_created, message_id).
+            before: Only walk messages whose key is less than this, or None
+                to start from the most recent.
+            chunk (int): Number of messages to read under lock at a time.
+        Returns:
+            A generator of (key, message_id) tuples.
+        """
+        while True:
+            with self.lock:
+                self._sync()
+                timeline = self._timelines.get(channel_id, [])
+                ## The number of messages whose key is less than before
+                low, end = 0, len(timeline)
+                if before is not None:
+                    while low < end:
+                        middle = (low + end) // 2
+                        if sort_key(timeline[middle]) < before:
+                            low = middle + 1
+                        else:
+                            end = middle
+                keyed = [
+                    (sort_key(m_id), m_id)
+                    for m_id in reversed(timeline[max(end - chunk, 0):end])
+                ]
+            if not keyed:
+                return
+            yield from keyed
+            before = keyed[-1][0]
+
+    def page(self, channel_id, start, length):
+        """
+        Args:
+            channel_id (int): id of the channel.
+            start (int): Number of most recent messages to skip.
+            length (int): Maximum number of message_ids to return.
+        Returns:
+            A list of message_ids from most recent to least recent.
+        """
+        with self.lock:
+            self._sync()
+            timeline = self._timelines.get(channel_id, [])
+            end = max(len(timeline) - start, 0)
+            return timeline[max(end - length, 0):end][::-1]
+
+
+class TextIndex(MessageIndex):
+    """
+    Inverted index from lowercase character trigrams to the ids of the
+    messages containing them. Any message containing a query of three or
+    more characters contains all of the query's trigrams, so intersecting
+    their postings gives a small candidate set to check for the substring.
+    """
+
+    def __init__(self, database):
+        super().__init__(database)
+        self._postings = {}
+        self._grams = {}
+
+    @staticmethod
+    def trigrams(text):
+        """
+        Args:
+            text (str): Lowercase text.
+        Returns:
+            The set of three-character substrings of text.
+        """
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def _clear(self):
+        self._postings = {}
+        self._grams = {}
+
+    def _add(self, message):
+        grams = self.trigrams(message["message"].lower())
+        self._grams[message["message_id"]] = grams
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(message["message_id"])
+
+    def _discard(self, message):
+        for gram in self._grams.pop(message["message_id"], ()):
+            posting = self._postings[gram]
+            posting.discard(message["message_id"])
+            if not posting:
+                del self._postings[gram]
+
+    def edit(self, message, text):
+        """
+        Re-index a message whose text is about to change.
+
+        Args:
+            message (dict): The message being edited.
+            text (str): The message's new text.
+        """
+        with self.lock:
+            self._sync()
+            self._discard(message)
+            self._add(dict(message, message=text))
+
+    def candidates(self, query):
+        """
+        Args:
+            query (str): Lowercase search query.
+        Returns:
+            A set of message_ids that may contain query, or None if query is
+            too short to narrow the search.
+        """
+        with self.lock:
+            self._sync()
+            grams = sorted(
+                (self._postings.get(gram, set()) for gram in self.trigrams(query)),
+                key=len
+            )
+            if not grams:
+                return None
+            return set(grams[0]).intersection(*grams[1:])
+
+
+def split_seq(seq):
+    """
+    Args:
+        seq (str): A change number as given by ChannelChanges, ie.
+            "<epoch>:<number>", or "0" for a channel that has not changed.
+    Raises:
+        ValueError: if seq is not in either form, or its number is negative.
+    Returns:
+        A tuple of the epoch (str, or None for "0") and the number (int).
+    """
+    if str(seq) == "0":
+        return None, 0
+    epoch, separator, number = str(seq).partition(":")
+    if not separator or not epoch or not number.isdigit():
+        raise ValueError(f"Invalid seq {seq!r}")
+    return epoch, int(number)
+
+
+class ChannelChanges:
+    """
+    A change number for each channel that goes up by one whenever one of its
+    messages is sent, changed or removed, so that a client that has seen a
+    channel up to some number can be sent only what changed after it.
+
+    The latest change of each channel is a row of the "channel_changes"
+    table, so numbers carry on after a restart and reach every server
+    process through the journal. Which message each earlier number changed
+    is only kept in memory, from the number a channel was at when the table
+    was loaded (its floor) onwards. Changes are recorded while holding the
+    messages table's lock.
+
+    Each row also has an epoch, picked at random when the channel first
+    changes, which is given along with the number as "<epoch>:<number>".
+    Numbers start again from 1 once the table is emptied (eg. by a
+    workspace reset), but the epoch does not match, so a client holding a
+    number from before is told to start again rather than sent the wrong
+    changes.
+
+    Threads can wait() for a channel's next change. Each channel has its own
+    condition, so a change only wakes the threads waiting on its channel,
+    and nothing is queued for them: a woken thread asks since() for
+    whatever changed while it was busy.
+    """
+
+    def __init__(self, database):
+        self._database = database
+        self._source = None
+        self._rows = {}
+        self._changes = {}
+        self._floors = {}
+        self.lock = TABLE_LOCKS["messages"]
+        ## The latest change of each channel as seen by waiting threads,
+        ## which never take the messages table's lock while holding this one
+        self._latest = {}
+        self._waiting = {}
+        self._waiting_lock = threading.Lock()
+
+    @staticmethod
+    def _seq(row):
+        """
+        Returns:
+            The change number (str) of a "channel_changes" row.
+        """
+        return f"{row.get('epoch', '0')}:{row['seq']}"
+
+    def _sync(self):
+        """
+        Start again from the table if it has been replaced (eg. by
+        workspace_reset() or data_reload()).
+        """
+        rows = self._database.get().setdefault("channel_changes", [])
+        if rows is not self._source or len(rows) != len(self._rows):
+            self._rows = {row["channel_id"]: row for row in rows}
+            self._changes = {}
+            self._floors = {channel_id: row["seq"] for channel_id, row in self._rows.items()}
+            self._source = rows
+            with self._waiting_lock:
+                self._latest = {channel_id: self._seq(row) for channel_id, row in self._rows.items()}
+                for condition in self._waiting.values():
+                    condition.notify_all()
+        return rows
+
+    def apply(self, row):
+        """
+        Make a change the latest of its channel, eg. one that another server
+        process has journaled.
+
+        Args:
+            row (dict): The channel's new "channel_changes" row.
+        Returns:
+            The row as stored in the table.
+        """
+        with self.lock:
+            rows = self._sync()
+            channel_id = row["channel_id"]
+            existing = self._rows.get(channel_id)
+            if existing is None:
+                rows.append(row)
+                self._rows[channel_id] = existing = row
+            else:
+                existing.update(row)
+            self._floors.setdefault(channel_id, row["seq"] - 1)
+            changes = self._changes.setdefault(channel_id, OrderedDict())
+            changes[row["message_id"]] = (row["seq"], row["removed"])
+            changes.move_to_end(row["message_id"])
+            with self._waiting_lock:
+                self._latest[channel_id] = self._seq(existing)
+                if channel_id in self._waiting:
+                    self._waiting[channel_id].notify_all()
+            return existing
+
+    def record(self, message, removed=False):
+        """
+        Give a change to a message the next number of its channel.
+
+        Args:
+            message (dict): The message that was sent, changed or removed.
+            removed (bool): Whether the message was removed.
+        """
+        with self.lock:
+            self._sync()
+            latest = self._rows.get(message["channel_id"])
+            row = self.apply({
+                "channel_id": message["channel_id"],
+                "epoch": latest.get("epoch", "0") if latest is not None else secrets.token_hex(4),
+                "seq": latest["seq"] + 1 if latest is not None else 1,
+                "message_id": message["message_id"],
+                "removed": removed
+            })
+            JOURNAL.put(self._database, "channel_changes", "channel_id", row)
+
+    def latest(self, channel_id):
+        """
+        Args:
+            channel_id (int): id of the channel.
+        Returns:
+            The channel's latest change number (str), or "0" if it has not
+            changed.
+        """
+        with self.lock:
+            self._sync()
+            return self._seq(self._rows[channel_id]) if channel_id in self._rows else "0"
+
+    def since(self, channel_id, seq):
+        """
+        Args:
+            channel_id (int): id of the channel.
+            seq (str): The last change number the client has seen.
+        Raises:
+            ValueError: if seq is not a change number (see split_seq()).
+        Returns:
+            A tuple of the channel's latest change number and a list of
+            (message_id, removed) tuples for the messages changed after seq,
+            from least to most recently changed. The list is None if the
+            changes after seq are not known (seq is from another epoch, from
+            before the floor or after the latest change, eg. from before a
+            workspace reset).
+        """
+        epoch, number = split_seq(seq)
+        with self.lock:
+            latest = self.latest(channel_id)
+            row = self._rows.get(channel_id)
+            if row is None:
+                return latest, [] if epoch is None else None
+            if epoch is not None and epoch != row.get("epoch", "0"):
+                return latest, None
+            if number > row["seq"] or number < self._floors.get(channel_id, 0):
+                return latest, None
+            changed = []
+            for message_id, (change, removed) in reversed(self._changes.get(channel_id, {}).items()):
+                if change <= number:
+                    break
+                changed.append((message_id, removed))
+            changed.reverse()
+            return latest, changed
+
+    def wait(self, channel_id, seq, timeout):
+        """
+        Block until a channel's latest change number is no longer seq.
+
+        Args:
+            channel_id (int): id of the channel.
+            seq (str): The last change number the caller has seen.
+            timeout (float): Maximum number of seconds to wait.
+        Returns:
+            True if the channel has changed, or False if timeout passed first.
+        """
+        with self.lock:
+            self._sync()
+        with self._waiting_lock:
+            condition = self._waiting.get(channel_id)
+            if condition is None:
+                condition = self._waiting[channel_id] = threading.Condition(self._waiting_lock)
+            return condition.wait_for(lambda: self._latest.get(channel_id, "0") != seq, timeout)
+
+
+class ChannelMembers:
+    """
+    The ids of the channels each user is a member of, so that finding a
+    user's channels does not search every channel's member list.
+
+    Like the other indexes, it follows the channels table: it is rebuilt
+    when a channel is added, removed or saved through its index (which
+    changes the index's version), when the table is replaced, or when a
+    channel's number of members changes behind its back (eg. a helper
+    appended a member without saving the channel), which only costs
+    comparing a count for each channel.
+    """
+
+    def __init__(self, database, channels):
+        self._database = database
+        self._channels = channels
+        self._members = {}
+        self._fingerprint = None
+
+    def channel_ids(self, u_id):
+        """
+        Args:
+            u_id (int): id of the user.
+        Returns:
+            A set of the ids of the channels the user is a member of.
+        """
+        with self._channels.lock:
+            version = self._channels.version
+            rows = self._database.get().get("channels", [])
+            fingerprint = (version, id(rows), [len(row["all_members"]) for row in rows])
+            if fingerprint != self._fingerprint:
+                self._members = {}
+                for row in rows:
+                    for member in row["all_members"]:
+                        self._members.setdefault(member["u_id"], set()).add(row["channel_id"])
+                self._fingerprint = fingerprint
+            return set(self._members.get(u_id, ()))
+
+
+TOKENS = TableIndex(AUTH_DATABASE, "active_tokens", "token", group="u_id")
+USERS = TableIndex(AUTH_DATABASE, "registered_users", "u_id")
+CHANNELS = TableIndex(CHANNELS_DATABASE, "channels", "channel_id")
+MESSAGES = TableIndex(MESSAGES_DATABASE, "messages", "message_id")
+## Messages waiting to be sent by message_sendlater(), which are changed
+## along with the messages table so share its lock
+QUEUED = TableIndex(
+    MESSAGES_DATABASE, "queued_messages", "message_id", lock=TABLE_LOCKS["messages"]
+)
+QUEUED_IDS = ValueIndex(MESSAGES_DATABASE, "queued_message_ids", TABLE_LOCKS["messages"])
+TIMELINES = ChannelTimelines(MESSAGES_DATABASE)
+SEARCH = TextIndex(MESSAGES_DATABASE)
+CHANGES = ChannelChanges(CHANNELS_DATABASE)
+MEMBERS = ChannelMembers(CHANNELS_DATABASE, CHANNELS)
+
+#####################################################################
+
+def generate_token(u_id):
+    """
+    Generate an active token for a user and index it.
+
+    Args:
+        u_id (int): id of the user being given the token.
+    Returns:
+        The new token (str).
+    """
+    with TOKENS.lock:
+        token = helpers_auth.generate_token(u_id)
+        TOKENS.track(token)
+    return token
+
+def is_token_valid(token):
+    """
+    Args:
+        token (str): Token being checked.
+    Returns:
+        True if the token is an active token, else False.
+    """
+    return token in TOKENS
+
+def find_u_id(token):
+    """
+    Args:
+        token (str): An active token.
+    Returns:
+        The u_id (int) of the user the token belongs to, or None if the token
+        is not active.
+    """
+    row = TOKENS.get(token)
+    return row["u_id"] if row is not None else None
+
+def is_user_in_channel(token, channel_id):
+    """
+    Args:
+        token (str): Token of a user.
+        channel_id (int): id of a channel.
+    Returns:
+        True if the token is active and its user is a member of the channel,
+        else False.
+    """
+    u_id = find_u_id(token)
+    with CHANNELS.lock:
+        channel = CHANNELS.get(channel_id)
+        if u_id is None or channel is None:
+            return False
+        return any(member["u_id"] == u_id for member in channel["all_members"])
+
+def remove_token(token):
+    """
+    Invalidate an active token.
+
+    Args:
+        token (str): Token being invalidated.
+    """
+    TOKENS.remove(token)
+
+def remove_user_tokens(u_id):
+    """
+    Invalidate every active token belonging to a user.
+
+    Args:
+        u_id (int): id of the user being logged out everywhere.
+    """
+    with TOKENS.lock:
+        for token in TOKENS.grouped(u_id):
+            TOKENS.remove(token)
+
+def add_message(message):
+    """
+    Add a message to the messages table and its channel's timeline. The
+    message and the change to its channel are journaled as one record.
+
+    Args:
+        message (dict): The new message.
+    """
+    with MESSAGES.lock, JOURNAL.group():
+        MESSAGES.insert(message)
+        TIMELINES.append(message)
+        SEARCH.append(message)
+        CHANGES.record(message)
+
+def track_message(message_id):
+    """
+    Index a message that a helper has already appended to the messages table.
+
+    Args:
+        message_id (int): id of the new message.
+    """
+    with MESSAGES.lock, JOURNAL.group():
+        MESSAGES.track(message_id)
+        message = MESSAGES.get(message_id)
+        if message is not None:
+            TIMELINES.append(message)
+            SEARCH.append(message)
+            CHANGES.record(message)
+
+def remove_message(message_id, journal=True):
+    """
+    Remove a message from the messages table and its channel's timeline.
+
+    Args:
+        message_id (int): id of the message being removed.
+        journal (bool): Whether to record the removal in the journal.
+    Returns:
+        The removed message, or None if there was no such message.
+    """
+    with MESSAGES.lock, JOURNAL.group():
+        message = MESSAGES.remove(message_id, journal)
+        if message is not None:
+            TIMELINES.remove(message)
+            SEARCH.remove(message)
+            ## Another process records its own removals
+            if journal:
+                CHANGES.record(message, removed=True)
+        return message
+
+def edit_message(message_id, text):
+    """
+    Change the text of a message and re-index it for search.
+
+    Args:
+        message_id (int): id of the message being edited.
+        text (str): The message's new text.
+    """
+    with MESSAGES.lock:
+        message = MESSAGES.get(message_id)
+        SEARCH.edit(message, text)
+        message["message"] = text
+        save_message(message_id)
+
+def save_message(message_id):
+    """
+    Write a message to the journal after it has been changed in place (eg.
+    reacted to or pinned), as the latest change to its channel.
+
+    Args:
+        message_id (int): id of the changed message.
+    """
+    with MESSAGES.lock, JOURNAL.group():
+        MESSAGES.save(message_id)
+        message = MESSAGES.get(message_id)
+        if message is not None:
+            CHANGES.record(message)
+
+def apply_put(index, key, row):
+    """
+    Add or update a row that another server process has journaled, keeping
+    the message indexes in step, without journaling it again.
+
+    Args:
+        index (TableIndex): Index of the table the row belongs to.
+        key (str): The row's indexed field.
+        row (dict): The row as journaled.
+    Returns:
+        The row as stored in the table.
+    """
+    with index.lock:
+        existing = index.get(row[key])
+        if existing is None:
+            index.insert(row, journal=False)
+            if index is MESSAGES:
+                TIMELINES.append(row)
+                SEARCH.append(row)
+            return row
+        if index is MESSAGES and existing["message"] != row["message"]:
+            SEARCH.edit(existing, row["message"])
+        ## Update in place without emptying the row first, as other threads
+        ## may be reading it
+        existing.update(row)
+        for field in [field for field in existing if field not in row]:
+            del existing[field]
+        index.save(row[key], journal=False)
+        return existing
+
+def apply_delete(index, key):
+    """
+    Remove a row that another server process has journaled as removed.
+
+    Args:
+        index (TableIndex): Index of the table the row belongs to.
+        key: Value of the row's indexed field.
+    Returns:
+        The removed row, or None if there was no such row.
+    """
+    if index is MESSAGES:
+        return remove_message(key, journal=False)
+    return index.remove(key, journal=False)
+
+def channel_page(channel_id, start, length=50):
+    """
+    Get one page of a channel's messages without scanning other channels.
+
+    Args:
+        channel_id (int): id of the channel.
+        start (int): Number of most recent messages to skip.
+        length (int): Maximum number of messages in the page.
+    Returns:
+        A list of message dictionaries from most recent to least recent.
+    """
+    with MESSAGES.lock:
+        return [MESSAGES.get(m_id) for m_id in TIMELINES.page(channel_id, start, length)]
+
+def message_lock(message_id):
+    """
+    Changes to a message are made while holding the lock of its channel, so
+    that a check of the message (eg. has_user_reacted()) and the change that
+    depends on it happen together.
+
+    Args:
+        message_id (int): id of a message.
+    Returns:
+        The lock (threading.RLock) of the message's channel.
+    """
+    message = MESSAGES.get(message_id)
+    return CHANNEL_LOCKS(message["channel_id"] if message is not None else None)
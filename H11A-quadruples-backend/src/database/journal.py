@@ -0,0 +1,474 @@
+"""
+Append-only write-ahead journal of changes made to the databases.
+H11A-quadruples, April 2020.
+"""
+
+import os
+import pickle
+import shutil
+import struct
+import threading
+from contextlib import contextmanager, nullcontext
+from zlib import crc32
+from database.database import AUTH_DATABASE, CHANNELS_DATABASE, MESSAGES_DATABASE
+from database.positions import Positions
+from constants import AUTH_DB_PATH
+
+DATABASES = {
+    "auth": AUTH_DATABASE,
+    "channels": CHANNELS_DATABASE,
+    "messages": MESSAGES_DATABASE
+}
+
+JOURNAL_PATH = os.path.join(os.path.dirname(AUTH_DB_PATH), "journal.log")
+
+## Each record is its length and checksum followed by the pickled entry
+HEADER = struct.Struct(">II")
+
+## Whether each record is fsynced before the change it records returns.
+## Without it a record is handed to the operating system, which survives
+## the process being killed but not the machine going down before the
+## record reaches the disk; with it every record (or group, see
+## Journal.group()) waits for a disk flush while holding Journal.lock
+FSYNC = os.environ.get("SLACKR_JOURNAL_FSYNC", "0") == "1"
+
+def database_name(database):
+    """
+    Args:
+        database: One of the database objects in DATABASES.
+    Returns:
+        The name (str) the database is journaled under.
+    """
+    for name, journaled in DATABASES.items():
+        if journaled is database:
+            return name
+    raise KeyError(database)
+
+
+class Journal:
+    """
+    Records every change to the databases as it happens so that they can be
+    rebuilt from the last snapshot plus the journal after a crash.
+
+    Every entry is idempotent (rows are written whole and keyed), so
+    replaying entries that are already reflected in a snapshot is harmless.
+    Nothing is written until the journal has been opened, but every change
+    marks the part of the database it touched as dirty, so that the next
+    snapshot only has to rewrite those parts.
+
+    Holding lock stops any change from being recorded, which gives a point
+    at which a snapshot can be taken that matches the rotated journal.
+    Listeners (eg. a storage backend) are passed each entry, pickled, as it
+    is recorded, in the order the changes were made. Each record is written
+    inside append_guard(), which processes that share the journal replace
+    (see WorkerSync) so that they take turns to append. If fsync is True,
+    each record is fsynced before the change it records returns (see FSYNC).
+    """
+
+    def __init__(self, path, fsync=FSYNC):
+        self.path = path
+        self.old_path = f"{path}.old"
+        self.fsync = fsync
+        self._file = None
+        self.lock = threading.RLock()
+        self._dirty = {}
+        self._listeners = []
+        self.append_guard = nullcontext
+        ## Entries held back by each thread's group()
+        self._groups = threading.local()
+
+    def subscribe(self, listener):
+        """
+        Pass every entry recorded from now on to listener, while lock is held.
+
+        Args:
+            listener (function): Called with each entry tuple, pickled (bytes).
+        """
+        with self.lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """
+        Stop passing entries to a listener added by subscribe().
+        """
+        with self.lock:
+            self._listeners.remove(listener)
+
+    def open(self):
+        """
+        Start appending entries to the journal file.
+        """
+        with self.lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+
+    def close(self):
+        """
+        Stop writing entries.
+        """
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, shard, *entry):
+        """
+        Append an entry to the journal and mark the shard it changed as dirty.
+        Inside group(), the entry is held back and written with the group.
+
+        Args:
+            shard: The part of the database that changed (see dirty_shard()),
+                or None if the whole database changed.
+            entry: The operation name and database name followed by the
+                operation's arguments.
+        """
+        grouped = getattr(self._groups, "entries", None)
+        if grouped is not None:
+            grouped.append((shard, entry))
+            return
+        self._write([(shard, entry)])
+
+    @contextmanager
+    def group(self):
+        """
+        Write every entry that the calling thread records inside the block
+        as one record once the block ends, eg. a message and the change it
+        makes to its channel, which costs one write (and one fsync, if fsync
+        is True) rather than one each.
+        Only for changes made while holding the lock of every table they
+        touch, so that no other thread records a change to them in between.
+        May be nested, in which case the outermost block writes the record.
+        """
+        if getattr(self._groups, "entries", None) is not None:
+            yield
+            return
+        self._groups.entries = []
+        try:
+            yield
+        finally:
+            grouped, self._groups.entries = self._groups.entries, None
+            if grouped:
+                self._write(grouped)
+
+    def _write(self, grouped):
+        """
+        Append a record of one entry, or of a group of entries, to the
+        journal, mark the shards they changed as dirty and pass the record
+        to the listeners.
+
+        Args:
+            grouped (list): (shard, entry) tuples, as passed to record().
+        """
+        if len(grouped) == 1:
+            entry = grouped[0][1]
+        else:
+            entry = ("group", None, [entry for _, entry in grouped])
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            for shard, grouped_entry in grouped:
+                self.mark(grouped_entry[1], shard)
+            if self._file is not None:
+                with self.append_guard():
+                    self._file.write(HEADER.pack(len(data), crc32(data)) + data)
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+            for listener in self._listeners:
+                listener(data)
+
+    def mark(self, name, shard):
+        """
+        Mark a shard of a database as dirty without recording an entry, eg.
+        for a change that another process recorded.
+
+        Args:
+            name (str): Name of the database.
+            shard: The part of the database that changed, or None.
+        """
+        with self.lock:
+            self._dirty.setdefault(name, set()).add(shard)
+
+    def reopen(self):
+        """
+        Start a new journal file if another process has moved the one being
+        written aside (see rotate()) since it was opened.
+        """
+        with self.lock:
+            if self._file is None:
+                return
+            try:
+                moved = os.fstat(self._file.fileno()).st_ino != os.stat(self.path).st_ino
+            except FileNotFoundError:
+                moved = True
+            if moved:
+                self._file.close()
+                self._file = open(self.path, "ab")
+
+    def put(self, database, table, key, row):
+        """
+        Record that a row was added to or changed in a table.
+        """
+        self.record(dirty_shard(table, row), "put", database_name(database), table, key, row)
+
+    def delete(self, database, table, key, row):
+        """
+        Record that a row was removed from a table.
+        """
+        self.record(dirty_shard(table, row), "delete", database_name(database), table, key, row[key])
+
+    def add(self, database, table, value):
+        """
+        Record that a value was added to a list of plain values.
+        """
+        self.record(dirty_shard(table), "add", database_name(database), table, value)
+
+    def discard(self, database, table, value):
+        """
+        Record that a value was removed from a list of plain values.
+        """
+        self.record(dirty_shard(table), "discard", database_name(database), table, value)
+
+    def replace(self, database):
+        """
+        Record the whole contents of a database, eg. after a workspace reset.
+        """
+        self.record(None, "replace", database_name(database), database.get())
+
+    def rotate(self):
+        """
+        Move the current journal aside and start a new one, and collect the
+        shards that have changed since the last rotation. Entries in the old
+        journal are covered once those shards have been written to a
+        snapshot. If an old journal is still there (eg. a snapshot failed),
+        the current journal is added to the end of it rather than replacing it.
+
+        Returns:
+            A tuple of the path (str) of the old journal and a dictionary
+            from database name to the set of dirty shards. The dictionary is
+            empty (and nothing is rotated) if nothing has changed.
+        """
+        with self.lock:
+            dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return self.old_path, dirty
+            reopen = self._file is not None
+            if reopen:
+                self._file.close()
+            if os.path.exists(self.path):
+                if os.path.exists(self.old_path):
+                    with open(self.old_path, "ab") as old, open(self.path, "rb") as current:
+                        shutil.copyfileobj(current, old)
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.old_path)
+            if reopen:
+                self._file = open(self.path, "ab")
+        return self.old_path, dirty
+
+    def restore_dirty(self, dirty):
+        """
+        Mark shards as dirty again after a snapshot of them failed.
+
+        Args:
+            dirty (dict): Dirty shards returned by rotate().
+        """
+        with self.lock:
+            for name, shards in dirty.items():
+                self._dirty.setdefault(name, set()).update(shards)
+
+    def truncate(self):
+        """
+        Delete the old and current journals, once a full snapshot has been
+        written.
+        """
+        with self.lock:
+            self._dirty = {}
+            for path in (self.old_path, self.path):
+                if os.path.exists(path):
+                    os.remove(path)
+            if self._file is not None:
+                self._file.close()
+                self._file = open(self.path, "ab")
+
+    def recover(self):
+        """
+        Apply the old and current journals to the databases, after the
+        last snapshot has been loaded.
+
+        Returns:
+            The number of entries applied.
+        """
+        return replay(self.old_path) + replay(self.path)
+
+
+def dirty_shard(table, row=None):
+    """
+    Messages are saved in one shard per channel; every other table belongs
+    to the base shard of its database.
+
+    Args:
+        table (str): Name of the table that changed.
+        row (dict): The row that changed, if any.
+    Returns:
+        The channel_id (int) of a changed message, else "base".
+    """
+    if table == "messages" and row is not None:
+        return row["channel_id"]
+    return "base"
+
+
+def read_records(file, positions=False):
+    """
+    Read entries from an open journal file, starting at its current position
+    and stopping at the end of the file or at the first torn or corrupt
+    record (eg. one that is still being written). The file is left
+    positioned just after the last entry read.
+
+    Args:
+        file: The journal file, opened for reading in binary mode.
+        positions (bool): Whether to also give where each record starts.
+    Returns:
+        A generator of journal entries, or of (position, entry) tuples if
+        positions is True.
+    """
+    while True:
+        start = file.tell()
+        header = file.read(HEADER.size)
+        if len(header) == HEADER.size:
+            length, checksum = HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) == length and crc32(data) == checksum:
+                yield (start, pickle.loads(data)) if positions else pickle.loads(data)
+                continue
+        file.seek(start)
+        return
+
+
+def read_entries(path):
+    """
+    Read the entries in a journal file, stopping at the first torn or
+    corrupt record (eg. one that was being written during a crash).
+
+    Args:
+        path (str): Path to the journal file.
+    Returns:
+        A generator of journal entries.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as file:
+        yield from read_records(file)
+
+
+def split_group(entry):
+    """
+    Args:
+        entry (tuple): A journal entry as read back, which may be a group
+            (see Journal.group()).
+    Returns:
+        The list of entries it holds, in the order they were recorded.
+    """
+    if entry[0] == "group":
+        return entry[2]
+    return [entry]
+
+
+def apply_entry(entry, tables):
+    """
+    Apply one journal entry to the databases.
+
+    Args:
+        entry (tuple): The entry, as passed to Journal.record().
+        tables (dict): Rows by key, and their Positions, for each table
+            touched so far, kept between calls so that each entry is O(1).
+            Start with {}.
+    Returns:
+        The row that was put or deleted, or None if no row was.
+    """
+    def indexed(name, table, key=None):
+        """
+        Returns:
+            A tuple of the table's rows by key (or its values by value, if
+            key is None) and their Positions in the table.
+        """
+        if (name, table, key) not in tables:
+            rows = DATABASES[name].get().setdefault(table, [])
+            keys = list(rows) if key is None else [row[key] for row in rows]
+            positions = Positions()
+            positions.reset(keys)
+            tables[(name, table, key)] = (dict(zip(keys, rows)), positions)
+        return tables[(name, table, key)]
+
+    def remove(name, table, key, value):
+        """
+        Remove a row (or a plain value, if key is None) from a table
+        without searching it.
+
+        Returns:
+            The removed row or value, or None if it was not there.
+        """
+        by_key, positions = indexed(name, table, key)
+        existing = by_key.pop(value, None)
+        if existing is not None:
+            rows = DATABASES[name].get()[table]
+            del rows[positions.pop(value)]
+            if positions.stale:
+                positions.reset(list(rows) if key is None else [row[key] for row in rows])
+        return existing
+
+    if entry[0] == "group":
+        for grouped in split_group(entry):
+            apply_entry(grouped, tables)
+        return None
+    operation, name = entry[0], entry[1]
+    data = DATABASES[name].get()
+    if operation == "put":
+        table, key, row = entry[2:]
+        by_key, positions = indexed(name, table, key)
+        existing = by_key.get(row[key])
+        if existing is None:
+            data[table].append(row)
+            by_key[row[key]] = row
+            positions.append(row[key])
+            return row
+        existing.clear()
+        existing.update(row)
+        return existing
+    if operation == "delete":
+        table, key, value = entry[2:]
+        return remove(name, table, key, value)
+    if operation == "add":
+        table, value = entry[2:]
+        by_value, positions = indexed(name, table)
+        if value not in by_value:
+            data[table].append(value)
+            by_value[value] = value
+            positions.append(value)
+    elif operation == "discard":
+        table, value = entry[2:]
+        remove(name, table, None, value)
+    elif operation == "replace":
+        DATABASES[name].update(entry[2])
+        for cached in [cached for cached in tables if cached[0] == name]:
+            del tables[cached]
+    return None
+
+
+def replay(path):
+    """
+    Apply every entry in a journal file to the databases.
+
+    Args:
+        path (str): Path to the journal file.
+    Returns:
+        The number of entries applied.
+    """
+    tables = {}
+    count = 0
+    for entry in read_entries(path):
+        apply_entry(entry, tables)
+        count += 1
+    return count
+
+
+JOURNAL = Journal(JOURNAL_PATH)
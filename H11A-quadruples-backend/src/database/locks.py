@@ -0,0 +1,71 @@
+"""
+Locks that serialise changes to the databases between request threads,
+Timer callbacks and the save thread.
+H11A-quadruples, April 2020.
+"""
+
+import threading
+from contextlib import contextmanager, ExitStack
+
+## Locks must be taken in this order, never the reverse, so that two
+## threads cannot each hold a lock the other is waiting for:
+##     0. WORKERS.exclusive() (which takes its tables in the order of TABLES)
+##     1. CHANNEL_LOCKS stripes (lowest stripe first if taking several)
+##     2. TABLE_LOCKS (in the order of TABLES if taking several)
+##     3. JOURNAL.lock
+
+## Tables that have their own lock. Changes to a channel's row or to the
+## rows of its messages are covered by the channel's stripe instead.
+TABLES = ("registered_users", "active_tokens", "channels", "messages")
+
+
+class LockStripes:
+    """
+    A fixed number of locks that keys are spread over, so that changes under
+    different keys (eg. to different channels) usually proceed in parallel
+    without needing a lock per key.
+    """
+
+    def __init__(self, count):
+        self._locks = [threading.RLock() for _ in range(count)]
+
+    def __call__(self, key):
+        """
+        Args:
+            key: A hashable key, eg. a channel_id.
+        Returns:
+            The lock (threading.RLock) that key maps to.
+        """
+        return self._locks[hash(key) % len(self._locks)]
+
+    @contextmanager
+    def all(self):
+        """
+        Hold every stripe, eg. while making a change that spans every channel.
+        """
+        with ExitStack() as stack:
+            for lock in self._locks:
+                stack.enter_context(lock)
+            yield
+
+
+CHANNEL_LOCKS = LockStripes(64)
+TABLE_LOCKS = {table: threading.RLock() for table in TABLES}
+
+@contextmanager
+def all_tables():
+    """
+    Hold every table lock, eg. while taking a snapshot of the databases.
+    """
+    with ExitStack() as stack:
+        for table in TABLES:
+            stack.enter_context(TABLE_LOCKS[table])
+        yield
+
+@contextmanager
+def all_locks():
+    """
+    Hold every lock, eg. while the whole workspace is being reset.
+    """
+    with CHANNEL_LOCKS.all(), all_tables():
+        yield
@@ -0,0 +1,269 @@
+"""
+A single thread that runs every scheduled job (eg. sendlater deliveries
+and standup ends) at its due time.
+H11A-quadruples, April 2020.
+"""
+
+import heapq
+import sys
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+from database.database import MESSAGES_DATABASE
+from database.journal import JOURNAL
+from database.indexes import TableIndex
+
+## Seconds to wait before running a job again after it failed
+JOB_RETRY = 10
+
+class Scheduler:
+    """
+    Holds pending jobs in a heap ordered by due time and runs them on one
+    daemon thread, rather than sleeping a thread per job.
+
+    Each job is a row of the "scheduled_jobs" table of the messages database
+    (its job_id, due time as a UNIX timestamp, and the name and arguments of
+    the function to call), so pending jobs are saved with the databases and
+    put back on the heap by reload(). A job's row is removed once it has
+    run, so a job that was running during a crash runs again after the
+    restart; job functions must therefore be safe to run twice.
+
+    Every job that is due is taken off the heap at once, so that a backlog
+    (eg. of jobs that fell due while the server was down) can be handed to
+    a function's batch handler in one call rather than run job by job. If
+    the batch handler raises, its jobs are run one at a time to find which
+    of them failed. A job that raises keeps its row and is tried again
+    JOB_RETRY seconds later.
+
+    When several server processes share the databases, each one holds every
+    job (see adopt()) and runs due jobs inside guard(), which the processes
+    take in turn; a job whose row another process has already removed is
+    skipped, so each job runs once.
+
+    Rows are found and removed through index (a TableIndex keyed on
+    job_id), so running a batch of due jobs costs O(batch) however many
+    jobs are pending.
+    """
+
+    def __init__(self, database, table):
+        self._database = database
+        self._table = table
+        self._functions = {}
+        self._batches = {}
+        self._heap = []
+        self._next_id = 0
+        self._condition = threading.Condition()
+        self.index = TableIndex(database, table, "job_id", lock=self._condition)
+        self._thread = None
+        self.guard = nullcontext
+
+    def _rows(self):
+        """
+        Returns:
+            The live table of pending jobs, creating it if the database
+            does not have one yet.
+        """
+        return self._database.get().setdefault(self._table, [])
+
+    def register(self, function, batch=None):
+        """
+        Allow a function to be scheduled. Jobs refer to functions by name so
+        that they can be saved and reloaded.
+
+        Args:
+            function (function): The function, called with the job's arguments.
+            batch (function): Optionally, a function that runs several of
+                function's jobs at once, called with a list of their
+                argument lists in the order they fell due.
+        """
+        self._functions[function.__name__] = function
+        self._batches.pop(function.__name__, None)
+        if batch is not None:
+            self._batches[function.__name__] = batch
+
+    def schedule(self, when, function, *args):
+        """
+        Run function(*args) at a given time.
+
+        Args:
+            when (float): UNIX timestamp to run the job at.
+            function (function): A function passed to register().
+            args: Arguments to call the function with; they are saved with
+                the job so must be picklable.
+        Returns:
+            The job_id (int) of the new job.
+        """
+        with self._condition:
+            self._next_id += 1
+            row = {
+                "job_id": self._next_id,
+                "time": when,
+                "name": function.__name__,
+                "args": list(args)
+            }
+            self.index.insert(row)
+            heapq.heappush(self._heap, (when, row["job_id"], row))
+            self._start()
+            self._condition.notify()
+        return row["job_id"]
+
+    def adopt(self, row):
+        """
+        Put a job that another server process scheduled on the heap.
+
+        Args:
+            row (dict): The job's row, already added to the table.
+        """
+        with self._condition:
+            self._next_id = max(self._next_id, row["job_id"])
+            heapq.heappush(self._heap, (row["time"], row["job_id"], row))
+            self._start()
+            self._condition.notify()
+
+    def pending(self):
+        """
+        Returns:
+            The number of jobs waiting to run.
+        """
+        with self._condition:
+            return len(self._rows())
+
+    def jobs(self, function):
+        """
+        Args:
+            function (function): A function passed to register().
+        Returns:
+            A list of the argument lists of function's jobs waiting to run.
+        """
+        with self._condition:
+            return [
+                list(row["args"]) for row in self._rows()
+                if row["name"] == function.__name__
+            ]
+
+    def reload(self):
+        """
+        Put every job in the table back on the heap, eg. after the databases
+        have been loaded. Jobs that are already overdue run straight away.
+        """
+        with self._condition:
+            rows = self._rows()
+            self._heap = [(row["time"], row["job_id"], row) for row in rows]
+            heapq.heapify(self._heap)
+            self._next_id = max([row["job_id"] for row in rows], default=0)
+            self._start()
+            self._condition.notify()
+
+    def clear(self):
+        """
+        Drop every pending job, eg. when the workspace is reset.
+        """
+        with self._condition:
+            rows = self._rows()
+            for row in rows:
+                JOURNAL.delete(self._database, self._table, "job_id", row)
+            self._heap = []
+            rows.clear()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _due_jobs(self):
+        """
+        Wait until the earliest job is due.
+
+        Returns:
+            A list of the rows of every job that is due, earliest first.
+        """
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    when, _, row = heapq.heappop(self._heap)
+                    ## The job has been put back on the heap for a later
+                    ## time since (eg. to be tried again)
+                    if when == row["time"]:
+                        due.append(row)
+                return due
+
+    def _live(self, due):
+        """
+        Args:
+            due (list): Rows of jobs taken off the heap.
+        Returns:
+            The rows of those jobs that are still in the table.
+        """
+        with self._condition:
+            live = {}
+            for row in due:
+                if self.index.get(row["job_id"]) is row:
+                    live[row["job_id"]] = row
+            return list(live.values())
+
+    def _finish(self, finished):
+        """
+        Remove the rows of jobs that have run.
+
+        Args:
+            finished (list): Rows of the jobs.
+        """
+        with self._condition:
+            for row in finished:
+                self.index.remove(row["job_id"])
+
+    def _retry(self, row):
+        """
+        Put a job that failed back on the heap, to run again JOB_RETRY
+        seconds from now.
+
+        Args:
+            row (dict): The job's row.
+        """
+        with self._condition:
+            row["time"] = time.time() + JOB_RETRY
+            self.index.save(row["job_id"])
+            heapq.heappush(self._heap, (row["time"], row["job_id"], row))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            due = self._due_jobs()
+            with self.guard():
+                ## Run each function's due jobs together, in the order the
+                ## functions first fell due
+                by_name = {}
+                for row in self._live(due):
+                    by_name.setdefault(row["name"], []).append(row)
+                for name, rows in by_name.items():
+                    if name in self._batches:
+                        try:
+                            self._batches[name]([row["args"] for row in rows])
+                        except Exception:
+                            traceback.print_exc()
+                        else:
+                            self._finish(rows)
+                            continue
+                    ## Only finish the jobs that ran, and try the rest again
+                    for row in rows:
+                        try:
+                            self._functions[name](*row["args"])
+                        except Exception:
+                            print(f"Scheduled job {row['job_id']} ({name}) failed", file=sys.stderr)
+                            traceback.print_exc()
+                            self._retry(row)
+                        else:
+                            self._finish([row])
+
+
+SCHEDULER = Scheduler(MESSAGES_DATABASE, "scheduled_jobs")
@@ -0,0 +1,355 @@
+"""
+Saving and loading snapshots of the databases.
+H11A-quadruples, April 2020.
+"""
+
+import os
+import pickle
+import struct
+import traceback
+from zlib import crc32
+from database.database import AUTH_DATABASE, CHANNELS_DATABASE, MESSAGES_DATABASE
+from database.indexes import MESSAGES, TIMELINES
+from database.journal import JOURNAL
+from database.locks import all_tables
+from constants import AUTH_DB_PATH, CHANNELS_DB_PATH, MESSAGES_DB_PATH
+
+## Snapshot files start with a magic string, format version, checksum and
+## length of the pickled data that follows
+MAGIC = b"SLKR"
+VERSION = 1
+HEADER = struct.Struct(">4sBII")
+
+## Each channel's messages are saved to their own file in this folder, so
+## that a change in one channel does not rewrite every message
+SEGMENTS_FOLDER = f"{MESSAGES_DB_PATH}.channels"
+
+class CorruptSnapshotError(Exception):
+    """
+    Raised when a snapshot file is truncated or fails its checksum.
+    """
+
+
+def fsync_folder(folder):
+    """
+    Make a rename in a folder durable.
+
+    Args:
+        folder (str): Path to the folder.
+    """
+    if os.name != "posix":
+        return
+    descriptor = os.open(folder or ".", os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+def encode_snapshot(data):
+    """
+    Args:
+        data: Data to pickle.
+    Returns:
+        The contents (bytes) of a snapshot file holding data.
+    """
+    pickled = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(MAGIC, VERSION, crc32(pickled), len(pickled)) + pickled
+
+def write_snapshot(path, data):
+    """
+    Atomically replace the snapshot at path. The data is written to a temp
+    file and fsynced before being renamed into place, and the snapshot it
+    replaces is kept as the previous generation. There is always a complete
+    snapshot at path, even if the process dies part way through.
+
+    Args:
+        path (str): Path to the snapshot file.
+        data: Data to pickle.
+    """
+    write_snapshot_file(path, encode_snapshot(data))
+
+def write_snapshot_file(path, contents):
+    """
+    Atomically replace the snapshot at path (see write_snapshot()).
+
+    Args:
+        path (str): Path to the snapshot file.
+        contents (bytes): The snapshot, as returned by encode_snapshot().
+    """
+    checksum = HEADER.unpack_from(contents)[2]
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(contents)
+        file.flush()
+        os.fsync(file.fileno())
+    if os.path.exists(path):
+        if os.path.exists(f"{path}.prev"):
+            os.remove(f"{path}.prev")
+        os.link(path, f"{path}.prev")
+    os.replace(temp_path, path)
+    fsync_folder(os.path.dirname(path))
+    verify_snapshot(path, checksum)
+
+def verify_snapshot(path, checksum):
+    """
+    Read a snapshot back after writing it, so that the journal entries it
+    covers are only discarded once it is known to be readable.
+
+    Args:
+        path (str): Path to the snapshot file.
+        checksum (int): crc32 of the pickled data that was written.
+    Raises:
+        CorruptSnapshotError: if the file does not hold that data.
+    """
+    with open(path, "rb") as file:
+        contents = file.read()
+    if len(contents) < HEADER.size:
+        raise CorruptSnapshotError(path)
+    magic, _, stored, length = HEADER.unpack_from(contents)
+    pickled = contents[HEADER.size:]
+    if magic != MAGIC or stored != checksum or len(pickled) != length or crc32(pickled) != checksum:
+        raise CorruptSnapshotError(path)
+
+def read_snapshot_file(path):
+    """
+    Args:
+        path (str): Path to a snapshot file.
+    Raises:
+        FileNotFoundError: if there is no file at path.
+        CorruptSnapshotError: if the file is truncated or fails its checksum.
+    Returns:
+        The unpickled data.
+    """
+    with open(path, "rb") as file:
+        contents = file.read()
+    if not contents.startswith(MAGIC):
+        ## Snapshots written before headers were added are plain pickles
+        try:
+            return pickle.loads(contents)
+        except Exception:
+            raise CorruptSnapshotError(path)
+    if len(contents) < HEADER.size:
+        raise CorruptSnapshotError(path)
+    _, version, checksum, length = HEADER.unpack_from(contents)
+    pickled = contents[HEADER.size:]
+    if version != VERSION or len(pickled) != length or crc32(pickled) != checksum:
+        raise CorruptSnapshotError(path)
+    return pickle.loads(pickled)
+
+def read_snapshot(path, fallback=False):
+    """
+    Read the snapshot at path, falling back to the previous generation if
+    the newest one is missing or corrupt and fallback is allowed.
+
+    The previous generation is older than the rest of the snapshots, so it
+    is only of use while the journal entries written since it are still
+    there to replay on top of it. Otherwise it would silently lose them
+    (and mix generations with the snapshots that did load), so the snapshot
+    counts as corrupt.
+
+    Args:
+        path (str): Path to the snapshot file.
+        fallback (bool): Whether the journal since the previous generation
+            is still there, so that it may be used.
+    Raises:
+        FileNotFoundError: if neither generation exists.
+        CorruptSnapshotError: if no generation can be read, or only the
+            previous one can and fallback is False.
+    Returns:
+        The unpickled data.
+    """
+    try:
+        return read_snapshot_file(path)
+    except (FileNotFoundError, CorruptSnapshotError):
+        if not os.path.exists(f"{path}.prev"):
+            raise
+        if not fallback:
+            raise CorruptSnapshotError(
+                f"{path} could not be read and the journal since {path}.prev is gone"
+            )
+        traceback.print_exc()
+        return read_snapshot_file(f"{path}.prev")
+
+def remove_snapshot(path):
+    """
+    Delete every generation of the snapshot at path.
+
+    Args:
+        path (str): Path to the snapshot file.
+    """
+    for generation in (path, f"{path}.prev"):
+        if os.path.exists(generation):
+            os.remove(generation)
+
+def segment_path(channel_id):
+    """
+    Args:
+        channel_id (int): id of a channel.
+    Returns:
+        The path (str) of the file that the channel's messages are saved to.
+    """
+    return os.path.join(SEGMENTS_FOLDER, f"{channel_id}.p")
+
+def segment_names():
+    """
+    Returns:
+        A list of the file names of the saved channel segments.
+    """
+    if not os.path.isdir(SEGMENTS_FOLDER):
+        return []
+    return [name for name in os.listdir(SEGMENTS_FOLDER) if name.endswith(".p")]
+
+def encode_messages(shards=None):
+    """
+    Pickle the messages database, with each channel's messages in their own
+    segment.
+
+    Args:
+        shards (set): channel_ids of the segments to pickle, plus "base" to
+            pickle everything other than messages. None pickles everything.
+    Returns:
+        A list of (path, contents) pairs of the snapshot files to write,
+        where contents is None for a segment to remove.
+    """
+    files = []
+    messages_data = MESSAGES_DATABASE.get()
+    if shards is None or "base" in shards:
+        base = {key: value for key, value in messages_data.items() if key != "messages"}
+        base["messages"] = []
+        files.append((MESSAGES_DB_PATH, encode_snapshot(base)))
+
+    channel_ids = TIMELINES.channel_ids()
+    if shards is None:
+        ## Remove segments of channels that no longer have messages
+        for segment in segment_names():
+            if int(segment[:-len(".p")]) not in channel_ids:
+                files.append((os.path.join(SEGMENTS_FOLDER, segment), None))
+    else:
+        channel_ids = [shard for shard in shards if shard != "base"]
+
+    for channel_id in channel_ids:
+        message_ids = TIMELINES.message_ids(channel_id)
+        if message_ids:
+            files.append((
+                segment_path(channel_id),
+                encode_snapshot([MESSAGES.get(m_id) for m_id in message_ids])
+            ))
+        else:
+            files.append((segment_path(channel_id), None))
+    return files
+
+def load_messages(fallback=False):
+    """
+    Load the pickled messages database and its channel segments.
+
+    Args:
+        fallback (bool): Whether previous generations may be used (see
+            read_snapshot()).
+    """
+    messages_data = read_snapshot(MESSAGES_DB_PATH, fallback)
+    if segment_names():
+        messages = list(messages_data["messages"])
+        ## Each segment is saved in its channel's timeline order, which is
+        ## the only order the indexes read, so keep it as it is
+        for segment in sorted(segment_names(), key=lambda name: int(name[:-len(".p")])):
+            messages.extend(read_snapshot(os.path.join(SEGMENTS_FOLDER, segment), fallback))
+        messages_data["messages"] = messages
+    MESSAGES_DATABASE.update(messages_data)
+
+def encode_databases(dirty=None):
+    """
+    Pickle the databases, skipping any that have not changed. Every table
+    lock is held while pickling, so that no table or index is pickled half
+    way through a change.
+
+    Args:
+        dirty (dict): Dirty shards by database name, as returned by
+            JOURNAL.rotate(). None pickles everything.
+    Returns:
+        A list of (path, contents) pairs of the snapshot files to write,
+        where contents is None for a snapshot to remove.
+    """
+    files = []
+    with all_tables():
+        if dirty is None or "auth" in dirty:
+            files.append((AUTH_DB_PATH, encode_snapshot(AUTH_DATABASE.get())))
+        if dirty is None or "channels" in dirty:
+            files.append((CHANNELS_DB_PATH, encode_snapshot(CHANNELS_DATABASE.get())))
+        if dirty is None:
+            files.extend(encode_messages())
+        elif "messages" in dirty:
+            ## A None shard means the whole database was replaced
+            files.extend(encode_messages(None if None in dirty["messages"] else dirty["messages"]))
+    return files
+
+def write_databases(files):
+    """
+    Write the snapshot files pickled by encode_databases().
+
+    Args:
+        files (list): (path, contents) pairs, where contents is None for a
+            snapshot to remove.
+    """
+    os.makedirs(SEGMENTS_FOLDER, exist_ok=True)
+    for path, contents in files:
+        if contents is None:
+            remove_snapshot(path)
+        else:
+            write_snapshot_file(path, contents)
+
+def save_databases(dirty=None):
+    """
+    Pickle dump the databases, skipping any that have not changed.
+
+    Args:
+        dirty (dict): Dirty shards by database name, as returned by
+            JOURNAL.rotate(). None writes everything.
+    """
+    write_databases(encode_databases(dirty))
+
+def load_databases():
+    """
+    Load the pickled databases. The old journal is only removed once a
+    compaction's snapshots have been written and verified, so while it is
+    still there a snapshot that cannot be read is one that compaction was
+    writing, and its previous generation plus the entries that
+    JOURNAL.recover() replays make up for it. Otherwise the snapshot must
+    have been damaged since, and loading stops rather than losing entries.
+    """
+    fallback = os.path.exists(JOURNAL.old_path)
+    AUTH_DATABASE.update(read_snapshot(AUTH_DB_PATH, fallback))
+    CHANNELS_DATABASE.update(read_snapshot(CHANNELS_DB_PATH, fallback))
+    load_messages(fallback)
+
+def start_save(dirty=None):
+    """
+    Start saving the databases by pickling them as they are now, so that
+    requests can keep changing them while finish_save() writes the files.
+
+    The pickling is done while holding every table lock rather than from a
+    copy of the tables, as rows (and lists within them) are changed in
+    place, so only the pickling pauses requests and the writing and fsyncs
+    do not.
+
+    Args:
+        dirty (dict): Dirty shards by database name, or None to save everything.
+    Returns:
+        The pickled snapshot files (list) to pass to finish_save().
+    """
+    return encode_databases(dirty)
+
+def finish_save(files):
+    """
+    Write the snapshot files pickled by start_save().
+
+    Args:
+        files (list): The pickled snapshot files returned by start_save().
+    Returns:
+        True if the save succeeded, else False.
+    """
+    try:
+        write_databases(files)
+    except Exception:
+        traceback.print_exc()
+        return False
+    return True
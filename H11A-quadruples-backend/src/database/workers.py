@@ -0,0 +1,348 @@
+"""
+Sharing the databases between several server processes (eg. the workers
+of a WSGI server) through the journal.
+H11A-quadruples, April 2020.
+"""
+
+import fcntl
+import os
+import struct
+import threading
+from contextlib import contextmanager, ExitStack
+from database import indexes
+from database.journal import JOURNAL, apply_entry, dirty_shard, read_records, split_group
+from database.locks import TABLES, all_tables
+from database.scheduler import SCHEDULER
+
+## The byte of the lock file that each table's lock covers, and the byte
+## whose lock is held while appending to the journal
+TABLE_BYTES = {table: position for position, table in enumerate(TABLES)}
+APPEND_BYTE = len(TABLES)
+
+## Where the lock file keeps the inode and length of the journal as the
+## last process to append to it left it
+COMMITTED = struct.Struct(">QQ")
+COMMITTED_OFFSET = 16
+
+## Each process holds a shared lock on the byte at FOLLOW_OFFSET plus the
+## inode of the journal it is following, so that others can tell whether
+## every process has reached the current journal
+FOLLOW_OFFSET = 64
+
+## Longest that catch_up() waits for another thread that is catching up,
+## in seconds
+CATCH_UP_WAIT = 1
+
+## Tables whose rows are applied through their index, by database and table name
+INDEXED = {
+    ("auth", "active_tokens"): indexes.TOKENS,
+    ("auth", "registered_users"): indexes.USERS,
+    ("channels", "channels"): indexes.CHANNELS,
+    ("messages", "messages"): indexes.MESSAGES,
+    ("messages", "queued_messages"): indexes.QUEUED,
+    ("messages", "scheduled_jobs"): SCHEDULER.index,
+}
+
+## Tables of plain values that are applied through their index
+INDEXED_VALUES = {
+    ("messages", "queued_message_ids"): indexes.QUEUED_IDS,
+}
+
+
+class WorkerSync:
+    """
+    Keeps the in-memory databases of several processes in step.
+
+    Each process loads the databases once and then follows the shared
+    journal, applying the entries that other processes record (and keeping
+    its indexes and scheduler in step with them). Each table is changed by
+    one process at a time: a process holds a lock on a byte of the lock file
+    for each table it is changing, from catching up with the journal until
+    it has recorded its own entries, so every change is made to an
+    up-to-date copy of the tables it changes. Changes to different tables
+    run in different processes at once, so their entries interleave in the
+    journal, and each process skips its own entries by where it wrote them.
+    Reads only catch up first, so they run in every process at once.
+
+    Records are appended under a short lock of their own, taken by one
+    process at a time; the lock file keeps the length the journal was left
+    at, so a record torn by a process that died while appending it is cut
+    off before anything is added after it.
+
+    A process only moves on to a new journal once it has read the one it
+    was following, so the journal must not be rotated again until every
+    process has moved on (see others_behind()); otherwise a process that
+    fell behind would never read the journal in between.
+
+    Nothing is shared until start() is called; until then exclusive() and
+    catch_up() do nothing, so a single server process is unaffected.
+    """
+
+    def __init__(self, journal, path):
+        self._journal = journal
+        self.path = path
+        self._lock_file = None
+        self._following = None
+        ## Where this process's own records start, as (inode, position)
+        self._own = set()
+        ## Held while reading the journal, which the process follows once
+        self._follow_lock = threading.Lock()
+        ## A lock file's locks belong to the whole process, so threads take
+        ## turns at each table before locking it in the file
+        self._table_locks = {table: threading.Lock() for table in TABLES}
+        self._held = threading.local()
+
+    @property
+    def active(self):
+        """
+        True once start() has been called in this process.
+        """
+        return self._lock_file is not None
+
+    def start(self, storage):
+        """
+        Load the databases, or save them if nothing has been saved yet, and
+        start following the journal. Scheduled jobs are run inside
+        exclusive() from then on.
+
+        Args:
+            storage (StorageBackend): Where the databases are persisted.
+        """
+        self._lock_file = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        self._journal.append_guard = self._appending
+        with self.exclusive():
+            try:
+                storage.load()
+            except FileNotFoundError:
+                storage.save()
+            SCHEDULER.reload()
+            self._journal.open()
+            storage.open()
+            ## Everything in the journal was replayed by load()
+            self._follow()
+            self._following.seek(0, os.SEEK_END)
+        SCHEDULER.guard = self.exclusive
+
+    @contextmanager
+    def _file_lock(self, byte):
+        """
+        Hold the lock on one byte of the lock file.
+
+        Args:
+            byte (int): Position of the byte.
+        """
+        fcntl.lockf(self._lock_file, fcntl.LOCK_EX, 1, byte)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, byte)
+
+    def _held_tables(self):
+        """
+        Returns:
+            The set of tables the calling thread holds in exclusive().
+        """
+        if not hasattr(self._held, "tables"):
+            self._held.tables = set()
+        return self._held.tables
+
+    @contextmanager
+    def exclusive(self, *tables):
+        """
+        Change some tables with no other process changing them, after
+        catching up with every change made before. Other tables may still be
+        read. May be nested, as long as the inner call only adds tables that
+        come after every table held already in TABLES.
+
+        Args:
+            tables (str): Names (from TABLES) of the tables being changed,
+                or none to change every table.
+        Raises:
+            RuntimeError: if a nested call would take tables out of order.
+        """
+        if not self.active:
+            yield
+            return
+        held = self._held_tables()
+        wanted = [table for table in TABLES if table in (tables or TABLES) and table not in held]
+        if held and wanted and TABLES.index(wanted[0]) < max(TABLES.index(table) for table in held):
+            raise RuntimeError(f"Cannot take {wanted} while holding {sorted(held)}")
+        with ExitStack() as stack:
+            for table in wanted:
+                stack.enter_context(self._table_locks[table])
+                stack.enter_context(self._file_lock(TABLE_BYTES[table]))
+                held.add(table)
+                stack.callback(held.discard, table)
+            if wanted:
+                with self._follow_lock:
+                    self._catch_up()
+            yield
+
+    @contextmanager
+    def _appending(self):
+        """
+        Append a record to the journal (see Journal.append_guard) with no
+        other process appending, after cutting off a record torn by a process
+        that died while appending it, and remember where it goes so that
+        catching up skips it.
+        """
+        with self._file_lock(APPEND_BYTE):
+            self._journal.reopen()
+            committed = os.pread(self._lock_file, COMMITTED.size, COMMITTED_OFFSET)
+            inode, end = COMMITTED.unpack(committed.ljust(COMMITTED.size, b"\0"))
+            stat = os.stat(self._journal.path)
+            if stat.st_ino != inode or stat.st_size <= end:
+                end = stat.st_size
+            else:
+                ## A process stopped after appending; keep whatever it
+                ## managed to append whole
+                with open(self._journal.path, "rb") as file:
+                    file.seek(end)
+                    for _ in read_records(file):
+                        pass
+                    end = file.tell()
+                if end < stat.st_size:
+                    os.truncate(self._journal.path, end)
+            self._own.add((stat.st_ino, end))
+            yield
+            os.pwrite(
+                self._lock_file,
+                COMMITTED.pack(stat.st_ino, os.stat(self._journal.path).st_size),
+                COMMITTED_OFFSET
+            )
+
+    def catch_up(self):
+        """
+        Apply the changes that other processes have made since this process
+        last caught up, eg. before a read. If another thread is catching up
+        already, wait for it (for up to CATCH_UP_WAIT seconds) and then read
+        whatever it left, rather than answering from a copy that may be
+        behind. Changes in progress in this process are not waited for; they
+        have caught up already, and no other process can make a change to
+        the same tables until they are finished.
+        """
+        if not self.active or not self._follow_lock.acquire(timeout=CATCH_UP_WAIT):
+            return
+        try:
+            self._catch_up()
+        finally:
+            self._follow_lock.release()
+
+    def _rotated(self):
+        """
+        Returns:
+            True if the journal being followed has been moved aside (see
+            Journal.rotate()), in which case nothing more will be added to it.
+        """
+        try:
+            return os.fstat(self._following.fileno()).st_ino != os.stat(self._journal.path).st_ino
+        except FileNotFoundError:
+            ## Part way through a rotation; the old journal may still grow
+            return False
+
+    def _catch_up(self):
+        """
+        Apply the entries that other processes have appended since this
+        process last read the journal, skipping its own. Called while
+        holding _follow_lock.
+        """
+        if self._following is None:
+            return
+        while True:
+            rotated = self._rotated()
+            inode = os.fstat(self._following.fileno()).st_ino
+            entries = []
+            for position, entry in read_records(self._following, positions=True):
+                if (inode, position) in self._own:
+                    self._own.discard((inode, position))
+                else:
+                    entries.extend(split_group(entry))
+            self._apply(entries)
+            if not rotated:
+                return
+            for own in [own for own in list(self._own) if own[0] == inode]:
+                self._own.discard(own)
+            self._follow()
+
+    def _follow(self):
+        """
+        Start following the current journal from its beginning, and move the
+        shared lock that says which journal this process is following.
+        """
+        following = open(self._journal.path, "rb")
+        inode = os.fstat(following.fileno()).st_ino
+        fcntl.lockf(self._lock_file, fcntl.LOCK_SH, 1, FOLLOW_OFFSET + inode)
+        if self._following is not None:
+            previous = os.fstat(self._following.fileno()).st_ino
+            if previous != inode:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, FOLLOW_OFFSET + previous)
+            self._following.close()
+        self._following = following
+
+    def others_behind(self):
+        """
+        Whether another process is still following a journal that has been
+        rotated. Called inside exclusive() (with every table) before rotating
+        the journal, which must wait until it returns False.
+
+        Returns:
+            True if another process has not yet moved on to the current
+            journal, else False.
+        """
+        if not self.active:
+            return False
+        inode = os.stat(self._journal.path).st_ino
+        ## Try to lock every byte but the current journal's; this process's
+        ## own lock is on that byte, as it has caught up
+        for start, length in ((FOLLOW_OFFSET, inode), (FOLLOW_OFFSET + inode + 1, 0)):
+            try:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB, length, start)
+            except OSError:
+                return True
+            finally:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, length, start)
+        return False
+
+    def _apply(self, entries):
+        """
+        Apply entries recorded by other processes, and mark what they changed
+        as dirty so that this process's snapshots include it.
+
+        Args:
+            entries (list): Journal entries, in the order they were recorded.
+        """
+        if not entries:
+            return
+        tables = {}
+        with all_tables():
+            for entry in entries:
+                operation, name = entry[0], entry[1]
+                if operation == "replace":
+                    apply_entry(entry, tables)
+                    self._journal.mark(name, None)
+                    SCHEDULER.reload()
+                    continue
+                table = entry[2]
+                index = INDEXED.get((name, table))
+                if index is not None and operation == "put":
+                    row = indexes.apply_put(index, entry[3], entry[4])
+                    if table == "scheduled_jobs":
+                        SCHEDULER.adopt(row)
+                elif table == "channel_changes" and operation == "put":
+                    row = indexes.CHANGES.apply(entry[4])
+                elif index is not None and operation == "delete":
+                    row = indexes.apply_delete(index, entry[4])
+                elif (name, table) in INDEXED_VALUES and operation == "add":
+                    INDEXED_VALUES[(name, table)].add(entry[3], journal=False)
+                    row = None
+                elif (name, table) in INDEXED_VALUES and operation == "discard":
+                    INDEXED_VALUES[(name, table)].discard(entry[3], journal=False)
+                    row = None
+                else:
+                    row = apply_entry(entry, tables)
+                if operation in ("put", "delete") and row is None:
+                    continue
+                self._journal.mark(name, dirty_shard(table, row))
+
+
+WORKERS = WorkerSync(JOURNAL, f"{JOURNAL.path}.lock")
@@ -10,13 +10,12 @@ from database.helpers_auth import (
     search_email,
     get_hash,
     check_password,
-    generate_token,
-    is_token_valid,
     get_u_id,
     get_handle,
     generate_code,
     is_reset_code_valid
 )
+from database.indexes import generate_token, is_token_valid, remove_token, USERS
 from helpers.send_email import send_email
 
 def auth_login(email, password):
@@ -75,12 +74,7 @@ def auth_logout(token):
 
     ## Invalidate the token by removing it from the list of "active_tokens"
     ## in the database
-    auth_data = AUTH_DATABASE.get()
-    for valid_token in auth_data["active_tokens"]:
-        if valid_token["token"] == token:
-            auth_data["active_tokens"].remove(valid_token)
-            break
-    AUTH_DATABASE.update(auth_data)
+    remove_token(token)
 
     ## Check that the user has been successfully logged out
     if not is_token_valid(token):
@@ -122,32 +116,35 @@ def auth_register(email, password, name_first, name_last):
     if not 1 <= len(name_last) <= 50:
         raise InputError(description="name_last is not between 1 and 50 characters")
 
-    ## Determine if the user is the first user to sign up
-    auth_data = AUTH_DATABASE.get()
-    if auth_data["registered_users"] == []: ## no registered users
-        global_permission_id = 1 ## owner
-    else:
-        global_permission_id = 2 ## member
-
-    ## Generate a token for the user
-    u_id = get_u_id()
-    u_token = generate_token(u_id)
-
-    ## Register the user by adding their information to the list of
-    ## "registered_users" in the database
-    from port_settings import BASE_URL
-    auth_data["registered_users"].append({
-        "u_id": u_id,
-        "email": email,
-        "name_first": name_first,
-        "name_last": name_last,
-        "handle_str": get_handle(name_first, name_last),
-        "password_hash": get_hash(password),
-        "global_permission_id": global_permission_id,
-        "reset_code": None,
-        "profile_img_url": f"{BASE_URL}/imgurl/default.jpg"
-    })
-    AUTH_DATABASE.update(auth_data)
+    ## Hold the users table while the u_id and handle are chosen and the user
+    ## is added, so that concurrent registrations cannot be given the same ones
+    with USERS.lock:
+        ## Determine if the user is the first user to sign up
+        auth_data = AUTH_DATABASE.get()
+        if auth_data["registered_users"] == []: ## no registered users
+            global_permission_id = 1 ## owner
+        else:
+            global_permission_id = 2 ## member
+
+        ## Generate a token for the user
+        u_id = get_u_id()
+        u_token = generate_token(u_id)
+
+        ## Register the user by adding their information to the list of
+        ## "registered_users" in the database
+        from port_settings import BASE_URL
+        USERS.insert({
+            "u_id": u_id,
+            "email": email,
+            "name_first": name_first,
+            "name_last": name_last,
+            "handle_str": get_handle(name_first, name_last),
+            "password_hash": get_hash(password),
+            "global_permission_id": global_permission_id,
+            "reset_code": None,
+            "profile_img_url": f"{BASE_URL}/imgurl/default.jpg"
+        })
+        AUTH_DATABASE.update(auth_data)
 
     return {
         "u_id": u_id,
@@ -174,6 +171,7 @@ def auth_passwordreset_request(email):
         if user["email"] == email:
             reset_code = generate_code()
             user["reset_code"] = reset_code
+            USERS.save(user["u_id"])
             break
     AUTH_DATABASE.update(auth_data)
 
@@ -205,5 +203,6 @@ def auth_passwordreset_reset(reset_code, new_password):
         if user["reset_code"] == reset_code:
             user["password_hash"] = get_hash(new_password)
             user["reset_code"] = None
+            USERS.save(user["u_id"])
             break
     return {}
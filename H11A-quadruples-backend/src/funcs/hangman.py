@@ -8,7 +8,8 @@ from datetime import datetime, timezone
 from unicodedata import normalize
 from error import InputError
 from database.database import CHANNELS_DATABASE, MESSAGES_DATABASE
-from database.helpers_auth import find_u_id
+from database.indexes import find_u_id, add_message, CHANNELS, MESSAGES
+from database.locks import CHANNEL_LOCKS
 from database.helpers_channels import reset_hangman_data
 from database.helpers_messages import get_message_id
 from helpers.hangman_ascii import HANGMAN_LVLS
@@ -53,25 +54,30 @@ def hangman_send(token, channel_id, message):
     Returns:
         Dictionary containing the new message's message_id.
     """
-    ## Generate a message_id for the message
-    m_id = get_message_id()
-
-    ## Find the timestamp of the message
-    now = datetime.utcnow()
-    timestamp = int(now.replace(tzinfo=timezone.utc).timestamp())
-
-    ## Add the message to the database
-    messages_data = MESSAGES_DATABASE.get()
-    messages_data["messages"].append({
-        "channel_id": channel_id,
-        "message_id": m_id,
-        "u_id": find_u_id(token),
-        "message": message,
-        "time_created": timestamp,
-        "reacts": [], ## no reacts by default
-        "is_pinned": False ## not pinned by default
-    })
-    MESSAGES_DATABASE.update(messages_data)
+    ## Find the sender before taking the messages table's lock, since
+    ## the tokens table's lock must not be taken while holding it
+    u_id = find_u_id(token)
+
+    with MESSAGES.lock:
+        ## Generate a message_id for the message
+        m_id = get_message_id()
+
+        ## Find the timestamp of the message
+        now = datetime.utcnow()
+        timestamp = int(now.replace(tzinfo=timezone.utc).timestamp())
+
+        ## Add the message to the database
+        messages_data = MESSAGES_DATABASE.get()
+        add_message({
+            "channel_id": channel_id,
+            "message_id": m_id,
+            "u_id": u_id,
+            "message": message,
+            "time_created": timestamp,
+            "reacts": [], ## no reacts by default
+            "is_pinned": False ## not pinned by default
+        })
+        MESSAGES_DATABASE.update(messages_data)
     return {"message_id": m_id}
 
 
@@ -89,24 +95,25 @@ def hangman_start(token, channel_id):
     """
     rand_word = get_random_word()
 
-    ## Add the word to the channel in the channels database
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        if channel["channel_id"] == channel_id:
-            ## Check if a hangman game is already active
-            if channel["hangman_word"] is not None:
-                raise InputError(description="An active game is already running")
-            channel["hangman_word"] = rand_word
-            break
-    CHANNELS_DATABASE.update(channels_data)
-
-    ## Send the welcome message
-    unguessed_word = " ".join(["_" for letter in rand_word])
-    welcome_msg = (
-        "Welcome to Hangman!\n\n"
-        f"Word: {unguessed_word}"
-    )
-    hangman_send(token, channel_id, welcome_msg)
+    ## Hold the channel's lock so that only one game can be started
+    with CHANNEL_LOCKS(channel_id):
+        ## Add the word to the channel in the channels database
+        channels_data = CHANNELS_DATABASE.get()
+        channel = CHANNELS.get(channel_id)
+        ## Check if a hangman game is already active
+        if channel["hangman_word"] is not None:
+            raise InputError(description="An active game is already running")
+        channel["hangman_word"] = rand_word
+        CHANNELS.save(channel_id)
+        CHANNELS_DATABASE.update(channels_data)
+
+        ## Send the welcome message
+        unguessed_word = " ".join(["_" for letter in rand_word])
+        welcome_msg = (
+            "Welcome to Hangman!\n\n"
+            f"Word: {unguessed_word}"
+        )
+        hangman_send(token, channel_id, welcome_msg)
 
 
 def hangman_guess(token, channel_id, letter):
@@ -129,59 +136,62 @@ def hangman_guess(token, channel_id, letter):
     if len(letter) != 1 or not letter.isalpha():
         raise InputError(description="Enter a single letter to guess")
 
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        if channel["channel_id"] == channel_id:
-            ## Check if a Hangman game is indeed active
-            if channel["hangman_word"] is None:
-                raise InputError(description="A hangman game must be active to guess")
-
-            ## Check if letter is already guessed
-            if letter.upper() in channel["hangman_guessed"]:
-                raise InputError(description=f"'{letter}' has already been guessed.")
-
-            ## If not, add it to the list of guessed letters
-            channel["hangman_guessed"].append(letter.upper())
-
-            ## If guess is incorrect, increment the level
-            if letter.upper() not in channel["hangman_word"].upper():
-                channel["hangman_level"] += 1
-
-            ## Grab data so it can be used
-            word = channel["hangman_word"]
-            guessed = channel["hangman_guessed"]
-            level = channel["hangman_level"]
-            break
-    CHANNELS_DATABASE.update(channels_data)
-
-    ## Check for game won
-    if all([ch in guessed for ch in word.upper()]): ## all letters have been guessed
-        game_won_msg = (
-            f"{word.upper()}\n"
-            "Congratulations! You have won hangman."
-        )
-        hangman_send(token, channel_id, game_won_msg)
-        reset_hangman_data(channel_id)
-        return
-
-    ## Check for game lost
-    if level == 10: ## game over level
-        game_over_msg = (
-            f"{word.upper()}\n"
-            "You lost!\n\n"
-            f"{HANGMAN_LVLS['LVL10']}"
+    ## Hold the channel's lock so that each guess sees the ones before it
+    with CHANNEL_LOCKS(channel_id):
+        channels_data = CHANNELS_DATABASE.get()
+        channel = CHANNELS.get(channel_id)
+        ## Check if a Hangman game is indeed active
+        if channel["hangman_word"] is None:
+            raise InputError(description="A hangman game must be active to guess")
+
+        ## Check if letter is already guessed
+        if letter.upper() in channel["hangman_guessed"]:
+            raise InputError(description=f"'{letter}' has already been guessed.")
+
+        ## If not, add it to the list of guessed letters
+        channel["hangman_guessed"].append(letter.upper())
+
+        ## If guess is incorrect, increment the level
+        if letter.upper() not in channel["hangman_word"].upper():
+            channel["hangman_level"] += 1
+
+        ## Grab data so it can be used
+        word = channel["hangman_word"]
+        guessed = channel["hangman_guessed"]
+        level = channel["hangman_level"]
+        CHANNELS.save(channel_id)
+        CHANNELS_DATABASE.update(channels_data)
+
+        ## Check for game won
+        if all([ch in guessed for ch in word.upper()]): ## all letters have been guessed
+            game_won_msg = (
+                f"{word.upper()}\n"
+                "Congratulations! You have won hangman."
+            )
+            hangman_send(token, channel_id, game_won_msg)
+            reset_hangman_data(channel_id)
+            CHANNELS.save(channel_id)
+            return
+
+        ## Check for game lost
+        if level == 10: ## game over level
+            game_over_msg = (
+                f"{word.upper()}\n"
+                "You lost!\n\n"
+                f"{HANGMAN_LVLS['LVL10']}"
+            )
+            hangman_send(token, channel_id, game_over_msg)
+            reset_hangman_data(channel_id)
+            CHANNELS.save(channel_id)
+            return
+
+        ## Send the game update message if the game is not won or lost
+        unguessed_word = " ".join([ch if ch in guessed else "_" for ch in word.upper()])
+        level = f"LVL{level}"
+        wrong_guesses = " ".join([ch for ch in guessed if ch not in word.upper()])
+        game_msg = (
+            f"{unguessed_word}\n\n"
+            f"{HANGMAN_LVLS[level]}\n"
+            f"You have guessed: {wrong_guesses}"
         )
-        hangman_send(token, channel_id, game_over_msg)
-        reset_hangman_data(channel_id)
-        return
-
-    ## Send the game update message if the game is not won or lost
-    unguessed_word = " ".join([ch if ch in guessed else "_" for ch in word.upper()])
-    level = f"LVL{level}"
-    wrong_guesses = " ".join([ch for ch in guessed if ch not in word.upper()])
-    game_msg = (
-        f"{unguessed_word}\n\n"
-        f"{HANGMAN_LVLS[level]}\n"
-        f"You have guessed: {wrong_guesses}"
-    )
-    hangman_send(token, channel_id, game_msg)
+        hangman_send(token, channel_id, game_msg)
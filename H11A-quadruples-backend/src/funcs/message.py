@@ -4,25 +4,30 @@ H11A-quadruples, April 2020.
 """
 
 from datetime import datetime, timezone
-import threading
 from error import AccessError, InputError
 from database.database import MESSAGES_DATABASE
-from database.helpers_auth import is_token_valid, find_u_id
-from database.helpers_channels import (
+from database.journal import JOURNAL
+from database.scheduler import SCHEDULER
+from database.indexes import (
+    is_token_valid,
+    find_u_id,
     is_user_in_channel,
-    is_user_owner,
-    does_channel_exist
+    add_message,
+    remove_message,
+    edit_message,
+    save_message,
+    message_lock,
+    MESSAGES,
+    QUEUED,
+    QUEUED_IDS
 )
+from database.helpers_channels import is_user_owner, does_channel_exist
 from database.helpers_messages import (
     get_message_id,
-    do_sendlater,
-    does_message_exist,
     can_user_react,
     has_user_reacted,
     add_react,
-    remove_react,
-    is_pinned_already,
-    did_user_send_message
+    remove_react
 )
 from funcs.hangman import hangman_start, hangman_guess
 from constants import VALID_REACT_IDS
@@ -67,25 +72,32 @@ def message_send(token, channel_id, message):
         hangman_guess(token, channel_id, message.split()[1])
         return {}
 
-    ## Generate a message_id for the message
-    m_id = get_message_id()
-
-    ## Find the timestamp of the message
-    now = datetime.utcnow()
-    timestamp = int(now.replace(tzinfo=timezone.utc).timestamp())
-
-    ## Add the message to the database
-    messages_data = MESSAGES_DATABASE.get()
-    messages_data["messages"].append({
-        "channel_id": channel_id,
-        "message_id": m_id,
-        "u_id": find_u_id(token),
-        "message": message,
-        "time_created": timestamp,
-        "reacts": [], ## no reacts by default
-        "is_pinned": False ## not pinned by default
-    })
-    MESSAGES_DATABASE.update(messages_data)
+    ## Find the sender before taking the messages table's lock, since
+    ## the tokens table's lock must not be taken while holding it
+    u_id = find_u_id(token)
+
+    ## Hold the messages table while the id is reserved and the message is
+    ## added, so that concurrent sends cannot be given the same id
+    with MESSAGES.lock:
+        ## Generate a message_id for the message
+        m_id = get_message_id()
+
+        ## Find the timestamp of the message
+        now = datetime.utcnow()
+        timestamp = int(now.replace(tzinfo=timezone.utc).timestamp())
+
+        ## Add the message to the database
+        messages_data = MESSAGES_DATABASE.get()
+        add_message({
+            "channel_id": channel_id,
+            "message_id": m_id,
+            "u_id": u_id,
+            "message": message,
+            "time_created": timestamp,
+            "reacts": [], ## no reacts by default
+            "is_pinned": False ## not pinned by default
+        })
+        MESSAGES_DATABASE.update(messages_data)
     return {"message_id": m_id}
 
 
@@ -133,25 +145,85 @@ def message_sendlater(token, channel_id, message, time_sent):
     if interval < 0: ## time_sent is a time in the past
         raise InputError(description="Time sent is a time in the past")
 
-    ## Get the message's id
-    m_id = get_message_id()
+    ## Find the sender before taking the messages table's lock
+    u_id = find_u_id(token)
+
+    with MESSAGES.lock:
+        ## Get the message's id
+        m_id = get_message_id()
 
-    ## Add it to the queued_message_ids in the database
-    messages_data = MESSAGES_DATABASE.get()
-    messages_data["queued_message_ids"].append(m_id)
-    MESSAGES_DATABASE.update(messages_data)
+        ## Add it to the queued_message_ids in the database, and keep the
+        ## whole message in queued_messages so that it survives a restart
+        QUEUED_IDS.add(m_id)
+        QUEUED.insert({
+            "message_id": m_id,
+            "channel_id": channel_id,
+            "u_id": u_id,
+            "message": message,
+            "time_sent": time_sent
+        })
 
-    ## Start the timer
-    timer = threading.Timer(
-        interval, do_sendlater,
-        args=[find_u_id(token), channel_id, message, m_id]
-    )
-    timer.start()
+    ## Schedule the delivery
+    SCHEDULER.schedule(time_sent, deliver_sendlater, m_id)
 
     ## Return the message_id
     return {"message_id": m_id}
 
 
+def deliver_sendlater(message_id):
+    """
+    Send a queued message and add it to its channel's timeline.
+
+    Args:
+        message_id (int): id of the message in queued_messages.
+    """
+    deliver_sendlater_batch([[message_id]])
+
+
+def deliver_sendlater_batch(jobs):
+    """
+    Send several queued messages at once, eg. a backlog that fell due while
+    the server was down. The messages are added while holding the messages
+    table's lock once, and each is removed from the queue by its id.
+
+    Args:
+        jobs (list): Argument lists of deliver_sendlater() jobs, in the
+            order they fell due.
+    """
+    with MESSAGES.lock:
+        for message_id, in jobs:
+            ## A delivery may be run again after a restart if the server
+            ## stopped before it was marked as done, or after it failed part
+            ## way, so only take a message off the queue once it is sent
+            queued_message = QUEUED.get(message_id)
+            if queued_message is not None and MESSAGES.get(message_id) is None:
+                add_message({
+                    "channel_id": queued_message["channel_id"],
+                    "message_id": message_id,
+                    "u_id": queued_message["u_id"],
+                    "message": queued_message["message"],
+                    "time_created": queued_message["time_sent"],
+                    "reacts": [], ## no reacts by default
+                    "is_pinned": False ## not pinned by default
+                })
+            QUEUED.remove(message_id)
+            QUEUED_IDS.discard(message_id)
+
+def requeue_sendlater():
+    """
+    Schedule the delivery of every queued message that has no pending job,
+    eg. after the databases are loaded from a save made before their jobs
+    were saved with them, or one that lost a job's row.
+    """
+    scheduled = {message_id for message_id, in SCHEDULER.jobs(deliver_sendlater)}
+    with MESSAGES.lock:
+        missing = [QUEUED.get(m_id) for m_id in QUEUED.keys() if m_id not in scheduled]
+    for queued_message in missing:
+        SCHEDULER.schedule(queued_message["time_sent"], deliver_sendlater, queued_message["message_id"])
+
+SCHEDULER.register(deliver_sendlater, batch=deliver_sendlater_batch)
+
+
 def message_react(token, message_id, react_id):
     """
     Add a react to a message in a user's channel.
@@ -176,22 +248,23 @@ def message_react(token, message_id, react_id):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    ## Check for InputErrors
-    if react_id not in VALID_REACT_IDS:
-        raise InputError(description="react_id is not a valid id")
-    if not can_user_react(token, message_id):
-        raise InputError(description="Can only react to a message in your channels")
-    if has_user_reacted(token, message_id, react_id):
-        raise InputError(description="You already reacted to this message with this react")
-
-    ## Add the react information to the database
-    messages_data = MESSAGES_DATABASE.get()
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            message["reacts"] = add_react(token, react_id, message["reacts"])
-            break
-    MESSAGES_DATABASE.update(messages_data)
-    return {}
+    ## Check and change the message while holding its channel's lock
+    with message_lock(message_id):
+        ## Check for InputErrors
+        if react_id not in VALID_REACT_IDS:
+            raise InputError(description="react_id is not a valid id")
+        if not can_user_react(token, message_id):
+            raise InputError(description="Can only react to a message in your channels")
+        if has_user_reacted(token, message_id, react_id):
+            raise InputError(description="You already reacted to this message with this react")
+
+        ## Add the react information to the database
+        messages_data = MESSAGES_DATABASE.get()
+        message = MESSAGES.get(message_id)
+        message["reacts"] = add_react(token, react_id, message["reacts"])
+        save_message(message_id)
+        MESSAGES_DATABASE.update(messages_data)
+        return {}
 
 
 def message_unreact(token, message_id, react_id):
@@ -214,22 +287,23 @@ def message_unreact(token, message_id, react_id):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    ## Check for InputErrors
-    if react_id not in VALID_REACT_IDS:
-        raise InputError(description="react_id is not a valid id")
-    if not has_user_reacted(token, message_id, react_id):
-        raise InputError(description="Can only unreact if you have reacted")
-    if not can_user_react(token, message_id):
-        raise InputError(description="Can only unreact to a message in your channels")
-
-    ## Remove react information from the database
-    messages_data = MESSAGES_DATABASE.get()
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            message["reacts"] = remove_react(token, react_id, message["reacts"])
-            break
-    MESSAGES_DATABASE.update(messages_data)
-    return {}
+    ## Check and change the message while holding its channel's lock
+    with message_lock(message_id):
+        ## Check for InputErrors
+        if react_id not in VALID_REACT_IDS:
+            raise InputError(description="react_id is not a valid id")
+        if not has_user_reacted(token, message_id, react_id):
+            raise InputError(description="Can only unreact if you have reacted")
+        if not can_user_react(token, message_id):
+            raise InputError(description="Can only unreact to a message in your channels")
+
+        ## Remove react information from the database
+        messages_data = MESSAGES_DATABASE.get()
+        message = MESSAGES.get(message_id)
+        message["reacts"] = remove_react(token, react_id, message["reacts"])
+        save_message(message_id)
+        MESSAGES_DATABASE.update(messages_data)
+        return {}
 
 
 def message_pin(token, message_id):
@@ -252,34 +326,32 @@ def message_pin(token, message_id):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    ## Check for InputErrors
-    if not does_message_exist(message_id):
-        raise InputError(description="Message does not exist -- cannot pin")
-
-    ## Message exists, so find its channel_id
-    messages_data = MESSAGES_DATABASE.get()
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            channel_id = message["channel_id"]
-            break
-
-    ## Check for AccessErrors (..continued)
-    if not is_user_in_channel(token, channel_id):
-        raise AccessError(description="Can only pin messages in a channel you are in")
-    if not is_user_owner(token, channel_id):
-        raise AccessError(description="Only owners can pin messages")
-
-    ## Check for InputErrors (..continued)
-    if is_pinned_already(message_id):
-        raise InputError(description="Message is already pinned")
-
-    ## Mark the message as pinned
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            message["is_pinned"] = True
-            break
-    MESSAGES_DATABASE.update(messages_data)
-    return {}
+    ## Check and change the message while holding its channel's lock
+    with message_lock(message_id):
+        ## Check for InputErrors
+        message = MESSAGES.get(message_id)
+        if message is None:
+            raise InputError(description="Message does not exist -- cannot pin")
+
+        ## Message exists, so find its channel_id
+        channel_id = message["channel_id"]
+
+        ## Check for AccessErrors (..continued)
+        if not is_user_in_channel(token, channel_id):
+            raise AccessError(description="Can only pin messages in a channel you are in")
+        if not is_user_owner(token, channel_id):
+            raise AccessError(description="Only owners can pin messages")
+
+        ## Check for InputErrors (..continued)
+        if message["is_pinned"]:
+            raise InputError(description="Message is already pinned")
+
+        ## Mark the message as pinned
+        messages_data = MESSAGES_DATABASE.get()
+        message["is_pinned"] = True
+        save_message(message_id)
+        MESSAGES_DATABASE.update(messages_data)
+        return {}
 
 
 def message_unpin(token, message_id):
@@ -302,34 +374,32 @@ def message_unpin(token, message_id):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    ## Check for InputErrors
-    if not does_message_exist(message_id):
-        raise InputError(description="message_id is not a valid message")
-
-    ## Message exists, so find its channel_id
-    messages_data = MESSAGES_DATABASE.get()
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            channel_id = message["channel_id"]
-            break
-
-    ## Check for AccessErrors (..continued)
-    if not is_user_in_channel(token, channel_id):
-        raise AccessError(description="Can only unpin messages in your channels")
-    if not is_user_owner(token, channel_id):
-        raise AccessError(description="Only owners can unpin messages")
-
-    ## Check for InputErrors (..continued)
-    if not is_pinned_already(message_id):
-        raise InputError(description="Message is already unpinned")
-
-    ## Mark the message as unpinned
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            message["is_pinned"] = False
-            break
-    MESSAGES_DATABASE.update(messages_data)
-    return {}
+    ## Check and change the message while holding its channel's lock
+    with message_lock(message_id):
+        ## Check for InputErrors
+        message = MESSAGES.get(message_id)
+        if message is None:
+            raise InputError(description="message_id is not a valid message")
+
+        ## Message exists, so find its channel_id
+        channel_id = message["channel_id"]
+
+        ## Check for AccessErrors (..continued)
+        if not is_user_in_channel(token, channel_id):
+            raise AccessError(description="Can only unpin messages in your channels")
+        if not is_user_owner(token, channel_id):
+            raise AccessError(description="Only owners can unpin messages")
+
+        ## Check for InputErrors (..continued)
+        if not message["is_pinned"]:
+            raise InputError(description="Message is already unpinned")
+
+        ## Mark the message as unpinned
+        messages_data = MESSAGES_DATABASE.get()
+        message["is_pinned"] = False
+        save_message(message_id)
+        MESSAGES_DATABASE.update(messages_data)
+        return {}
 
 
 def message_remove(token, message_id):
@@ -350,33 +420,35 @@ def message_remove(token, message_id):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    ## Check for InputErrors
-    if not does_message_exist(message_id):
-        raise InputError(description="Message no longer exists")
-
-    ## Remove the message from the database
-    messages_data = MESSAGES_DATABASE.get()
-    for message in messages_data["messages"]:
-        if message["message_id"] == message_id:
-            ## Check for AccessErrors (..continued)
-            is_owner = is_user_owner(token, message["channel_id"])
-            did_send_message = did_user_send_message(token, message_id)
-            if not is_owner and not did_send_message:
-                raise AccessError(description="Non-owners cannot delete other people's messages")
-
-            ## Add message to removed_messages
-            messages_data["removed_messages"].append({
-                "channel_id": message["channel_id"],
-                "message_id": message_id,
-                "u_id": message["u_id"],
-                "message": message["message"],
-                "time_created": message["time_created"]
-            })
-            ## Remove the message
-            messages_data["messages"].remove(message)
-            break
-    MESSAGES_DATABASE.update(messages_data)
-    return {}
+    ## Check and change the message while holding its channel's lock
+    with message_lock(message_id):
+        ## Check for InputErrors
+        message = MESSAGES.get(message_id)
+        if message is None:
+            raise InputError(description="Message no longer exists")
+
+        ## Check for AccessErrors (..continued)
+        is_owner = is_user_owner(token, message["channel_id"])
+        did_send_message = message["u_id"] == find_u_id(token)
+        if not is_owner and not did_send_message:
+            raise AccessError(description="Non-owners cannot delete other people's messages")
+
+        ## Remove the message from the database
+        messages_data = MESSAGES_DATABASE.get()
+        ## Add message to removed_messages
+        removed_message = {
+            "channel_id": message["channel_id"],
+            "message_id": message_id,
+            "u_id": message["u_id"],
+            "message": message["message"],
+            "time_created": message["time_created"]
+        }
+        messages_data["removed_messages"].append(removed_message)
+        JOURNAL.put(MESSAGES_DATABASE, "removed_messages", "message_id", removed_message)
+        ## Remove the message
+        remove_message(message_id)
+        MESSAGES_DATABASE.update(messages_data)
+        return {}
 
 
 def message_edit(token, message_id, message):
@@ -397,23 +469,24 @@ def message_edit(token, message_id, message):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    ## Remove the message if it is an empty string
-    if message == "":
-        message_remove(token, message_id)
-        return {}
-
-    ## Edit the message in the database
-    messages_data = MESSAGES_DATABASE.get()
-    for message_dict in messages_data["messages"]:
-        if message_dict["message_id"] == message_id:
+    ## Check and change the message while holding its channel's lock
+    with message_lock(message_id):
+        ## Remove the message if it is an empty string
+        if message == "":
+            message_remove(token, message_id)
+            return {}
+
+        ## Edit the message in the database
+        messages_data = MESSAGES_DATABASE.get()
+        message_dict = MESSAGES.get(message_id)
+        if message_dict is not None:
             ## Check for AccessErrors (..continued)
             is_owner = is_user_owner(token, message_dict["channel_id"])
-            did_send_message = did_user_send_message(token, message_id)
+            did_send_message = message_dict["u_id"] == find_u_id(token)
             if not is_owner and not did_send_message:
                 raise AccessError(description="Non-owners cannot edit other people's messages")
 
             ## Edit the message
-            message_dict["message"] = message
-            break
-    MESSAGES_DATABASE.update(messages_data)
-    return {}
+            edit_message(message_id, message)
+        MESSAGES_DATABASE.update(messages_data)
+        return {}
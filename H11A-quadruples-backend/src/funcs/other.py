@@ -3,7 +3,11 @@ Implementations of the other functions.
 H11A-quadruples, April 2020.
 """
 
-import threading
+import hashlib
+import heapq
+import math
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timezone
 from error import AccessError, InputError
 from database.database import (
@@ -11,16 +15,33 @@ from database.database import (
     CHANNELS_DATABASE,
     MESSAGES_DATABASE
 )
+from database.journal import JOURNAL
+from database.locks import CHANNEL_LOCKS, all_locks
+from database.scheduler import SCHEDULER
 from database.helpers_auth import (
     reset_auth_data,
-    is_token_valid,
-    find_u_id,
     is_user_slackr_owner,
     does_user_exist
 )
+from database.indexes import (
+    is_token_valid,
+    find_u_id,
+    is_user_in_channel,
+    remove_user_tokens,
+    add_message,
+    save_message,
+    USERS,
+    CHANNELS,
+    MESSAGES,
+    TIMELINES,
+    SEARCH,
+    CHANGES,
+    MEMBERS,
+    channel_page,
+    split_seq
+)
 from database.helpers_channels import (
     reset_channels_data,
-    is_user_in_channel,
     does_channel_exist,
     is_standup_active
 )
@@ -28,8 +49,29 @@ from database.helpers_messages import (
     reset_messages_data,
     get_message_id
 )
+from funcs.user_profile_uploadphoto import cancel_uploads
+from responses import Encoded, encode_json
 from constants import VALID_PERMISSION_IDS, DELETED_USER_ID
 
+## The users_all() list and its encoding, and the version of the
+## registered_users table they were built from
+DIRECTORY = {}
+
+## Search candidates are read from the timelines this many at a time, each
+## chunk under the messages table's lock; a query narrowed to no more
+## candidates than this sorts them instead
+SEARCH_CHUNK = 256
+
+## Most messages returned by one channel_messages() call
+PAGE_LENGTH = 50
+
+## Seconds between heartbeats on an idle channel event stream, which keep
+## proxies from closing it and find clients that have gone away
+EVENT_HEARTBEAT = 15
+
+## Longest that standup_wait() keeps a request waiting, in seconds
+STANDUP_MAX_WAIT = 60
+
 def users_all(token):
     """
     Returns a list of all users and their details.
@@ -45,63 +87,343 @@ def users_all(token):
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    users_all_list = {"users": []}
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        users_all_list["users"].append({
-            "u_id": user["u_id"],
-            "email": user["email"],
-            "name_first": user["name_first"],
-            "name_last": user["name_last"],
-            "handle_str": user["handle_str"],
-            "profile_img_url": user["profile_img_url"]
-        })
-    return users_all_list
+    users, _, _ = user_directory()
+    return {"users": [dict(user) for user in users]}
+
+def users_all_encoded(token):
+    """
+    users_all() already encoded as JSON, for the /users/all route. The users
+    are only copied and encoded again after one of them has changed.
+
+    Args:
+        token (str): Token of the user making the request.
+    Raises:
+        AccessError: if token is invalid.
+    Returns:
+        A tuple of the Encoded response body and a strong ETag (str) for it.
+    """
+    ## Check for AccessErrors
+    if not is_token_valid(token):
+        raise AccessError(description="Token is not a valid token")
 
+    _, body, etag = user_directory()
+    return body, etag
 
-def search(token, query_str):
+def user_directory():
+    """
+    Returns:
+        A tuple of the list of user dictionaries returned by users_all(),
+        the list encoded as JSON and an ETag for the encoded list, rebuilt
+        if a user has been added, changed or removed since the last call.
+    """
+    with USERS.lock:
+        version = USERS.version
+        if DIRECTORY.get("version") != version:
+            users = [{
+                "u_id": user["u_id"],
+                "email": user["email"],
+                "name_first": user["name_first"],
+                "name_last": user["name_last"],
+                "handle_str": user["handle_str"],
+                "profile_img_url": user["profile_img_url"]
+            } for user in AUTH_DATABASE.get()["registered_users"]]
+            body = Encoded(encode_json({"users": users}))
+            ## The ETag depends only on the contents, as other server
+            ## processes count their versions separately
+            DIRECTORY.update(
+                version=version,
+                users=users,
+                body=body,
+                etag=hashlib.sha256(body).hexdigest()[:32]
+            )
+        return DIRECTORY["users"], DIRECTORY["body"], DIRECTORY["etag"]
+
+
+def search(token, query_str, limit=None, cursor=None):
     """
     Return a collection of messages in all of a user's channels that contain
     a given query_str. Messages are sorted from most recent to least recent.
+    If limit is given, at most limit messages are returned along with a
+    next_cursor that can be passed back in to get the following page.
 
     Args:
         token (str): Token of the user making the search.
         query_str (str): Query to search for.
+        limit (int): Maximum number of messages to return, or None for all.
+        cursor (str): next_cursor from the previous page, or None for the first page.
     Raises:
         AccessError: if token is invalid.
+        InputError: if limit is less than 1.
+        InputError: if cursor is not a valid cursor.
     Returns:
-        Dictionary containing a list of messages from the search result.
+        Dictionary containing a list of messages from the search result, and
+        the cursor of the next page (None on the last page) if limit is given.
+    """
+    ## Check for InputErrors
+    if limit is not None and limit < 1:
+        raise InputError(description="limit must be at least 1")
+
+    matches = search_matches(token, query_str, cursor)
+    search_result = {"messages": []}
+    next_cursor = None
+    for match_cursor, message in matches:
+        if limit is not None and len(search_result["messages"]) == limit:
+            next_cursor = last_cursor
+            break
+        search_result["messages"].append(message)
+        last_cursor = match_cursor
+
+    if limit is not None:
+        search_result["next_cursor"] = next_cursor
+    return search_result
+
+
+def message_key(m_id):
+    """
+    Args:
+        m_id (int): id of a message in the messages table.
+    Returns:
+        The (time_created, message_id) tuple that search results are
+        sorted by.
+    """
+    return MESSAGES.get(m_id)["time_created"], m_id
+
+
+def search_matches(token, query_str, cursor=None):
+    """
+    Lazily find the messages in a user's channels that contain query_str,
+    from most recent to least recent, so that results can be sent as soon
+    as they are found.
+
+    Args:
+        token (str): Token of the user making the search.
+        query_str (str): Query to search for.
+        cursor (str): Only find messages older than the one this cursor was given with.
+    Raises:
+        AccessError: if token is invalid.
+        InputError: if cursor is not a valid cursor.
+    Returns:
+        A generator of (cursor, message) tuples, where message is a message
+        dictionary from the search result.
     """
     ## Check for AccessErrors
     if not is_token_valid(token):
         raise AccessError(description="Token is not a valid token")
 
-    search_result = {"messages": []}
-    messages_data = MESSAGES_DATABASE.get()
-    for message_dict in messages_data["messages"]:
-        if query_str.lower() in message_dict["message"].lower(): ## not case sensitive
-            if is_user_in_channel(token, message_dict["channel_id"]):
-                ## Find is_this_user_reacted
-                new_reacts = message_dict["reacts"]
-                user_id = find_u_id(token)
-                for react in new_reacts:
-                    if user_id in react["u_ids"]:
-                        react["is_this_user_reacted"] = True
-                    else:
-                        react["is_this_user_reacted"] = False
-
-                ## PREPEND the message dictionary so that it is sorted
-                ## from most recent to least recent message.
-                search_result["messages"].insert(0, {
-                    "message_id": message_dict["message_id"],
-                    "u_id": message_dict["u_id"],
-                    "message": message_dict["message"],
-                    "time_created": message_dict["time_created"],
-                    "reacts": new_reacts,
-                    "is_pinned": message_dict["is_pinned"]
-                })
-    return search_result
+    ## Check for InputErrors
+    before = None
+    if cursor is not None:
+        try:
+            time_created, m_id = urlsafe_b64decode(cursor.encode()).decode().split(":")
+            before = (int(time_created), int(m_id))
+        except ValueError:
+            raise InputError(description="cursor is not a valid cursor")
+
+    ## Find the channels the user is in
+    user_id = find_u_id(token)
+    channel_ids = MEMBERS.channel_ids(user_id)
+
+    ## Narrow the search to messages containing every trigram of the query,
+    ## or to every message in the user's channels if the query is too short.
+    ## Either way, candidates are visited from most recent to least recent
+    ## by (time_created, message_id), which cursors hold since it does not
+    ## change when the indexes are rebuilt.
+    query = query_str.lower() ## not case sensitive
+    candidates = SEARCH.candidates(query)
+    if candidates is not None and len(candidates) <= SEARCH_CHUNK:
+        with MESSAGES.lock:
+            keyed = [
+                (message_key(m_id), m_id) for m_id in candidates
+                if MESSAGES.get(m_id) is not None
+            ]
+        keyed.sort(reverse=True)
+        if before is not None:
+            keyed = [(key, m_id) for key, m_id in keyed if key < before]
+    else:
+        ## Merge the user's channels' timelines as they are walked, so the
+        ## first matches are sent without visiting every candidate first
+        keyed = heapq.merge(*(
+            TIMELINES.newest(channel_id, message_key, before, SEARCH_CHUNK)
+            for channel_id in channel_ids
+        ), reverse=True)
+        if candidates is not None:
+            keyed = ((key, m_id) for key, m_id in keyed if m_id in candidates)
+
+    def matches():
+        for key, m_id in keyed:
+            ## The message may have been removed since the search started
+            message_dict = MESSAGES.get(m_id)
+            if message_dict is None or message_dict["channel_id"] not in channel_ids:
+                continue
+            if query not in message_dict["message"].lower():
+                continue
+
+            key_cursor = urlsafe_b64encode(f"{key[0]}:{key[1]}".encode()).decode()
+            yield key_cursor, message_view(message_dict, user_id)
+    return matches()
+
+
+def message_view(message_dict, user_id):
+    """
+    Args:
+        message_dict (dict): A row of the messages table.
+        user_id (int): u_id of the user the message is being shown to.
+    Returns:
+        A dictionary of the message as the user sees it.
+    """
+    return {
+        "message_id": message_dict["message_id"],
+        "u_id": message_dict["u_id"],
+        "message": message_dict["message"],
+        "time_created": message_dict["time_created"],
+        "reacts": [
+            dict(react, is_this_user_reacted=user_id in react["u_ids"])
+            for react in message_dict["reacts"]
+        ],
+        "is_pinned": message_dict["is_pinned"]
+    }
+
+def channel_messages(token, channel_id, start):
+    """
+    Given a channel the user is a member of, return up to PAGE_LENGTH of
+    its messages, skipping the start most recent. The page is a slice of
+    the channel's timeline, so its cost does not depend on how many
+    messages other channels have.
 
+    Args:
+        token (str): Token of the user making the request.
+        channel_id (int): id of the channel.
+        start (int): Number of most recent messages to skip.
+    Raises:
+        AccessError: if token is invalid.
+        InputError: if channel_id is not a valid channel.
+        AccessError: if the user is not a member of the channel.
+        InputError: if start is negative or greater than the number of
+            messages in the channel.
+    Returns:
+        A dictionary containing the messages (from most to least recent),
+        start, and end, which is start + PAGE_LENGTH, or -1 if the page
+        holds the channel's least recent message.
+    """
+    ## Check for AccessErrors
+    if not is_token_valid(token):
+        raise AccessError(description="Token is not a valid token")
+
+    ## Check for InputErrors
+    if not does_channel_exist(channel_id):
+        raise InputError(description="Channel does not exist")
+
+    ## Check for AccessErrors (..continued)
+    if not is_user_in_channel(token, channel_id):
+        raise AccessError(description="Only members can see the channel's messages")
+
+    user_id = find_u_id(token)
+    with MESSAGES.lock:
+        total = TIMELINES.count(channel_id)
+        if not 0 <= start <= total:
+            raise InputError(description="Start is greater than the number of messages")
+        page = channel_page(channel_id, start, PAGE_LENGTH)
+        messages = [message_view(message_dict, user_id) for message_dict in page]
+    end = start + PAGE_LENGTH if start + len(page) < total else -1
+    return {"messages": messages, "start": start, "end": end}
+
+def channel_changes(token, channel_id, since):
+    """
+    Find what has changed in a channel since a client last looked, so that
+    it can keep its copy of the channel's messages up to date without
+    fetching them again. Every message that is sent, edited, reacted to,
+    pinned or removed takes the channel's next change number.
+
+    Args:
+        token (str): Token of the user making the request.
+        channel_id (int): id of the channel.
+        since (str): seq returned by the client's last call, or "0".
+    Raises:
+        AccessError: if token is invalid.
+        InputError: if channel_id is not a valid channel.
+        InputError: if since is not a seq returned by this function.
+        AccessError: if the user is not a member of the channel.
+    Returns:
+        A dictionary containing the channel's latest change number (seq,
+        a string of the form "<epoch>:<number>"),
+        the messages changed since since (from least to most recently
+        changed), the message_ids of those removed since since, and reset.
+        If reset is True, the changes since since are not known (eg. the
+        server has restarted) and the client should fetch the channel's
+        messages again.
+    """
+    ## Check for AccessErrors
+    if not is_token_valid(token):
+        raise AccessError(description="Token is not a valid token")
+
+    ## Check for InputErrors
+    if not does_channel_exist(channel_id):
+        raise InputError(description="Channel does not exist")
+    try:
+        split_seq(since)
+    except ValueError:
+        raise InputError(description="since is not a valid seq")
+
+    ## Check for AccessErrors (..continued)
+    if not is_user_in_channel(token, channel_id):
+        raise AccessError(description="Only members can see the channel's changes")
+
+    user_id = find_u_id(token)
+    changes = {"seq": "0", "messages": [], "removed": [], "reset": False}
+    with MESSAGES.lock:
+        changes["seq"], changed = CHANGES.since(channel_id, since)
+        if changed is None:
+            changes["reset"] = True
+            return changes
+        for m_id, removed in changed:
+            message_dict = MESSAGES.get(m_id)
+            if removed or message_dict is None:
+                changes["removed"].append(m_id)
+                continue
+            changes["messages"].append(message_view(message_dict, user_id))
+    return changes
+
+def channel_events(token, channel_id, since=None):
+    """
+    Follow a channel's changes as they happen. Each event is a
+    channel_changes() result covering every change since the last event, so
+    a client that reads slowly is sent fewer, larger events rather than a
+    backlog of every change.
+
+    Args:
+        token (str): Token of the user following the channel.
+        channel_id (int): id of the channel.
+        since (str): seq of the last change the client has seen, or None
+            to only follow changes from now on.
+    Raises:
+        AccessError: if token is invalid.
+        InputError: if channel_id is not a valid channel.
+        InputError: if since is not a valid seq.
+        AccessError: if the user is not a member of the channel.
+    Returns:
+        A generator of (event, changes) tuples, where event is "changes",
+        "reset" (see channel_changes()) or "heartbeat" (changes is None).
+        It ends once the token is no longer valid or the user is no longer
+        a member of the channel.
+    """
+    ## Check for errors before anything is sent
+    if since is None:
+        since = CHANGES.latest(channel_id)
+    changes = channel_changes(token, channel_id, since)
+
+    def events(changes):
+        while True:
+            if changes["reset"]:
+                yield "reset", changes
+            elif changes["messages"] or changes["removed"]:
+                yield "changes", changes
+            if not CHANGES.wait(channel_id, changes["seq"], EVENT_HEARTBEAT):
+                yield "heartbeat", None
+            try:
+                changes = channel_changes(token, channel_id, changes["seq"])
+            except (AccessError, InputError):
+                return
+    return events(changes)
 
 def standup_start(token, channel_id, length):
     """
@@ -128,27 +450,28 @@ def standup_start(token, channel_id, length):
     ## Check for InputErrors
     if not does_channel_exist(channel_id):
         raise InputError(description="Channel does not exist")
-    if is_standup_active(channel_id):
-        raise InputError(description="An active standup is currently running in this channel")
-
-    ## Calculate time_finish
-    now = datetime.utcnow()
-    time_now = int(now.replace(tzinfo=timezone.utc).timestamp())
-    time_finish = time_now + length
-
-    ## Change channel info to say that a standup is active
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        if channel["channel_id"] == channel_id:
-            channel["is_standup_active"] = True
-            channel["standup_time_finish"] = time_finish
-            break
-    CHANNELS_DATABASE.update(channels_data)
 
-    ## Start a thread to automatically clear standup_queue
+    ## Hold the channel's lock so that only one standup can be started
+    with CHANNEL_LOCKS(channel_id):
+        if is_standup_active(channel_id):
+            raise InputError(description="An active standup is currently running in this channel")
+
+        ## Calculate time_finish
+        now = datetime.utcnow()
+        time_now = int(now.replace(tzinfo=timezone.utc).timestamp())
+        time_finish = time_now + length
+
+        ## Change channel info to say that a standup is active
+        channels_data = CHANNELS_DATABASE.get()
+        channel = CHANNELS.get(channel_id)
+        channel["is_standup_active"] = True
+        channel["standup_time_finish"] = time_finish
+        CHANNELS.save(channel_id)
+        CHANNELS_DATABASE.update(channels_data)
+
+    ## Schedule the end of the standup to clear standup_queue
     ## and update is_standup_active and standup_time_finish
-    timer = threading.Timer(length, end_standup, args=[find_u_id(token), channel_id])
-    timer.start()
+    SCHEDULER.schedule(time_finish, end_standup, find_u_id(token), channel_id)
 
     ## Return time_finish
     return {"time_finish": time_finish}
@@ -162,44 +485,56 @@ def end_standup(u_id, channel_id):
         u_id (int): id of the user who initiated the standup.
         channel_id (int): id of the channel that the standup took place in.
     """
-    ## Get list of messages that were sent
-    stdup_msgs = []
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        if channel["channel_id"] == channel_id:
-            stdup_msgs = channel["standup_queue"]
+    with CHANNEL_LOCKS(channel_id):
+        ## The end may be run again after a restart if the server stopped
+        ## before it was marked as done, or the channel may have been reset
+        channels_data = CHANNELS_DATABASE.get()
+        channel = CHANNELS.get(channel_id)
+        if channel is None or not channel["is_standup_active"]:
+            return
+
+        ## Create the message from the list of messages that were sent
+        group_message = ""
+        for message_tuple in channel["standup_queue"]:
+            name, message = message_tuple ## deconstruct
+            group_message += f"{name}: {message}\n"
+
+        ## Reserve the id and add the message while holding the messages
+        ## table. The channel records the id before the message is added, so
+        ## anyone woken by the message (see standup_wait()) can find it.
+        with CHANNELS.lock, MESSAGES.lock:
+            ## Generate a message_id for the group message
+            m_id = get_message_id()
+
             ## Update channel info
+            channel["last_standup"] = {
+                "time_finish": channel["standup_time_finish"],
+                "message_id": m_id
+            }
             channel["is_standup_active"] = False
             channel["standup_time_finish"] = None
             channel["standup_queue"] = []
-            break
-    CHANNELS_DATABASE.update(channels_data)
-
-    ## Create the message
-    group_message = ""
-    for message_tuple in stdup_msgs:
-        name, message = message_tuple ## deconstruct
-        group_message += f"{name}: {message}\n"
-
-    ## Generate a message_id for the group message
-    m_id = get_message_id()
-
-    ## Find the timestamp of the group message
-    now = datetime.utcnow()
-    timestamp = int(now.replace(tzinfo=timezone.utc).timestamp())
-
-    ## Add the group message to the database
-    messages_data = MESSAGES_DATABASE.get()
-    messages_data["messages"].append({
-        "channel_id": channel_id,
-        "message_id": m_id,
-        "u_id": u_id,
-        "message": group_message,
-        "time_created": timestamp,
-        "reacts": [],
-        "is_pinned": False
-    })
-    MESSAGES_DATABASE.update(messages_data)
+            CHANNELS.save(channel_id)
+            CHANNELS_DATABASE.update(channels_data)
+
+            ## Find the timestamp of the group message
+            now = datetime.utcnow()
+            timestamp = int(now.replace(tzinfo=timezone.utc).timestamp())
+
+            ## Add the group message to the database
+            messages_data = MESSAGES_DATABASE.get()
+            add_message({
+                "channel_id": channel_id,
+                "message_id": m_id,
+                "u_id": u_id,
+                "message": group_message,
+                "time_created": timestamp,
+                "reacts": [],
+                "is_pinned": False
+            })
+            MESSAGES_DATABASE.update(messages_data)
+
+SCHEDULER.register(end_standup)
 
 
 def standup_active(token, channel_id):
@@ -225,15 +560,71 @@ def standup_active(token, channel_id):
         raise InputError(description="Channel does not exist")
 
     ## Determine if a standup is active
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        if channel["channel_id"] == channel_id:
-            is_active = channel["is_standup_active"]
-            time_finish = channel["standup_time_finish"]
-            break
+    channel = CHANNELS.get(channel_id)
+    return {
+        "is_active": channel["is_standup_active"],
+        "time_finish": channel["standup_time_finish"]
+    }
+
 
-    return {"is_active": is_active, "time_finish": time_finish}
+def standup_wait(token, channel_id, timeout):
+    """
+    Wait for the standup in a given channel to finish, rather than asking
+    standup_active() again and again. Returns as soon as the standup ends
+    (or straight away if none is active), or once timeout seconds pass.
 
+    Args:
+        token (str): Token of the user making the request.
+        channel_id (int): id of the channel being checked.
+        timeout (float): Maximum number of seconds to wait, up to
+            STANDUP_MAX_WAIT.
+    Raises:
+        AccessError: if token is invalid.
+        InputError: if channel_id is not a valid channel.
+        InputError: if timeout is negative or not a finite number.
+    Returns:
+        A dictionary containing whether a standup is still active and the
+        time it finishes, or if not, the time the last standup finished and
+        the message_id of its summary message (both None if the channel has
+        never had a standup).
+    """
+    ## Check for AccessErrors
+    if not is_token_valid(token):
+        raise AccessError(description="Token is not a valid token")
+
+    ## Check for InputErrors
+    if not does_channel_exist(channel_id):
+        raise InputError(description="Channel does not exist")
+    if not math.isfinite(timeout):
+        raise InputError(description="timeout must be a finite number")
+    if timeout < 0:
+        raise InputError(description="timeout cannot be negative")
+
+    ## The summary message is a change to the channel, so wait for the
+    ## channel to change until the standup is over
+    deadline = time.monotonic() + min(timeout, STANDUP_MAX_WAIT)
+    while True:
+        seq = CHANGES.latest(channel_id)
+        with CHANNEL_LOCKS(channel_id):
+            channel = CHANNELS.get(channel_id)
+            if channel is None:
+                raise InputError(description="Channel does not exist")
+            if channel["is_standup_active"]:
+                result = {
+                    "is_active": True,
+                    "time_finish": channel["standup_time_finish"],
+                    "message_id": None
+                }
+            else:
+                last_standup = channel.get("last_standup", {})
+                return {
+                    "is_active": False,
+                    "time_finish": last_standup.get("time_finish"),
+                    "message_id": last_standup.get("message_id")
+                }
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not CHANGES.wait(channel_id, seq, remaining):
+            return result
 
 def standup_send(token, channel_id, message):
     """
@@ -267,27 +658,24 @@ def standup_send(token, channel_id, message):
     ## Check for InputErrors (..continued)
     if len(message) > 1000:
         raise InputError(description="Message is more than 1000 characters")
-    if not is_standup_active(channel_id):
-        raise InputError(description="An active standup is not currently running")
 
-    ## Find the name of the person sending the message
-    user_id = find_u_id(token)
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == user_id:
-            name_first = user["name_first"]
-            break
-
-    ## Add the message to the standup queue in the database
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        if channel["channel_id"] == channel_id:
-            ## Append a tuple (sender, message)
-            channel["standup_queue"].append(
-                (name_first.lower(), message)
-            )
-            break
-    CHANNELS_DATABASE.update(channels_data)
+    ## Hold the channel's lock so that the standup cannot end while the
+    ## message is being queued
+    with CHANNEL_LOCKS(channel_id):
+        if not is_standup_active(channel_id):
+            raise InputError(description="An active standup is not currently running")
+
+        ## Find the name of the person sending the message
+        name_first = USERS.get(find_u_id(token))["name_first"]
+
+        ## Add the message to the standup queue in the database
+        channels_data = CHANNELS_DATABASE.get()
+        ## Append a tuple (sender, message)
+        CHANNELS.get(channel_id)["standup_queue"].append(
+            (name_first.lower(), message)
+        )
+        CHANNELS.save(channel_id)
+        CHANNELS_DATABASE.update(channels_data)
     return {}
 
 
@@ -323,10 +711,9 @@ def admin_userpermission_change(token, u_id, permission_id):
 
     ## Change permission_id in the database
     auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == u_id:
-            user["global_permission_id"] = permission_id
-            break
+    with USERS.lock:
+        USERS.get(u_id)["global_permission_id"] = permission_id
+        USERS.save(u_id)
     AUTH_DATABASE.update(auth_data)
     return {}
 
@@ -355,49 +742,48 @@ def admin_user_remove(token, u_id):
     if not does_user_exist(u_id):
         raise InputError(description="The user you are trying to remove does not exist")
 
-    ## Update the AUTH_DATABASE
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == u_id:
-            ## Add to deleted_users
-            auth_data["deleted_users"].append({
-                "u_id": u_id,
-                "email": user["email"]
-            })
-
-            ## Invalidate active token if it exists
-            for valid_token in auth_data["active_tokens"]:
-                if valid_token["u_id"] == u_id:
-                    auth_data["active_tokens"].remove(valid_token)
+    ## The user is removed from every channel, so hold every lock
+    with all_locks():
+        ## Update the AUTH_DATABASE
+        auth_data = AUTH_DATABASE.get()
+        user = USERS.remove(u_id)
+        ## Add to deleted_users
+        deleted_user = {
+            "u_id": u_id,
+            "email": user["email"]
+        }
+        auth_data["deleted_users"].append(deleted_user)
+        JOURNAL.put(AUTH_DATABASE, "deleted_users", "u_id", deleted_user)
+        AUTH_DATABASE.update(auth_data)
+
+        ## Invalidate all of the user's active tokens
+        remove_user_tokens(u_id)
+
+        ## Update the CHANNELS_DATABASE
+        channels_data = CHANNELS_DATABASE.get()
+        for channel in channels_data["channels"]:
+            ## Remove user from channel all_members
+            for member in channel["all_members"]:
+                if member["u_id"] == u_id:
+                    channel["all_members"].remove(member)
+                    CHANNELS.save(channel["channel_id"])
                     break
 
-            ## Remove from registered users
-            auth_data["registered_users"].remove(user)
-            break
-    AUTH_DATABASE.update(auth_data)
+            ## Remove user from channel owner_members
+            for owner in channel["owner_members"]:
+                if owner["u_id"] == u_id:
+                    channel["owner_members"].remove(owner)
+                    CHANNELS.save(channel["channel_id"])
+                    break
+        CHANNELS_DATABASE.update(channels_data)
 
-    ## Update the CHANNELS_DATABASE
-    channels_data = CHANNELS_DATABASE.get()
-    for channel in channels_data["channels"]:
-        ## Remove user from channel all_members
-        for member in channel["all_members"]:
-            if member["u_id"] == u_id:
-                channel["all_members"].remove(member)
-                break
-
-        ## Remove user from channel owner_members
-        for owner in channel["owner_members"]:
-            if owner["u_id"] == u_id:
-                channel["owner_members"].remove(owner)
-                break
-    CHANNELS_DATABASE.update(channels_data)
-
-    ## Update the MESSAGES_DATABASE
-    messages_data = MESSAGES_DATABASE.get()
-    for message in messages_data["messages"]:
-        if message["u_id"] == u_id:
-            message["u_id"] = DELETED_USER_ID ## reserved u_id for a removed user
-    MESSAGES_DATABASE.update(messages_data)
+        ## Update the MESSAGES_DATABASE
+        messages_data = MESSAGES_DATABASE.get()
+        for message in messages_data["messages"]:
+            if message["u_id"] == u_id:
+                message["u_id"] = DELETED_USER_ID ## reserved u_id for a removed user
+                save_message(message["message_id"])
+        MESSAGES_DATABASE.update(messages_data)
 
     return {}
 
@@ -409,7 +795,13 @@ def workspace_reset():
     Returns:
         Empty dictionary.
     """
-    reset_auth_data()
-    reset_channels_data()
-    reset_messages_data()
+    cancel_uploads()
+    with all_locks():
+        SCHEDULER.clear()
+        reset_auth_data()
+        reset_channels_data()
+        reset_messages_data()
+        JOURNAL.replace(AUTH_DATABASE)
+        JOURNAL.replace(CHANNELS_DATABASE)
+        JOURNAL.replace(MESSAGES_DATABASE)
     return {}
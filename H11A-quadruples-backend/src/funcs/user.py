@@ -5,13 +5,9 @@ H11A-quadruples, April 2020.
 
 from error import AccessError, InputError
 from database.database import AUTH_DATABASE, CHANNELS_DATABASE
-from database.helpers_auth import (
-    check_email,
-    search_email,
-    is_token_valid,
-    is_handle_in_use,
-    find_u_id
-)
+from database.helpers_auth import check_email, search_email, is_handle_in_use
+from database.indexes import is_token_valid, find_u_id, USERS, CHANNELS
+from database.locks import CHANNEL_LOCKS
 from constants import DELETED_USER_ID
 
 def user_profile(token, u_id):
@@ -45,23 +41,19 @@ def user_profile(token, u_id):
         }
 
     ## Find the user in the database and return their profile
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == u_id:
-            return {
-                "user": {
-                    "u_id": u_id,
-                    "email": user["email"],
-                    "name_first": user["name_first"],
-                    "name_last": user["name_last"],
-                    "handle_str": user["handle_str"],
-                    "profile_img_url": user["profile_img_url"]
-                }
-            }
-
-    ## If the function has not returned, then u_id is not a valid user, so
-    ## raise an InputError
-    raise InputError(description="User with u_id is not a valid user")
+    user = USERS.get(u_id)
+    if user is None:
+        raise InputError(description="User with u_id is not a valid user")
+    return {
+        "user": {
+            "u_id": u_id,
+            "email": user["email"],
+            "name_first": user["name_first"],
+            "name_last": user["name_last"],
+            "handle_str": user["handle_str"],
+            "profile_img_url": user["profile_img_url"]
+        }
+    }
 
 
 def user_profile_setname(token, name_first, name_last):
@@ -94,29 +86,31 @@ def user_profile_setname(token, name_first, name_last):
 
     ## Update the user's details in the auth database
     auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == user_id:
-            user["name_first"] = name_first
-            user["name_last"] = name_last
-            break
+    user = USERS.get(user_id)
+    user["name_first"] = name_first
+    user["name_last"] = name_last
+    USERS.save(user_id)
     AUTH_DATABASE.update(auth_data)
 
     ## Update the user's name in the channel details database if they
     ## are members/owners of any channel
     channel_data = CHANNELS_DATABASE.get()
     for channel in channel_data["channels"]:
-        ## Update name if user is an owner
-        for owner in channel["owner_members"]:
-            if owner["u_id"] == user_id:
-                owner["name_first"] = name_first
-                owner["name_last"] = name_last
-                break
-        ## Update name if user is a member
-        for member in channel["all_members"]:
-            if member["u_id"] == user_id:
-                member["name_first"] = name_first
-                member["name_last"] = name_last
-                break
+        with CHANNEL_LOCKS(channel["channel_id"]):
+            ## Update name if user is an owner
+            for owner in channel["owner_members"]:
+                if owner["u_id"] == user_id:
+                    owner["name_first"] = name_first
+                    owner["name_last"] = name_last
+                    CHANNELS.save(channel["channel_id"])
+                    break
+            ## Update name if user is a member
+            for member in channel["all_members"]:
+                if member["u_id"] == user_id:
+                    member["name_first"] = name_first
+                    member["name_last"] = name_last
+                    CHANNELS.save(channel["channel_id"])
+                    break
     CHANNELS_DATABASE.update(channel_data)
     return {}
 
@@ -142,19 +136,20 @@ def user_profile_setemail(token, email):
     ## Check for InputErrors
     if not check_email(email):
         raise InputError(description="Email entered is not a valid email")
-    if search_email(email):
-        raise InputError(description="Email address is already in use")
 
-    ## Find the u_id corresponding to the given token
-    user_id = find_u_id(token)
+    ## Hold the users table so that no one else can take the email before it is set
+    with USERS.lock:
+        if search_email(email):
+            raise InputError(description="Email address is already in use")
 
-    ## Update the user's details in the database
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == user_id:
-            user["email"] = email
-            break
-    AUTH_DATABASE.update(auth_data)
+        ## Find the u_id corresponding to the given token
+        user_id = find_u_id(token)
+
+        ## Update the user's details in the database
+        auth_data = AUTH_DATABASE.get()
+        USERS.get(user_id)["email"] = email
+        USERS.save(user_id)
+        AUTH_DATABASE.update(auth_data)
     return {}
 
 
@@ -179,17 +174,18 @@ def user_profile_sethandle(token, handle_str):
     ## Check for InputErrors
     if not 2 <= len(handle_str) <= 20:
         raise InputError(description="handle_str must be between 2 and 20 characters")
-    if is_handle_in_use(handle_str):
-        raise InputError(description="Handle is already used by another user")
 
-    ## Find the u_id corresponding to the given token
-    user_id = find_u_id(token)
+    ## Hold the users table so that no one else can take the handle before it is set
+    with USERS.lock:
+        if is_handle_in_use(handle_str):
+            raise InputError(description="Handle is already used by another user")
 
-    ## Update the user's details in the database
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == user_id:
-            user["handle_str"] = handle_str
-            break
-    AUTH_DATABASE.update(auth_data)
+        ## Find the u_id corresponding to the given token
+        user_id = find_u_id(token)
+
+        ## Update the user's details in the database
+        auth_data = AUTH_DATABASE.get()
+        USERS.get(user_id)["handle_str"] = handle_str
+        USERS.save(user_id)
+        AUTH_DATABASE.update(auth_data)
     return {}
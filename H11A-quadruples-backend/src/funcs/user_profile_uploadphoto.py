@@ -3,21 +3,183 @@ Implementation of the user_profile_uploadphoto function.
 H11A-quadruples, April 2020.
 """
 
-import imghdr
+import hashlib
+import itertools
+import math
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import requests
-from PIL import Image
+import urllib3
+from PIL import Image, features
 from error import AccessError, InputError
 from database.database import AUTH_DATABASE, CHANNELS_DATABASE
-from database.helpers_auth import is_token_valid, find_u_id, generate_code
+from database.helpers_auth import is_user_slackr_owner
+from database.indexes import is_token_valid, find_u_id, USERS, CHANNELS
+from database.locks import CHANNEL_LOCKS
+from database.workers import WORKERS
 from constants import PFP_FOLDER, DEFAULT_PFP
 
-def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end):
+## Photos are downloaded, cropped and stored on a small pool of threads,
+## so that a slow image host never holds up a request thread
+PHOTO_THREADS = 4
+## Photos queued or being processed at once; further uploads are refused
+PHOTO_BACKLOG = 64
+## Seconds to wait for the image host to connect or send more data, and
+## the longest that a whole download may take
+DOWNLOAD_TIMEOUT = 10
+DOWNLOAD_DEADLINE = 30
+## Larger downloads are abandoned, and images with more pixels are refused
+## before they are decoded, which bounds the memory each upload can use
+MAX_DOWNLOAD_BYTES = int(os.environ.get("SLACKR_PHOTO_MAX_BYTES", 10 * 1024 * 1024))
+MAX_PHOTO_PIXELS = int(os.environ.get("SLACKR_PHOTO_MAX_PIXELS", 50 * 1000 * 1000))
+## Every JPG starts with these bytes, and is served with one of these
+## content types (or none)
+JPG_MAGIC = b"\xff\xd8\xff"
+JPG_TYPES = {
+    "image/jpeg", "image/jpg", "image/pjpeg", "application/octet-stream", "binary/octet-stream"
+}
+
+## Cropped photos larger than this (in pixels) are shrunk to fit it
+MAX_PHOTO_SIZE = 512
+## Each photo is also stored shrunk to fit each of these sizes (in pixels),
+## as a progressive JPG and, if PIL supports it, a WebP
+THUMBNAIL_SIZES = (24, 48, 96, 192)
+WEBP = features.check("webp")
+MIMETYPES = {"jpg": "image/jpeg", "webp": "image/webp"}
+
+## The modification time and size of each stored photo that has been
+## served, and its ETag
+ETAGS = {}
+
+## Photos are stored under a hash of their full size JPG, so identical
+## crops share their files. A photo that no user has as their profile
+## picture is removed once it is PHOTO_GRACE seconds old, which leaves
+## time for the upload that stored it to finish.
+PHOTO_GRACE = 10 * 60
+DEFAULT_CODE = "default"
+PHOTOS_LOCK = threading.Lock()
+## The name of every file stored for a photo: its code, then the size of
+## its thumbnail (if it is one), then its extension. Codes are a hash, or
+## DEFAULT_CODE, or for photos stored before they were named by hash, a
+## code from generate_code() (eg. "jdH5ixbma3")
+PHOTO_NAME = re.compile(
+    r"[A-Za-z0-9]+"
+    rf"(?:-(?:{'|'.join(str(size) for size in THUMBNAIL_SIZES)}))?"
+    rf"\.(?:{'|'.join(MIMETYPES)})"
+)
+
+
+class ImageCache:
+    """
+    A least recently used cache of downloaded images that have passed the
+    JPG check, keyed by their URL, so that cropping the same image again
+    (eg. while adjusting the bounds) does not download it again. It holds
+    at most max_bytes of images and forgets each one ttl seconds after it
+    was downloaded, in case the image at the URL changes.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, img_url):
+        """
+        Args:
+            img_url (str): URL the image was downloaded from.
+        Returns:
+            The image (bytes), or None if it is not cached.
+        """
+        with self._lock:
+            cached = self._images.get(img_url)
+            if cached is not None and time.time() - cached[0] >= self.ttl:
+                self._discard(img_url)
+                cached = None
+            if cached is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(img_url)
+            self.hits += 1
+            return cached[1]
+
+    def put(self, img_url, content):
+        """
+        Cache an image, evicting the least recently used images to make room.
+
+        Args:
+            img_url (str): URL the image was downloaded from.
+            content (bytes): The image.
+        """
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(img_url)
+            self._images[img_url] = (time.time(), content)
+            self._bytes += len(content)
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._images)))
+
+    def _discard(self, img_url):
+        cached = self._images.pop(img_url, None)
+        if cached is not None:
+            self._bytes -= len(cached[1])
+
+    def clear(self):
+        """
+        Forget every cached image.
+        """
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            A dictionary of the number of hits and misses so far, and the
+            number of images and bytes cached.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "images": len(self._images),
+                "bytes": self._bytes
+            }
+
+
+IMAGE_CACHE = ImageCache(max_bytes=64 * 1024 * 1024, ttl=5 * 60)
+POOL = ThreadPoolExecutor(max_workers=PHOTO_THREADS, thread_name_prefix="uploadphoto")
+SLOTS = threading.BoundedSemaphore(PHOTO_BACKLOG)
+
+## Every upload is numbered, and each user's latest upload number is kept
+## so that an older upload finishing late does not replace a newer one
+UPLOAD_NUMBERS = itertools.count(1)
+LATEST_UPLOADS = {}
+LATEST_LOCK = threading.Lock()
+
+def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end, wait=False):
     """
     Given a url 'img_url' of a .jpg from the Internet, crops the image
     within bounds (x_start, y_start) and (x_end, y_end) and sets the user's
     profile picture to this cropped image.
 
+    The image is only downloaded as far as its header before returning,
+    which is enough to check it; the rest is downloaded, cropped and
+    stored in the background, and the user's profile_img_url changes once
+    the photo has been stored. If wait is True, the photo is stored before
+    returning instead (eg. the default photo, which must exist as soon as
+    the first user has registered).
+
     Args:
         token (str): Token of user who is uploading their photo.
         img_url (str): URL to the image on the Internet.
@@ -25,11 +187,18 @@ def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end):
         y_start (int): upper pixel to start crop.
         x_end (int): right pixel to end crop.
         y_end (int): lower pixel to end crop.
+        wait (bool): Whether to store the photo before returning.
     Raises:
         AccessError: if token is invalid.
-        InputError: if img_url does not return a HTTP status code 200.
-        InputError: if any of x_start, y_start, x_end, y_end are out of image bounds.
+        InputError: if img_url cannot be downloaded or does not return a
+            HTTP status code 200, or takes longer than DOWNLOAD_DEADLINE
+            seconds to download.
         InputError: if image is not a JPG.
+        InputError: if the image is larger than MAX_DOWNLOAD_BYTES or has
+            more than MAX_PHOTO_PIXELS pixels.
+        InputError: if any of x_start, y_start, x_end, y_end are out of
+            image bounds, or they enclose no pixels.
+        InputError: if too many photos are already being processed.
     Returns:
         Empty dictionary.
     """
@@ -38,53 +207,573 @@ def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end):
         raise AccessError(description="Token is not a valid token")
 
     ## Check for InputErrors
-    response = requests.get(img_url)
-    if response.status_code != 200:
-        raise InputError(description="img_url did not return a 200 HTTP status")
-    if imghdr.what(BytesIO(response.content)) != "jpeg":
-        raise InputError(description="Image uploaded is not a JPG")
-
-    ## Set the name of the image, eg. "jdH5ixbma3.jpg" and the path to
-    ## the image relative to src, eg. "profile_pics/jdH5ixbma3.jpg"
-    img_code = generate_code() if img_url != DEFAULT_PFP else "default"
-    img_name = f"{img_code}.jpg"
-    img_path = f"{PFP_FOLDER}/{img_name}"
-
-    ## Open the image and check for InputErrors
-    image = Image.open(BytesIO(response.content))
-    width, height = image.size
-    if x_start < 0 or x_end > width or y_start < 0 or y_end > height:
+    box = (x_start, y_start, x_end, y_end)
+    if x_start < 0 or y_start < 0 or x_end <= x_start or y_end <= y_start:
         raise InputError(description="Bounds are not within the dimensions of the image")
+    if not SLOTS.acquire(blocking=False):
+        raise InputError(description="Too many photos are being processed, try again later")
+    try:
+        ## A cached image is read like a download of one chunk
+        cached = IMAGE_CACHE.get(img_url)
+        chunks = download(img_url) if cached is None else (chunk for chunk in [cached])
+        content = BytesIO()
+        try:
+            check_photo(read_header(content, chunks), box)
+        except BaseException:
+            chunks.close()
+            raise
+    except BaseException:
+        SLOTS.release()
+        raise
 
-    ## Crop the image and save it
-    image_cropped = image.crop((x_start, y_start, x_end, y_end))
-    image_cropped.save(img_path)
-    image.close()
+    u_id = find_u_id(token)
+    with LATEST_LOCK:
+        upload = next(UPLOAD_NUMBERS)
+        LATEST_UPLOADS[u_id] = upload
+    if wait:
+        try:
+            process_photo(u_id, upload, img_url, box, content, chunks)
+        finally:
+            chunks.close()
+            SLOTS.release()
+        return {}
+    try:
+        future = POOL.submit(process_photo, u_id, upload, img_url, box, content, chunks)
+    except RuntimeError:
+        SLOTS.release()
+        raise
+    future.add_done_callback(finish_photo)
+    return {}
+
+def finish_photo(future):
+    """
+    Free the photo's place in the backlog and report why it failed, if it did.
+
+    Args:
+        future (Future): The finished process_photo() call.
+    """
+    SLOTS.release()
+    error = future.exception()
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+def cancel_uploads():
+    """
+    Stop photos that are still being processed from changing any profile,
+    eg. when the workspace is reset.
+    """
+    with LATEST_LOCK:
+        LATEST_UPLOADS.clear()
+
+def download(img_url):
+    """
+    Start downloading a JPG, giving up before reading any of it if the
+    response says it is not a JPG or is larger than MAX_DOWNLOAD_BYTES.
+    The download gives up once DOWNLOAD_DEADLINE seconds have passed, as a
+    host that sends a few bytes at a time never lets a read time out.
+
+    Args:
+        img_url (str): URL to the image on the Internet.
+    Raises:
+        InputError: if img_url cannot be downloaded or does not return a
+            HTTP status code 200.
+        InputError: if the response's content type is not a JPG's.
+        InputError: if the response is larger than MAX_DOWNLOAD_BYTES.
+    Returns:
+        A generator of the image's chunks (bytes), which closes the
+        connection once it is finished or closed.
+    """
+    deadline = time.monotonic() + DOWNLOAD_DEADLINE
+    try:
+        response = requests.get(img_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
+        raise InputError(description="img_url could not be downloaded")
+    try:
+        if response.status_code != 200:
+            raise InputError(description="img_url did not return a 200 HTTP status")
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type and content_type not in JPG_TYPES:
+            raise InputError(description="Image uploaded is not a JPG")
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) > MAX_DOWNLOAD_BYTES:
+            raise InputError(description="Image is too large")
+    except InputError:
+        response.close()
+        raise
+    return response_chunks(response, deadline)
+
+def response_chunks(response, deadline):
+    """
+    Read a response as its data arrives, so that no read waits for more
+    than DOWNLOAD_TIMEOUT seconds, and give up once the deadline passes.
+
+    Args:
+        response (Response): A streamed response.
+        deadline (float): time.monotonic() by which the download must end.
+    Raises:
+        InputError: if the connection fails part way.
+        InputError: if the deadline passes.
+    Returns:
+        A generator of the response's content a chunk at a time (bytes).
+    """
+    ## Reading a whole chunk would wait for all of it, however slowly it
+    ## is sent; read1() returns whatever has arrived (urllib3 2 and later)
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is not None:
+        chunks = iter(lambda: read1(64 * 1024, decode_content=True), b"")
+    else:
+        chunks = response.iter_content(64 * 1024)
+    with response:
+        try:
+            for chunk in chunks:
+                yield chunk
+                if time.monotonic() > deadline:
+                    raise InputError(description="img_url took too long to download")
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError):
+            raise InputError(description="img_url could not be downloaded")
+
+def add_chunk(content, chunk):
+    """
+    Add a downloaded chunk to a JPG, giving up as soon as it is clearly not
+    a JPG or is larger than MAX_DOWNLOAD_BYTES, so that no more than that is
+    ever read.
+
+    Args:
+        content (BytesIO): The JPG so far, positioned at its end.
+        chunk (bytes): The next chunk.
+    Raises:
+        InputError: if the image does not start like a JPG.
+        InputError: if the image is larger than MAX_DOWNLOAD_BYTES.
+    """
+    if content.tell() < len(JPG_MAGIC):
+        head = (content.getvalue() + chunk)[:len(JPG_MAGIC)]
+        if not JPG_MAGIC.startswith(head):
+            raise InputError(description="Image uploaded is not a JPG")
+    content.write(chunk)
+    if content.tell() > MAX_DOWNLOAD_BYTES:
+        raise InputError(description="Image is too large")
+
+def read_header(content, chunks):
+    """
+    Download a JPG as far as the end of its header, which gives its size.
+    The header is usually in the first chunk, but may be read some way
+    beyond its end when it arrives in many.
+
+    Args:
+        content (BytesIO): Where to put the JPG, positioned at its end.
+        chunks (iterator): The JPG, a chunk at a time.
+    Raises:
+        InputError: if the image is not a JPG.
+        InputError: if the image is larger than MAX_DOWNLOAD_BYTES.
+        InputError: if the image has so many pixels that PIL refuses to
+            open it (see Image.MAX_IMAGE_PIXELS).
+    Returns:
+        The image's (width, height) in pixels.
+    """
+    ## Parsing from the start again after every chunk would be quadratic
+    ## in the size of the header (eg. a host sending a few bytes at a time
+    ## or a large EXIF segment), so only parse again once the download has
+    ## doubled, which keeps the parsing linear
+    parsed = 0
+    while True:
+        chunk = next(chunks, None)
+        if chunk is not None:
+            add_chunk(content, chunk)
+            if content.tell() < 2 * parsed:
+                continue
+        parsed = content.tell()
+        try:
+            with Image.open(BytesIO(content.getvalue())) as image:
+                if image.format != "JPEG":
+                    raise InputError(description="Image uploaded is not a JPG")
+                return image.size
+        except Image.DecompressionBombError:
+            raise InputError(description="Image has too many pixels")
+        except OSError:
+            ## Not enough of the header has been downloaded yet
+            if chunk is None:
+                raise InputError(description="Image uploaded is not a JPG")
+
+def check_photo(size, box):
+    """
+    Args:
+        size (tuple): The image's (width, height) in pixels.
+        box (tuple): The crop bounds (x_start, y_start, x_end, y_end).
+    Raises:
+        InputError: if the image has more than MAX_PHOTO_PIXELS pixels.
+        InputError: if the bounds are not within the image.
+    """
+    width, height = size
+    if width * height > MAX_PHOTO_PIXELS:
+        raise InputError(description="Image has too many pixels")
+    if box[2] > width or box[3] > height:
+        raise InputError(description="Bounds are not within the dimensions of the image")
+
+def process_photo(u_id, upload, img_url, box, content, chunks):
+    """
+    Finish downloading a photo whose header has been checked, then crop and
+    store it and make it the user's profile picture.
+
+    Args:
+        u_id (int): id of the user who uploaded the photo.
+        upload (int): Number of the upload.
+        img_url (str): URL to the image on the Internet.
+        box (tuple): The crop bounds (x_start, y_start, x_end, y_end).
+        content (BytesIO): The image as far as it has been downloaded,
+            positioned at its end.
+        chunks (iterator): The rest of the image, a chunk at a time.
+    Raises:
+        InputError: if the rest of the image cannot be downloaded or is
+            larger than MAX_DOWNLOAD_BYTES.
+    """
+    for chunk in chunks:
+        add_chunk(content, chunk)
+    content = content.getvalue()
+    IMAGE_CACHE.put(img_url, content)
+
+    ## Open the image, which only reads the header that has been checked,
+    ## then crop the image and save it with its thumbnails, eg. as
+    ## "profile_pics/3f1c0e9a7b5d2c4e6f80.jpg" relative to src
+    with Image.open(BytesIO(content)) as image:
+        img_code = store_photo(
+            crop_photo(image, box), upload, DEFAULT_CODE if img_url == DEFAULT_PFP else None
+        )
 
-    ## Set the url that contains the image and post the image to that url
     from port_settings import BASE_URL
-    profile_img_url = f"{BASE_URL}/imgurl/{img_name}"
-    requests.get(f"{profile_img_url}")
+    set_profile_img_url(u_id, upload, f"{BASE_URL}/imgurl/{img_code}.jpg")
 
-    ## Update the user's profile_img_url in the AUTH_DATABASE
-    u_id = find_u_id(token)
-    auth_data = AUTH_DATABASE.get()
-    for user in auth_data["registered_users"]:
-        if user["u_id"] == u_id:
-            user["profile_img_url"] = profile_img_url
-            break
-    AUTH_DATABASE.update(auth_data)
-
-    ## Update the user's profile_img_url in the CHANNELS_DATABASE
-    channel_data = CHANNELS_DATABASE.get()
-    for channel in channel_data["channels"]:
-        for member in channel["all_members"]:
-            if member["u_id"] == u_id:
-                member["profile_img_url"] = profile_img_url
-                break
-        for owner in channel["owner_members"]:
-            if owner["u_id"] == u_id:
-                owner["profile_img_url"] = profile_img_url
-                break
-    CHANNELS_DATABASE.update(channel_data)
-    return {}
+def crop_photo(image, box):
+    """
+    Crop a photo that has not been decoded yet, shrinking the crop to fit
+    MAX_PHOTO_SIZE. If it will be shrunk, a JPG is decoded at the smallest
+    of its reduced resolutions (1/2, 1/4 or 1/8 scale, see Image.draft())
+    that still leaves at least MAX_PHOTO_SIZE pixels across the crop, which
+    takes a fraction of the time and memory of decoding it whole.
+
+    Args:
+        image (Image): The opened photo.
+        box (tuple): The crop bounds (x_start, y_start, x_end, y_end) in
+            the photo's full resolution.
+    Returns:
+        The cropped photo (Image).
+    """
+    scale = MAX_PHOTO_SIZE / max(box[2] - box[0], box[3] - box[1])
+    if scale < 1:
+        width, height = image.size
+        image.draft(image.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+        ## Map the bounds onto the reduced resolution actually chosen
+        x_scale, y_scale = image.size[0] / width, image.size[1] / height
+        box = (
+            int(box[0] * x_scale),
+            int(box[1] * y_scale),
+            min(math.ceil(box[2] * x_scale), image.size[0]),
+            min(math.ceil(box[3] * y_scale), image.size[1])
+        )
+    cropped = image.crop(box)
+    if max(cropped.size) > MAX_PHOTO_SIZE:
+        cropped.thumbnail((MAX_PHOTO_SIZE, MAX_PHOTO_SIZE), Image.LANCZOS)
+    return cropped
+
+def store_photo(image, upload, img_code=None):
+    """
+    Save a cropped photo and a thumbnail for each of THUMBNAIL_SIZES smaller
+    than it to PFP_FOLDER, eg. "3f1c0e9a7b5d2c4e6f80.jpg",
+    "3f1c0e9a7b5d2c4e6f80-96.jpg" and "3f1c0e9a7b5d2c4e6f80-96.webp".
+    Nothing is written if the same photo is already stored. Each file
+    replaces any previous version whole, so that it is never served half
+    written, and the full size JPG is written last, so that a photo is only
+    taken to be stored once all of its files are.
+
+    Args:
+        image (Image): The cropped photo.
+        upload (int): Number of the upload, to keep temporary files apart.
+        img_code (str): Name to store the photo under, or None to name it
+            after a hash of its full size JPG.
+    Returns:
+        The name (str) the photo is stored under, without its extension.
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    full_size = encode_jpg(image)
+    if img_code is None:
+        img_code = hashlib.sha256(full_size).hexdigest()[:20]
+
+    with PHOTOS_LOCK:
+        img_path = os.path.join(PFP_FOLDER, f"{img_code}.jpg")
+        if img_code != DEFAULT_CODE and os.path.exists(img_path):
+            ## Mark the shared photo as recently used so it is not collected
+            ## before this upload refers to it
+            os.utime(img_path)
+            return img_code
+
+        files = []
+        if WEBP:
+            files.append((f"{img_code}.webp", encode_webp(image)))
+        for size in sorted(THUMBNAIL_SIZES, reverse=True):
+            if size < max(image.size):
+                ## Shrink each thumbnail from the next larger one
+                image = image.copy()
+                image.thumbnail((size, size), Image.LANCZOS)
+                files.append((f"{img_code}-{size}.jpg", encode_jpg(image)))
+                if WEBP:
+                    files.append((f"{img_code}-{size}.webp", encode_webp(image)))
+        files.append((f"{img_code}.jpg", full_size))
+        for img_name, data in files:
+            save_image(data, img_name, upload)
+    return img_code
+
+def encode_jpg(image):
+    """
+    Returns:
+        The image encoded as a progressive JPG (bytes).
+    """
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=85, optimize=True, progressive=True)
+    return output.getvalue()
+
+def encode_webp(image):
+    """
+    Returns:
+        The image encoded as a WebP (bytes).
+    """
+    output = BytesIO()
+    image.save(output, format="WEBP", quality=80)
+    return output.getvalue()
+
+def save_image(data, img_name, upload):
+    """
+    Write an encoded image to PFP_FOLDER through a temporary file.
+
+    Args:
+        data (bytes): The encoded image.
+        img_name (str): Name of the file in PFP_FOLDER.
+        upload (int): Number of the upload, to keep temporary files apart.
+    """
+    img_path = os.path.join(PFP_FOLDER, img_name)
+    temporary_path = f"{img_path}.{upload}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+    os.replace(temporary_path, img_path)
+
+def has_photo(img_code):
+    """
+    Args:
+        img_code (str): Name of a photo without its extension, eg. "default".
+    Returns:
+        True if the photo is stored, else False.
+    """
+    return os.path.exists(os.path.join(PFP_FOLDER, f"{img_code}.jpg"))
+
+def is_photo_name(img_name):
+    """
+    Args:
+        img_name (str): Name of a file asked for, eg. from a URL.
+    Returns:
+        True if img_name is the name a photo or thumbnail is stored under
+        (see PHOTO_NAME), else False.
+    """
+    return PHOTO_NAME.fullmatch(img_name) is not None
+
+def photo_variant(img_name, size=None, webp=False):
+    """
+    Choose which stored file to serve for a photo: the smallest thumbnail
+    at least as large as size, or the full photo if none is, as a WebP if
+    the client accepts it.
+
+    Args:
+        img_name (str): Name of the photo, eg. "jdH5ixbma3.jpg".
+        size (int): Width and height in pixels the photo is shown at, or
+            None for the full photo.
+        webp (bool): Whether the client accepts WebP.
+    Returns:
+        The name (str) of the file in PFP_FOLDER.
+    """
+    img_code = img_name.rsplit(".", 1)[0]
+    names = [img_code]
+    if size is not None:
+        names = [f"{img_code}-{thumbnail}" for thumbnail in sorted(THUMBNAIL_SIZES) if thumbnail >= size] + names
+    extensions = ["webp", "jpg"] if webp else ["jpg"]
+    for name in names:
+        for extension in extensions:
+            if os.path.exists(os.path.join(PFP_FOLDER, f"{name}.{extension}")):
+                return f"{name}.{extension}"
+    return img_name
+
+def photo_etag(img_name):
+    """
+    Args:
+        img_name (str): Name of a file in PFP_FOLDER.
+    Raises:
+        FileNotFoundError: if there is no such file.
+    Returns:
+        A strong ETag (str) for the file: a hash of its contents, computed
+        once for each version of the file.
+    """
+    img_path = os.path.join(PFP_FOLDER, img_name)
+    stat = os.stat(img_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if ETAGS.get(img_path, (None, None))[0] != version:
+        with open(img_path, "rb") as file:
+            ETAGS[img_path] = (version, hashlib.sha256(file.read()).hexdigest()[:32])
+    return ETAGS[img_path][1]
+
+def photo_code(img_name):
+    """
+    Args:
+        img_name (str): A profile_img_url or the name of a stored file, eg.
+            "3f1c0e9a7b5d2c4e6f80-96.webp".
+    Returns:
+        The name (str) of the photo the file belongs to, eg.
+        "3f1c0e9a7b5d2c4e6f80".
+    """
+    stem = img_name.rsplit("/", 1)[-1].split(".")[0]
+    code, _, size = stem.rpartition("-")
+    return code if size in {str(thumbnail) for thumbnail in THUMBNAIL_SIZES} else stem
+
+def photo_references():
+    """
+    Returns:
+        A Counter of how many users have each photo as their profile picture.
+    """
+    with USERS.lock:
+        urls = [user["profile_img_url"] for user in AUTH_DATABASE.get()["registered_users"]]
+    return Counter(photo_code(url) for url in urls)
+
+def photo_files():
+    """
+    Returns:
+        A dictionary from the name of each stored photo to a list of the
+        names of its files in PFP_FOLDER. Temporary files are left out.
+    """
+    files = {}
+    for img_name in os.listdir(PFP_FOLDER):
+        if not img_name.endswith(".tmp"):
+            files.setdefault(photo_code(img_name), []).append(img_name)
+    return files
+
+def collect_photos(img_codes=None):
+    """
+    Remove the files of photos that no user has as their profile picture,
+    and temporary files left by uploads that failed part way, once they are
+    older than PHOTO_GRACE. The default photo is always kept.
+
+    Args:
+        img_codes (set): Names of the photos to consider, or None for all.
+    Returns:
+        The number of bytes freed (int).
+    """
+    references = photo_references()
+    now = time.time()
+    freed = 0
+    with PHOTOS_LOCK:
+        for img_code, img_names in photo_files().items():
+            if img_codes is not None and img_code not in img_codes:
+                continue
+            if img_code == DEFAULT_CODE or references[img_code]:
+                continue
+            img_paths = [os.path.join(PFP_FOLDER, img_name) for img_name in img_names]
+            if now - max(os.path.getmtime(img_path) for img_path in img_paths) < PHOTO_GRACE:
+                continue
+            for img_path in img_paths:
+                freed += os.path.getsize(img_path)
+                os.remove(img_path)
+                ETAGS.pop(img_path, None)
+        if img_codes is None:
+            for img_name in os.listdir(PFP_FOLDER):
+                img_path = os.path.join(PFP_FOLDER, img_name)
+                if img_name.endswith(".tmp") and now - os.path.getmtime(img_path) >= PHOTO_GRACE:
+                    freed += os.path.getsize(img_path)
+                    os.remove(img_path)
+    return freed
+
+def photo_usage():
+    """
+    Returns:
+        A dictionary of how much disk space stored photos use: the number
+        of photos, files and bytes, how many of those photos are somebody's
+        profile picture, how many are shared by several users, and the
+        bytes used by photos nobody refers to.
+    """
+    references = photo_references()
+    usage = {
+        "photos": 0,
+        "files": 0,
+        "bytes": 0,
+        "referenced_photos": 0,
+        "shared_photos": 0,
+        "unreferenced_bytes": 0
+    }
+    with PHOTOS_LOCK:
+        for img_code, img_names in photo_files().items():
+            size = sum(os.path.getsize(os.path.join(PFP_FOLDER, img_name)) for img_name in img_names)
+            usage["photos"] += 1
+            usage["files"] += len(img_names)
+            usage["bytes"] += size
+            if references[img_code]:
+                usage["referenced_photos"] += 1
+                usage["shared_photos"] += references[img_code] > 1
+            elif img_code != DEFAULT_CODE:
+                usage["unreferenced_bytes"] += size
+    return usage
+
+def admin_photos_usage(token):
+    """
+    Report how much disk space stored profile pictures use.
+
+    Args:
+        token (str): Token of a Slackr owner.
+    Raises:
+        AccessError: if token is invalid.
+        AccessError: if the user is not a Slackr owner.
+    Returns:
+        Dictionary returned by photo_usage(), with the statistics of
+        IMAGE_CACHE under "image_cache".
+    """
+    if not is_token_valid(token):
+        raise AccessError(description="Token is not a valid token")
+    if not is_user_slackr_owner(find_u_id(token)):
+        raise AccessError(description="Only Slackr owners can see photo disk usage")
+    return dict(photo_usage(), image_cache=IMAGE_CACHE.stats())
+
+def set_profile_img_url(u_id, upload, profile_img_url):
+    """
+    Change a user's profile_img_url in the AUTH_DATABASE and in every
+    channel they are in at once, unless they have uploaded another photo
+    since.
+
+    Args:
+        u_id (int): id of the user.
+        upload (int): Number of the upload the photo came from.
+        profile_img_url (str): URL the photo is served from.
+    """
+    with WORKERS.exclusive("registered_users", "channels"), CHANNEL_LOCKS.all(), USERS.lock:
+        with LATEST_LOCK:
+            if LATEST_UPLOADS.get(u_id) != upload:
+                return
+        if USERS.get(u_id) is None:
+            return
+        previous_url = USERS.get(u_id)["profile_img_url"]
+
+        ## Update the user's profile_img_url in the AUTH_DATABASE
+        auth_data = AUTH_DATABASE.get()
+        USERS.get(u_id)["profile_img_url"] = profile_img_url
+        USERS.save(u_id)
+        AUTH_DATABASE.update(auth_data)
+
+        ## Update the user's profile_img_url in the CHANNELS_DATABASE
+        channel_data = CHANNELS_DATABASE.get()
+        for channel in channel_data["channels"]:
+            for member in channel["all_members"]:
+                if member["u_id"] == u_id:
+                    member["profile_img_url"] = profile_img_url
+                    CHANNELS.save(channel["channel_id"])
+                    break
+            for owner in channel["owner_members"]:
+                if owner["u_id"] == u_id:
+                    owner["profile_img_url"] = profile_img_url
+                    CHANNELS.save(channel["channel_id"])
+                    break
+        CHANNELS_DATABASE.update(channel_data)
+
+    ## Remove the previous photo if nobody else has it
+    collect_photos({photo_code(previous_url)})
@@ -0,0 +1,25 @@
+"""
+gunicorn settings for serving Slackr from several worker processes with
+`gunicorn --config gunicorn.conf.py wsgi:APP` run from src. The port and
+number of workers and threads per worker can be set with PORT,
+SLACKR_WORKERS and SLACKR_THREADS.
+H11A-quadruples, April 2020.
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("SLACKR_WORKERS", multiprocessing.cpu_count()))
+
+## Threads let a worker serve reads while another of its requests waits
+## for its turn to change the databases. Each open channel event stream or
+## standup long-poll holds a thread, so a worker only holds SLACKR_MAX_HELD
+## of them at once (half its threads unless set) and turns the rest away
+## with a 503 and Retry-After (see server.py).
+worker_class = "gthread"
+threads = int(os.environ.get("SLACKR_THREADS", 32))
+
+## Every worker must load the databases and start its own scheduler and
+## save threads after it is forked (see wsgi.py)
+preload_app = False
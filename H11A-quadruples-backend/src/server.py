@@ -3,12 +3,14 @@ Server.py -- contains all routes for Slackr app.
 H11A-quadruples, April 2020.
 """
 
+import os
 import sys
 import time
 import threading
-from json import dumps
-from flask import Flask, request, send_from_directory
+import traceback
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
+from werkzeug.exceptions import NotFound
 from funcs.auth import (
     auth_login,
     auth_logout,
@@ -19,7 +21,6 @@ from funcs.auth import (
 from funcs.channel import (
     channel_invite,
     channel_details,
-    channel_messages,
     channel_leave,
     channel_join,
     channel_addowner,
@@ -34,7 +35,8 @@ from funcs.message import (
     message_pin,
     message_unpin,
     message_remove,
-    message_edit
+    message_edit,
+    requeue_sendlater
 )
 from funcs.user import (
     user_profile,
@@ -42,34 +44,45 @@ from funcs.user import (
     user_profile_setemail,
     user_profile_sethandle
 )
-from funcs.user_profile_uploadphoto import user_profile_uploadphoto
+from funcs.user_profile_uploadphoto import (
+    user_profile_uploadphoto,
+    admin_photos_usage,
+    photo_variant,
+    photo_etag,
+    is_photo_name,
+    has_photo,
+    collect_photos,
+    MIMETYPES,
+    DEFAULT_CODE
+)
 from funcs.other import (
-    users_all,
+    users_all_encoded,
     search,
+    channel_messages,
+    channel_changes,
+    channel_events,
+    search_matches,
     workspace_reset,
     standup_start,
     standup_active,
+    standup_wait,
     standup_send,
     admin_userpermission_change,
     admin_user_remove
 )
-from database.database import (
-    AUTH_DATABASE,
-    CHANNELS_DATABASE,
-    MESSAGES_DATABASE,
-    update_database,
-    get_database
-)
 from database.helpers_auth import is_user_slackr_owner
-from constants import (
-    AUTH_DB_PATH, CHANNELS_DB_PATH, MESSAGES_DB_PATH,
-    SAVE_INTERVAL, PFP_FOLDER, LOCALHOST_URL, DEFAULT_PFP
-)
+from database.indexes import CHANNELS
+from database.locks import CHANNEL_LOCKS
+from database.scheduler import SCHEDULER
+from database.backends import get_backend
+from error import InputError
+from responses import encode_json, encode_event, json_response, EVENT_STREAM_MIMETYPE
+from constants import SAVE_INTERVAL, PFP_FOLDER, LOCALHOST_URL, DEFAULT_PFP
 
 def defaultHandler(err):
     response = err.get_response()
     print("response", err, err.get_response())
-    response.data = dumps({
+    response.data = encode_json({
         "code": err.code,
         "name": "System Error",
         "message": err.get_description(),
@@ -83,6 +96,39 @@ CORS(APP)
 APP.config["TRAP_HTTP_EXCEPTIONS"] = True
 APP.register_error_handler(Exception, defaultHandler)
 
+## "memory" (pickled snapshots and a journal) or "sqlite"; either way the
+## databases are served from memory, and only persisted by the backend
+STORAGE = get_backend(os.environ.get("SLACKR_STORAGE", "memory"))
+
+## Seconds that clients and proxies may cache a profile picture for
+PHOTO_MAX_AGE = 365 * 24 * 60 * 60
+
+## Channel event streams and standup long-polls hold a thread each for as
+## long as they are open, so each worker only holds this many at once and
+## keeps the rest of its threads (SLACKR_THREADS) for other requests
+MAX_HELD_REQUESTS = int(os.environ.get(
+    "SLACKR_MAX_HELD", int(os.environ.get("SLACKR_THREADS", 32)) // 2
+))
+HELD_REQUESTS = threading.BoundedSemaphore(MAX_HELD_REQUESTS)
+
+## Seconds that a client turned away for being over MAX_HELD_REQUESTS is
+## asked to wait before trying again
+HELD_RETRY_AFTER = 5
+
+def too_busy():
+    """
+    Returns:
+        A 503 response asking the client to come back in HELD_RETRY_AFTER
+        seconds, for when the worker holds MAX_HELD_REQUESTS already.
+    """
+    response = json_response({
+        "code": 503,
+        "name": "System Error",
+        "message": "Too many requests are waiting, try again later",
+    }, status=503)
+    response.headers["Retry-After"] = str(HELD_RETRY_AFTER)
+    return response
+
 
 ####################################################################
 ##                          auth routes                           ##
@@ -91,33 +137,39 @@ APP.register_error_handler(Exception, defaultHandler)
 @APP.route("/auth/login", methods=["POST"])
 def route_auth_login():
     data = request.get_json()
-    return dumps(auth_login(data["email"], data["password"]))
+    return json_response(auth_login(data["email"], data["password"]))
 
 @APP.route("/auth/logout", methods=["POST"])
 def route_auth_logout():
     data = request.get_json()
-    return dumps(auth_logout(data["token"]))
+    return json_response(auth_logout(data["token"]))
 
 @APP.route("/auth/register", methods=["POST"])
 def route_auth_register():
     data = request.get_json()
-    ## Register user and then serve the default pfp if it is the first user to register
+    ## Register user and then store the default pfp if it is the first user
+    ## to register and it has not been stored before, so that it can be
+    ## served as soon as the user is told their profile_img_url
     output = auth_register(
         data["email"], data["password"], data["name_first"], data["name_last"]
     )
-    if is_user_slackr_owner(output["u_id"]):
-        user_profile_uploadphoto(output["token"], DEFAULT_PFP, 0, 0, 400, 400)
-    return dumps(output)
+    if is_user_slackr_owner(output["u_id"]) and not has_photo(DEFAULT_CODE):
+        try:
+            user_profile_uploadphoto(output["token"], DEFAULT_PFP, 0, 0, 400, 400, wait=True)
+        except InputError:
+            ## The user is registered either way, so only report it
+            traceback.print_exc()
+    return json_response(output)
 
 @APP.route("/auth/passwordreset/request", methods=["POST"])
 def route_auth_passwordreset_request():
     data = request.get_json()
-    return dumps(auth_passwordreset_request(data["email"]))
+    return json_response(auth_passwordreset_request(data["email"]))
 
 @APP.route("/auth/passwordreset/reset", methods=["POST"])
 def route_auth_passwordreset_reset():
     data = request.get_json()
-    return dumps(auth_passwordreset_reset(
+    return json_response(auth_passwordreset_reset(
         data["reset_code"], data["new_password"]
     ))
 
@@ -129,45 +181,98 @@ def route_auth_passwordreset_reset():
 @APP.route("/channel/invite", methods=["POST"])
 def route_channel_invite():
     data = request.get_json()
-    return dumps(channel_invite(
-        data["token"], int(data["channel_id"]), int(data["u_id"])
-    ))
+    with CHANNEL_LOCKS(int(data["channel_id"])):
+        output = channel_invite(
+            data["token"], int(data["channel_id"]), int(data["u_id"])
+        )
+        CHANNELS.save(int(data["channel_id"]))
+    return json_response(output)
 
 @APP.route("/channel/details", methods=["GET"])
 def route_channel_details():
     data = request.args
-    return dumps(channel_details(data["token"], int(data["channel_id"])))
+    return json_response(channel_details(data["token"], int(data["channel_id"])))
 
 @APP.route("/channel/messages", methods=["GET"])
 def route_channel_messages():
     data = request.args
-    return dumps(channel_messages(
+    return json_response(channel_messages(
         data["token"], int(data["channel_id"]), int(data["start"])
     ))
 
+@APP.route("/channel/changes", methods=["GET"])
+def route_channel_changes():
+    data = request.args
+    return json_response(channel_changes(
+        data["token"], int(data["channel_id"]), data.get("since", "0")
+    ))
+
+@APP.route("/channel/events", methods=["GET"])
+def route_channel_events():
+    data = request.args
+    ## A reconnecting EventSource sends the id of the last event it saw
+    since = request.headers.get("Last-Event-ID", data.get("since"))
+    if not HELD_REQUESTS.acquire(blocking=False):
+        return too_busy()
+    try:
+        events = channel_events(
+            data["token"], int(data["channel_id"]), since
+        )
+    except Exception:
+        HELD_REQUESTS.release()
+        raise
+
+    def stream():
+        ## Send the headers straight away, even if the channel is quiet
+        yield encode_event("connected")
+        for event, changes in events:
+            if changes is None:
+                yield encode_event(event)
+            else:
+                yield encode_event(event, changes, changes["seq"])
+    response = Response(stream(), mimetype=EVENT_STREAM_MIMETYPE)
+    ## The stream is closed once the client goes away or it ends
+    response.call_on_close(HELD_REQUESTS.release)
+    response.cache_control.no_cache = True
+    ## Stop proxies such as nginx from holding events back
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 @APP.route("/channel/leave", methods=["POST"])
 def route_channel_leave():
     data = request.get_json()
-    return dumps(channel_leave(data["token"], int(data["channel_id"])))
+    with CHANNEL_LOCKS(int(data["channel_id"])):
+        output = channel_leave(data["token"], int(data["channel_id"]))
+        CHANNELS.save(int(data["channel_id"]))
+    return json_response(output)
 
 @APP.route("/channel/join", methods=["POST"])
 def route_channel_join():
     data = request.get_json()
-    return dumps(channel_join(data["token"], int(data["channel_id"])))
+    with CHANNEL_LOCKS(int(data["channel_id"])):
+        output = channel_join(data["token"], int(data["channel_id"]))
+        CHANNELS.save(int(data["channel_id"]))
+    return json_response(output)
 
 @APP.route("/channel/addowner", methods=["POST"])
 def route_channel_addowner():
     data = request.get_json()
-    return dumps(channel_addowner(
-        data["token"], int(data["channel_id"]), int(data["u_id"])
-    ))
+    with CHANNEL_LOCKS(int(data["channel_id"])):
+        output = channel_addowner(
+            data["token"], int(data["channel_id"]), int(data["u_id"])
+        )
+        CHANNELS.save(int(data["channel_id"]))
+    return json_response(output)
 
 @APP.route("/channel/removeowner", methods=["POST"])
 def route_channel_removeowner():
     data = request.get_json()
-    return dumps(channel_removeowner(
-        data["token"], int(data["channel_id"]), int(data["u_id"])
-    ))
+    with CHANNEL_LOCKS(int(data["channel_id"])):
+        output = channel_removeowner(
+            data["token"], int(data["channel_id"]), int(data["u_id"])
+        )
+        CHANNELS.save(int(data["channel_id"]))
+    return json_response(output)
 
 
 ####################################################################
@@ -177,19 +282,22 @@ def route_channel_removeowner():
 @APP.route("/channels/list", methods=["GET"])
 def route_channels_list():
     data = request.args
-    return dumps(channels_list(data["token"]))
+    return json_response(channels_list(data["token"]))
 
 @APP.route("/channels/listall", methods=["GET"])
 def route_channels_listall():
     data = request.args
-    return dumps(channels_listall(data["token"]))
+    return json_response(channels_listall(data["token"]))
 
 @APP.route("/channels/create", methods=["POST"])
 def route_channels_create():
     data = request.get_json()
-    return dumps(channels_create(
-        data["token"], data["name"], data["is_public"]
-    ))
+    with CHANNELS.lock:
+        output = channels_create(
+            data["token"], data["name"], data["is_public"]
+        )
+        CHANNELS.track(output["channel_id"])
+    return json_response(output)
 
 
 ####################################################################
@@ -199,50 +307,50 @@ def route_channels_create():
 @APP.route("/message/send", methods=["POST"])
 def route_message_send():
     data = request.get_json()
-    return dumps(message_send(
+    return json_response(message_send(
         data["token"], int(data["channel_id"]), data["message"]
     ))
 
 @APP.route("/message/sendlater", methods=["POST"])
 def route_message_sendlater():
     data = request.get_json()
-    return dumps(message_sendlater(
+    return json_response(message_sendlater(
         data["token"], int(data["channel_id"]), data["message"], int(data["time_sent"])
     ))
 
 @APP.route("/message/react", methods=["POST"])
 def route_message_react():
     data = request.get_json()
-    return dumps(message_react(
+    return json_response(message_react(
         data["token"], int(data["message_id"]), int(data["react_id"])
     ))
 
 @APP.route("/message/unreact", methods=["POST"])
 def route_message_unreact():
     data = request.get_json()
-    return dumps(message_unreact(
+    return json_response(message_unreact(
         data["token"], int(data["message_id"]), int(data["react_id"])
     ))
 
 @APP.route("/message/pin", methods=["POST"])
 def route_message_pin():
     data = request.get_json()
-    return dumps(message_pin(data["token"], int(data["message_id"])))
+    return json_response(message_pin(data["token"], int(data["message_id"])))
 
 @APP.route("/message/unpin", methods=["POST"])
 def route_message_unpin():
     data = request.get_json()
-    return dumps(message_unpin(data["token"], int(data["message_id"])))
+    return json_response(message_unpin(data["token"], int(data["message_id"])))
 
 @APP.route("/message/remove", methods=["DELETE"])
 def route_message_remove():
     data = request.get_json()
-    return dumps(message_remove(data["token"], int(data["message_id"])))
+    return json_response(message_remove(data["token"], int(data["message_id"])))
 
 @APP.route("/message/edit", methods=["PUT"])
 def route_message_edit():
     data = request.get_json()
-    return dumps(message_edit(
+    return json_response(message_edit(
         data["token"], int(data["message_id"]), data["message"]
     ))
 
@@ -254,29 +362,29 @@ def route_message_edit():
 @APP.route("/user/profile", methods=["GET"])
 def route_user_profile():
     data = request.args
-    return dumps(user_profile(data["token"], int(data["u_id"])))
+    return json_response(user_profile(data["token"], int(data["u_id"])))
 
 @APP.route("/user/profile/setname", methods=["PUT"])
 def route_user_profile_setname():
     data = request.get_json()
-    return dumps(user_profile_setname(
+    return json_response(user_profile_setname(
         data["token"], data["name_first"], data["name_last"]
     ))
 
 @APP.route("/user/profile/setemail", methods=["PUT"])
 def route_user_profile_setemail():
     data = request.get_json()
-    return dumps(user_profile_setemail(data["token"], data["email"]))
+    return json_response(user_profile_setemail(data["token"], data["email"]))
 
 @APP.route("/user/profile/sethandle", methods=["PUT"])
 def route_user_profile_sethandle():
     data = request.get_json()
-    return dumps(user_profile_sethandle(data["token"], data["handle_str"]))
+    return json_response(user_profile_sethandle(data["token"], data["handle_str"]))
 
 @APP.route("/user/profile/uploadphoto", methods=["POST"])
 def route_user_profile_uploadphoto():
     data = request.get_json()
-    return dumps(user_profile_uploadphoto(
+    return json_response(user_profile_uploadphoto(
         data["token"], data["img_url"],
         int(data["x_start"]), int(data["y_start"]),
         int(data["x_end"]), int(data["y_end"])
@@ -286,12 +394,39 @@ def route_user_profile_uploadphoto():
 def upload_img(img_name):
     """
     Uploads an image with title f"{img_name}" taken from PFP_FOLDER
-    to the route f"/imgurl/{img_name}".
+    to the route f"/imgurl/{img_name}". An optional size parameter (in
+    pixels) serves the smallest stored thumbnail that is at least that
+    size, and clients that accept WebP are sent WebP.
+
+    Stored files never change once written, so they may be cached for a
+    year, and requests with a matching ETag or date get a 304.
 
     Args:
         img_name (str): Name of the image being served.
+    Raises:
+        NotFound: if img_name is not the name of a stored photo.
     """
-    return send_from_directory(PFP_FOLDER, f"{img_name}", mimetype="image/jpg")
+    if not is_photo_name(img_name):
+        raise NotFound()
+    size = request.args.get("size", type=int)
+    webp = "image/webp" in request.headers.get("Accept", "")
+    variant = photo_variant(img_name, size, webp)
+    try:
+        etag = photo_etag(variant)
+        last_modified = os.path.getmtime(os.path.join(PFP_FOLDER, variant))
+    except FileNotFoundError:
+        ## Never stored, or collected since
+        raise NotFound()
+    response = send_from_directory(
+        PFP_FOLDER, variant, mimetype=MIMETYPES.get(variant.rsplit(".", 1)[-1], "image/jpeg")
+    )
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = PHOTO_MAX_AGE
+    response.vary.add("Accept")
+    return response.make_conditional(request)
 
 
 ####################################################################
@@ -301,74 +436,140 @@ def upload_img(img_name):
 @APP.route("/users/all", methods=["GET"])
 def route_users_all():
     data = request.args
-    return dumps(users_all(data["token"]))
+    body, etag = users_all_encoded(data["token"])
+    response = json_response(body)
+    response.set_etag(etag)
+    ## Clients revalidate every poll, and get a 304 if no user has changed
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @APP.route("/search", methods=["GET"])
 def route_search():
     data = request.args
-    return dumps(search(data["token"], data["query_str"]))
+    if data.get("stream") == "true":
+        ## Send each match as its own line of JSON as soon as it is found
+        matches = search_matches(data["token"], data["query_str"], data.get("cursor"))
+        return Response(
+            (encode_json({"cursor": cursor, "message": message}) + b"\n" for cursor, message in matches),
+            mimetype="application/x-ndjson"
+        )
+    limit = None
+    if "limit" in data:
+        try:
+            limit = int(data["limit"])
+        except ValueError:
+            raise InputError(description="limit must be a whole number")
+    return json_response(search(
+        data["token"], data["query_str"], limit, data.get("cursor")
+    ))
 
 @APP.route("/standup/start", methods=["POST"])
 def route_standup_start():
     data = request.get_json()
-    return dumps(standup_start(
+    return json_response(standup_start(
         data["token"], int(data["channel_id"]), int(data["length"])
     ))
 
 @APP.route("/standup/active", methods=["GET"])
 def route_standup_active():
     data = request.args
-    return dumps(standup_active(data["token"], int(data["channel_id"])))
+    if "wait" in data:
+        try:
+            wait = float(data["wait"])
+        except ValueError:
+            raise InputError(description="wait must be a number")
+        ## Long-poll: answer once the standup ends or wait seconds pass
+        if not HELD_REQUESTS.acquire(blocking=False):
+            return too_busy()
+        try:
+            return json_response(standup_wait(
+                data["token"], int(data["channel_id"]), wait
+            ))
+        finally:
+            HELD_REQUESTS.release()
+    return json_response(standup_active(data["token"], int(data["channel_id"])))
 
 @APP.route("/standup/send", methods=["POST"])
 def route_standup_send():
     data = request.get_json()
-    return dumps(standup_send(
+    return json_response(standup_send(
         data["token"], int(data["channel_id"]), data["message"]
     ))
 
 @APP.route("/admin/userpermission/change", methods=["POST"])
 def route_admin_userpermission_change():
     data = request.get_json()
-    return dumps(admin_userpermission_change(
+    return json_response(admin_userpermission_change(
         data["token"], int(data["u_id"]), int(data["permission_id"])
     ))
 
 @APP.route("/admin/user/remove", methods=["DELETE"])
 def route_admin_user_remove():
     data = request.args
-    return dumps(admin_user_remove(data["token"], int(data["u_id"])))
+    return json_response(admin_user_remove(data["token"], int(data["u_id"])))
+
+@APP.route("/admin/photos/usage", methods=["GET"])
+def route_admin_photos_usage():
+    data = request.args
+    return json_response(admin_photos_usage(data["token"]))
 
 @APP.route("/workspace/reset", methods=["POST"])
 def route_workspace_reset():
-    return dumps(workspace_reset())
+    return json_response(workspace_reset())
 
 #####################################################################
 #####################################################################
 
 def data_reload():
     """
-    Load pickled databases.
+    Load the databases from the storage backend, then reschedule the
+    jobs that were pending when they were saved, and the delivery of any
+    queued message that has no job.
     """
-    AUTH_DATABASE.update(get_database(AUTH_DB_PATH))
-    CHANNELS_DATABASE.update(get_database(CHANNELS_DB_PATH))
-    MESSAGES_DATABASE.update(get_database(MESSAGES_DB_PATH))
+    STORAGE.load()
+    SCHEDULER.reload()
+    requeue_sendlater()
 
 def data_save():
     """
-    Pickle dump all databases.
+    Save all databases to the storage backend.
     """
-    update_database(AUTH_DB_PATH, AUTH_DATABASE.get())
-    update_database(CHANNELS_DB_PATH, CHANNELS_DATABASE.get())
-    update_database(MESSAGES_DB_PATH, MESSAGES_DATABASE.get())
+    STORAGE.save()
 
-def data_save_regularly():
+def data_compact():
     """
-    Save data every 30 seconds.
+    Let the storage backend fold the changes made since the last compaction
+    into its saved copy of the databases.
     """
-    while True:
-        time.sleep(SAVE_INTERVAL)
-        data_save()
+    STORAGE.compact()
+
+def data_housekeeping():
+    """
+    Compact the journal into a snapshot and remove stored photos that
+    nobody uses any more. A task that fails is logged and tried again next
+    time, and does not stop the other.
+    """
+    for task in (data_compact, collect_photos):
+        try:
+            task()
+        except Exception:
+            ## eg. the disk is full, or another worker removed a photo
+            ## first; the changes stay in the journal (or the SQLite
+            ## database) until a later compaction succeeds
+            traceback.print_exc()
+
+def data_save_regularly(stop=None):
+    """
+    Run data_housekeeping() every SAVE_INTERVAL seconds.
+
+    Args:
+        stop (threading.Event): Stops the loop once set, or None to run
+            until the server stops.
+    """
+    stop = threading.Event() if stop is None else stop
+    while not stop.wait(SAVE_INTERVAL):
+        data_housekeeping()
 
 #####################################################################
 #####################################################################
@@ -378,8 +579,14 @@ if __name__ == "__main__":
         ## reload persisted data on server start
         data_reload()
     except FileNotFoundError:
-        ## pickled files don't exist, so initialise them
+        ## nothing has been saved yet, so save everything
         data_save()
+    else:
+        ## fold any replayed changes into the saved copy
+        STORAGE.checkpoint()
+
+    ## persist every change from here on
+    STORAGE.open()
 
     ## save port settings
     PORT = int(sys.argv[1]) if len(sys.argv) == 2 else 8080
@@ -390,7 +597,7 @@ if __name__ == "__main__":
     )
     FILE.close()
 
-    ## start a daemon thread to pickle data every 30 seconds
+    ## start a daemon thread to compact the journal every 30 seconds
     TIMER = threading.Thread(target=data_save_regularly, daemon=True)
     TIMER.start()
 
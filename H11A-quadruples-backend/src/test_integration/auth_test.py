@@ -8,6 +8,7 @@ from error import InputError, AccessError
 from funcs.auth import auth_login, auth_logout, auth_register
 from funcs.user import user_profile
 from funcs.other import workspace_reset
+from database.indexes import is_token_valid, remove_user_tokens
 from helpers.registers import user1, user2
 
 ####################################################################
@@ -90,6 +91,42 @@ def test_auth_logout():
     assert auth_logout(user1_token)["is_success"]
     assert auth_logout(user2_token)["is_success"]
 
+def test_auth_logout_one_session():
+    """
+    A test for the auth_logout() function to check that logging out of one
+    session does not invalidate the user's other sessions.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    login_token = auth_login("bob.ross@unsw.edu.au", "pword123")["token"]
+    assert auth_logout(user1_token)["is_success"]
+    ## The logged out token can no longer be used
+    with pytest.raises(AccessError):
+        user_profile(user1_token, user1_id)
+    with pytest.raises(AccessError):
+        auth_logout(user1_token)
+    ## The other session is still logged in
+    assert user_profile(login_token, user1_id)["user"]["u_id"] == user1_id
+
+def test_remove_user_tokens():
+    """
+    A test that remove_user_tokens() logs a user out of every session and
+    leaves other users' sessions logged in.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    user2_id, user2_token = user2()
+    login_tokens = [auth_login("bob.ross@unsw.edu.au", "pword123")["token"] for _ in range(3)]
+    remove_user_tokens(user1_id)
+    for token in [user1_token] + login_tokens:
+        assert not is_token_valid(token)
+    assert user_profile(user2_token, user2_id)["user"]["u_id"] == user2_id
+    ## A new session is indexed like any other
+    login_token = auth_login("bob.ross@unsw.edu.au", "pword123")["token"]
+    assert user_profile(login_token, user1_id)["user"]["u_id"] == user1_id
+    remove_user_tokens(user1_id)
+    assert not is_token_valid(login_token)
+
 
 ####################################################################
 ##                     Testing auth_register                      ##
@@ -0,0 +1,79 @@
+"""
+Integration tests for the storage backends (backends.py).
+H11A-quadruples, April 2020.
+"""
+
+import multiprocessing
+import os
+import signal
+import sqlite3
+from funcs.message import message_send
+from funcs.other import workspace_reset
+from database.backends import get_backend, SQLITE_DB_PATH
+from database.database import MESSAGES_DATABASE
+from database.journal import JOURNAL
+from helpers.registers import user1, chan1
+
+def send_and_die(token, channel_id, sent):
+    """
+    Run in a forked process: send a message that the SQLite writer never
+    gets to write, then get killed.
+    """
+    storage = get_backend("sqlite")
+    storage.load()
+    storage.open()
+    ## The writer waits for the connection, so nothing queued is written
+    storage.connect()
+    with storage._connection_lock:
+        message_send(token, channel_id, "not yet written")
+        sent.set()
+        os.kill(os.getpid(), signal.SIGKILL)
+
+####################################################################
+##                    Testing SqliteBackend                       ##
+####################################################################
+
+def test_sqlite_keeps_queued_changes_after_kill():
+    """
+    A test that a change the SQLite writer had not written when the
+    process was killed is loaded from the journal.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    get_backend("sqlite").save()
+    context = multiprocessing.get_context("fork")
+    sent = context.Event()
+    killed = context.Process(target=send_and_die, args=(user1_token, ch1, sent))
+    killed.start()
+    killed.join(timeout=30)
+    try:
+        assert sent.is_set()
+        assert killed.exitcode == -signal.SIGKILL
+        connection = sqlite3.connect(SQLITE_DB_PATH)
+        try:
+            assert connection.execute("SELECT COUNT(*) FROM messages").fetchone() == (0,)
+        finally:
+            connection.close()
+
+        workspace_reset()
+        storage = get_backend("sqlite")
+        storage.load()
+        messages = MESSAGES_DATABASE.get()["messages"]
+        assert [message["message"] for message in messages] == ["not yet written"]
+        ## The checkpoint writes the replayed change to SQLite
+        storage.checkpoint()
+        connection = sqlite3.connect(SQLITE_DB_PATH)
+        try:
+            assert connection.execute("SELECT COUNT(*) FROM messages").fetchone() == (1,)
+        finally:
+            connection.close()
+        storage.open()
+        storage.close()
+    finally:
+        ## Leave nothing of the SQLite database or its journal for later tests
+        workspace_reset()
+        JOURNAL.truncate()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(SQLITE_DB_PATH + suffix):
+                os.remove(SQLITE_DB_PATH + suffix)
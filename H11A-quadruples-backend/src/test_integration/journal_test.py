@@ -0,0 +1,66 @@
+"""
+Integration tests for the journal (journal.py).
+H11A-quadruples, April 2020.
+"""
+
+import os
+from funcs.other import workspace_reset
+from database.database import MESSAGES_DATABASE
+from database.journal import Journal, apply_entry, replay, JOURNAL_PATH
+
+def test_apply_entry_removals_keep_order():
+    """
+    A test that replaying many deletes and discards, enough for the
+    positions to be reset part way, removes exactly those rows and values
+    and keeps the rest in the order they were added.
+    """
+    workspace_reset()
+    tables = {}
+    for number in range(300):
+        apply_entry(("put", "messages", "test_rows", "row_id", {"row_id": number}), tables)
+        apply_entry(("add", "messages", "test_values", number), tables)
+    removed = set(range(0, 300, 3)) | set(range(250, 120, -1))
+    for number in sorted(removed, key=lambda number: (number % 7, number)):
+        apply_entry(("delete", "messages", "test_rows", "row_id", number), tables)
+        apply_entry(("discard", "messages", "test_values", number), tables)
+    ## A row that is put again goes on the end
+    apply_entry(("put", "messages", "test_rows", "row_id", {"row_id": 3}), tables)
+    apply_entry(("delete", "messages", "test_rows", "row_id", 1000), tables)
+    apply_entry(("discard", "messages", "test_values", 1000), tables)
+    try:
+        kept = [number for number in range(300) if number not in removed]
+        messages_data = MESSAGES_DATABASE.get()
+        assert [row["row_id"] for row in messages_data["test_rows"]] == kept + [3]
+        assert messages_data["test_values"] == kept
+    finally:
+        workspace_reset()
+
+def test_journal_fsync_option():
+    """
+    A test that a journal with fsync set fsyncs each record once, a group
+    included, and that its records replay.
+    """
+    workspace_reset()
+    path = os.path.join(os.path.dirname(JOURNAL_PATH), "test_journal.log")
+    journal = Journal(path, fsync=True)
+    synced = []
+    fsync = os.fsync
+    def counting_fsync(descriptor):
+        synced.append(descriptor)
+        fsync(descriptor)
+    os.fsync = counting_fsync
+    try:
+        journal.open()
+        journal.record("base", "add", "messages", "test_values", 1)
+        with journal.group():
+            journal.record("base", "add", "messages", "test_values", 2)
+            journal.record("base", "add", "messages", "test_values", 3)
+        journal.close()
+        assert len(synced) == 2
+        assert replay(path) == 2
+        assert MESSAGES_DATABASE.get()["test_values"] == [1, 2, 3]
+    finally:
+        os.fsync = fsync
+        if os.path.exists(path):
+            os.remove(path)
+        workspace_reset()
@@ -4,9 +4,11 @@ H11A-quadruples, April 2020.
 """
 
 from datetime import datetime, timezone
+import threading
 import time
 import pytest
 from error import InputError, AccessError
+from funcs.auth import auth_register
 from funcs.message import (
     message_send,
     message_sendlater,
@@ -15,12 +17,36 @@ from funcs.message import (
     message_pin,
     message_unpin,
     message_remove,
-    message_edit
+    message_edit,
+    deliver_sendlater_batch,
+    requeue_sendlater
 )
 from funcs.channel import channel_messages, channel_join
 from funcs.other import workspace_reset
+from database.scheduler import SCHEDULER
+from database.indexes import QUEUED, QUEUED_IDS
 from helpers.registers import user1, user2, chan1, chan2
 
+## Arguments of the jobs that flaky_job() has run
+FLAKY_RUNS = []
+
+def flaky_job(number):
+    """
+    A scheduled job that fails for the number 2.
+    """
+    if number == 2:
+        raise ValueError("flaky_job failed")
+    FLAKY_RUNS.append(number)
+
+def flaky_batch(jobs):
+    """
+    Run several flaky_job() jobs, giving up at the first that fails.
+    """
+    for number, in jobs:
+        flaky_job(number)
+
+SCHEDULER.register(flaky_job, batch=flaky_batch)
+
 ####################################################################
 ##                     Testing message_send                       ##
 ####################################################################
@@ -99,6 +125,69 @@ def test_message_sendlater_valid():
     time.sleep(5.5)
     assert channel_messages(user1_token, ch1, 0)["messages"][0]["message_id"] == m_id
 
+def test_message_sendlater_batch():
+    """
+    A test for delivering several queued messages at once, in the order
+    they fell due, and removing just those from the queue.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    now = datetime.utcnow()
+    time_now = int(now.replace(tzinfo=timezone.utc).timestamp())
+    m_ids = [
+        message_sendlater(user1_token, ch1, f"message {i}", time_now + 60)["message_id"]
+        for i in range(5)
+    ]
+    deliver_sendlater_batch([[m_ids[3]], [m_ids[1]]])
+    assert [message["message_id"] for message in
+            channel_messages(user1_token, ch1, 0)["messages"]] == [m_ids[1], m_ids[3]]
+    assert sorted(QUEUED.keys()) == [m_ids[0], m_ids[2], m_ids[4]]
+    assert m_ids[1] not in QUEUED_IDS and m_ids[2] in QUEUED_IDS
+
+    ## Delivering a message again does nothing
+    deliver_sendlater_batch([[m_ids[1]]])
+    assert len(channel_messages(user1_token, ch1, 0)["messages"]) == 2
+
+def test_message_sendlater_requeue():
+    """
+    A test for requeue_sendlater() scheduling a queued message whose job
+    was lost.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    now = datetime.utcnow()
+    time_now = int(now.replace(tzinfo=timezone.utc).timestamp())
+    m_id = message_sendlater(user1_token, ch1, "hello", time_now + 1)["message_id"]
+    SCHEDULER.clear()
+    requeue_sendlater()
+    ## A message that already has a job is not scheduled twice
+    requeue_sendlater()
+    assert SCHEDULER.pending() == 1
+
+    time.sleep(2.5)
+    assert channel_messages(user1_token, ch1, 0)["messages"][0]["message_id"] == m_id
+    assert m_id not in QUEUED
+
+def test_scheduler_failed_batch():
+    """
+    A test that when a batch of scheduled jobs fails part way, the jobs
+    that ran are finished and the one that failed is kept to try again.
+    """
+    workspace_reset()
+    FLAKY_RUNS.clear()
+    for number in range(4):
+        SCHEDULER.schedule(time.time(), flaky_job, number)
+    for _ in range(50):
+        if set(FLAKY_RUNS) == {0, 1, 3}:
+            break
+        time.sleep(0.1)
+    assert set(FLAKY_RUNS) == {0, 1, 3}
+    assert SCHEDULER.jobs(flaky_job) == [[2]]
+    assert SCHEDULER.pending() == 1
+    SCHEDULER.clear()
+
 def test_message_sendlater_input_errors():
     """
     A test for the message_sendlater() function under inputs that should
@@ -488,6 +577,37 @@ def test_message_remove_valid_input():
     ## Check that the message was removed
     assert channel_messages(user1_token, ch1, 0)["messages"] == []
 
+def test_message_remove_many():
+    """
+    A test for the message_remove() function removing enough messages from
+    the middle of two channels that the rest keep their order.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    ch2 = chan2(user1_token)
+    m_ids = {ch1: [], ch2: []}
+    for i in range(200):
+        for channel_id in (ch1, ch2):
+            m_ids[channel_id].append(
+                message_send(user1_token, channel_id, f"message {i}")["message_id"]
+            )
+    ## Remove every third message of ch1 and every other message of ch2
+    for m_id in m_ids[ch1][::3] + m_ids[ch2][::2]:
+        message_remove(user1_token, m_id)
+    del m_ids[ch1][::3]
+    del m_ids[ch2][::2]
+
+    ## Each channel's remaining messages are still from most to least recent
+    for channel_id, expected in m_ids.items():
+        sent = []
+        start = 0
+        while start != -1:
+            page = channel_messages(user1_token, channel_id, start)
+            sent += [message["message_id"] for message in page["messages"]]
+            start = page["end"]
+        assert sent == expected[::-1]
+
 def test_message_remove_input_error():
     """
     A test for the message_remove() function to check that an InputError
@@ -622,3 +742,54 @@ def test_message_access_error():
         message_remove(invalid_token, m_id)
     with pytest.raises(AccessError):
         message_edit(invalid_token, m_id, "Hello guys")
+
+
+####################################################################
+##                  Testing concurrent clients                    ##
+####################################################################
+
+def test_message_concurrent_clients():
+    """
+    A test that 64 clients sending and reacting at the same time do not lose
+    each other's messages or reacts.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    m_id = message_send(user1_token, ch1, "React to me")["message_id"]
+    tokens = []
+    for client in range(64):
+        token = auth_register(
+            f"client{client}@unsw.edu.au", "password123", "Client", f"Number{client}"
+        )["token"]
+        channel_join(token, ch1)
+        tokens.append(token)
+
+    ## Start every client at once so that their requests interleave
+    barrier = threading.Barrier(len(tokens))
+    sent = []
+    def client(token):
+        barrier.wait()
+        message_react(token, m_id, 1)
+        for number in range(20):
+            sent.append(message_send(token, ch1, f"message {number}")["message_id"])
+    threads = [threading.Thread(target=client, args=[token]) for token in tokens]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ## Every message was given its own id and is in the channel
+    assert len(set(sent)) == 64 * 20
+    received = []
+    start = 0
+    while start != -1:
+        page = channel_messages(user1_token, ch1, start)
+        received.extend(message["message_id"] for message in page["messages"])
+        start = page["end"]
+    assert set(sent) | {m_id} == set(received)
+
+    ## Every client's react was kept
+    message = [message for message in channel_messages(user1_token, ch1, len(sent))["messages"]
+               if message["message_id"] == m_id][0]
+    assert len(message["reacts"][0]["u_ids"]) == 64
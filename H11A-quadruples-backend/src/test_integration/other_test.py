@@ -4,15 +4,24 @@ H11A-quadruples, April 2020.
 """
 
 from datetime import datetime, timezone
+import json
+import threading
 import time
 import pytest
 from error import InputError, AccessError
+from funcs.auth import auth_login
 from funcs.channels import channels_listall
 from funcs.other import (
     users_all,
+    users_all_encoded,
     search,
+    search_matches,
+    SEARCH_CHUNK,
+    channel_changes,
+    channel_events,
     standup_start,
     standup_active,
+    standup_wait,
     standup_send,
     admin_userpermission_change,
     admin_user_remove,
@@ -24,7 +33,14 @@ from funcs.user import (
     user_profile_sethandle
 )
 from funcs.channel import channel_messages, channel_leave, channel_join, channel_details
-from funcs.message import message_send, message_remove, message_edit
+from funcs.message import (
+    message_send,
+    message_remove,
+    message_edit,
+    message_react,
+    message_pin
+)
+from database.indexes import MESSAGES, TIMELINES, SEARCH
 from helpers.registers import user1, user2, user3, chan1, chan2, chan3
 from port_settings import BASE_URL
 
@@ -165,6 +181,30 @@ def test_users_all_other():
         ]
     }
 
+def test_users_all_encoded():
+    """
+    A test for users_all_encoded(): its body matches users_all(), and its
+    ETag only changes when a user does.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    user2_id, user2_token = user2()
+    body, etag = users_all_encoded(user1_token)
+    assert json.loads(body) == users_all(user1_token)
+    assert users_all_encoded(user2_token) == (body, etag)
+
+    user_profile_setname(user1_token, "Ross", "Bob")
+    new_body, new_etag = users_all_encoded(user1_token)
+    assert new_etag != etag
+    assert json.loads(new_body) == users_all(user1_token)
+
+    admin_user_remove(user1_token, user2_id)
+    users = json.loads(users_all_encoded(user1_token)[0])["users"]
+    assert [user["u_id"] for user in users] == [user1_id]
+
+    with pytest.raises(AccessError):
+        users_all_encoded("invalid token")
+
 
 ####################################################################
 ##                         Testing search                         ##
@@ -467,6 +507,243 @@ def test_search_empty():
     assert search(user3_token, "user1") == {"messages": []}
     assert search(user3_token, "user2") == {"messages": []}
 
+def test_search_substring():
+    """
+    A test for the search() function where query_str is part of a word,
+    spans several words, or is shorter than three characters.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    _, user3_token = user3()
+    ch1, ch2, ch3 = chan1(user1_token), chan2(user2_token), chan3(user3_token)
+    msg1, msg2, _, _, _, _ = messages(
+        user1_token, user2_token, user3_token,
+        ch1, ch2, ch3
+    )
+    ## Query spanning two words
+    result = search(user1_token, "1 CHAN1 m")["messages"]
+    assert [message["message_id"] for message in result] == [msg2, msg1]
+    ## Query inside a word
+    result = search(user1_token, "sage2")["messages"]
+    assert [message["message_id"] for message in result] == [msg2]
+    ## Queries shorter than three characters
+    result = search(user1_token, "e2")["messages"]
+    assert [message["message_id"] for message in result] == [msg2]
+    assert len(search(user1_token, "")["messages"]) == 2
+
+def test_search_limit():
+    """
+    A test for the search() function when results are requested a page at a time.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    _, user3_token = user3()
+    ch1, ch2, ch3 = chan1(user1_token), chan2(user2_token), chan3(user3_token)
+    msg1, msg2, _, _, _, _ = messages(
+        user1_token, user2_token, user3_token,
+        ch1, ch2, ch3
+    )
+    page1 = search(user1_token, "message", 1)
+    assert [message["message_id"] for message in page1["messages"]] == [msg2]
+    page2 = search(user1_token, "message", 1, page1["next_cursor"])
+    assert [message["message_id"] for message in page2["messages"]] == [msg1]
+    assert page2["next_cursor"] is None
+    ## Invalid limits and cursors
+    with pytest.raises(InputError):
+        search(user1_token, "message", 0)
+    with pytest.raises(InputError):
+        search(user1_token, "message", 1, "not a cursor")
+
+
+def test_search_cursor_after_rebuild():
+    """
+    A test for the search() function: a cursor still continues from the
+    same message after the indexes have been rebuilt (eg. by a reload).
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    _, user3_token = user3()
+    ch1, ch2, ch3 = chan1(user1_token), chan2(user2_token), chan3(user3_token)
+    msg1, msg2, _, _, _, _ = messages(
+        user1_token, user2_token, user3_token,
+        ch1, ch2, ch3
+    )
+    msg3 = message_send(user1_token, ch1, "user1 chan1 message3")["message_id"]
+    page1 = search(user1_token, "message", 1)
+    assert [message["message_id"] for message in page1["messages"]] == [msg3]
+    for index in (MESSAGES, TIMELINES, SEARCH):
+        index.rebuild()
+    page2 = search(user1_token, "message", 2, page1["next_cursor"])
+    assert [message["message_id"] for message in page2["messages"]] == [msg2, msg1]
+
+def test_search_stream_remove():
+    """
+    A test for the search_matches() function when a match is removed while
+    the results are being sent.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    _, user3_token = user3()
+    ch1, ch2, ch3 = chan1(user1_token), chan2(user2_token), chan3(user3_token)
+    msg1, msg2, _, _, _, _ = messages(
+        user1_token, user2_token, user3_token,
+        ch1, ch2, ch3
+    )
+    msg3 = message_send(user1_token, ch1, "user1 chan1 message3")["message_id"]
+    matches = search_matches(user1_token, "message")
+    assert next(matches)[1]["message_id"] == msg3
+    message_remove(user1_token, msg2)
+    assert [message["message_id"] for _, message in matches] == [msg1]
+
+def test_search_stream_chunks():
+    """
+    A test for the search_matches() function over more candidates than it
+    reads at a time: the user's channels are merged in order across every
+    chunk, cursors carry on across chunks, and messages can be sent while
+    the results are being read.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    ch1, ch2 = chan1(user1_token), chan2(user2_token)
+    channel_join(user1_token, ch2)
+    sent = {
+        message_send(user1_token, (ch1, ch2)[number % 2], f"hello {number}")["message_id"]
+        for number in range(SEARCH_CHUNK + 50)
+    }
+    ## Too short to narrow the search, and narrowed to too many to sort
+    for query in ("he", "hello"):
+        found = list(search_matches(user1_token, query))
+        assert {message["message_id"] for _, message in found} == sent
+        keys = [(message["time_created"], message["message_id"]) for _, message in found]
+        assert keys == sorted(keys, reverse=True)
+
+        ## Paging carries on from the same message
+        page1 = search(user1_token, query, SEARCH_CHUNK + 10)
+        page2 = search(user1_token, query, SEARCH_CHUNK, page1["next_cursor"])
+        assert page1["messages"] + page2["messages"] == [message for _, message in found]
+        assert page2["next_cursor"] is None
+
+    ## The lock is not held between results
+    matches = search_matches(user1_token, "he")
+    next(matches)
+    sender = threading.Thread(target=message_send, args=(user1_token, ch1, "hello again"))
+    sender.start()
+    sender.join(timeout=10)
+    assert not sender.is_alive()
+    assert len(list(matches)) == len(sent) - 1
+
+
+####################################################################
+##                     Testing channel_changes                    ##
+####################################################################
+
+def test_channel_changes():
+    """
+    A test for the channel_changes() function as messages are sent,
+    changed and removed.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    msg1 = message_send(user1_token, ch1, "message1")["message_id"]
+    msg2 = message_send(user1_token, ch1, "message2")["message_id"]
+    changes = channel_changes(user1_token, ch1, 0)
+    assert [message["message_id"] for message in changes["messages"]] == [msg1, msg2]
+    assert changes["removed"] == []
+    assert not changes["reset"]
+
+    ## Only the messages changed since the last call are sent, once each
+    seq = changes["seq"]
+    message_react(user1_token, msg1, 1)
+    message_pin(user1_token, msg2)
+    message_edit(user1_token, msg2, "edited")
+    message_remove(user1_token, msg1)
+    changes = channel_changes(user1_token, ch1, seq)
+    epoch, number = seq.split(":")
+    assert changes["seq"] == f"{epoch}:{int(number) + 4}"
+    assert [message["message_id"] for message in changes["messages"]] == [msg2]
+    assert changes["messages"][0]["message"] == "edited"
+    assert changes["messages"][0]["is_pinned"]
+    assert changes["removed"] == [msg1]
+
+    ## Nothing has changed since
+    changes = channel_changes(user1_token, ch1, changes["seq"])
+    assert changes["messages"] == [] and changes["removed"] == []
+
+def test_channel_changes_reset():
+    """
+    A test for the channel_changes() function when the changes since since
+    cannot be known.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    message_send(user1_token, ch1, "message1")
+    seq = channel_changes(user1_token, ch1, 0)["seq"]
+    ## since is from before the workspace was reset
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+    assert channel_changes(user1_token, ch1, seq)["reset"]
+    ## The channel's numbers start again, but not its epoch
+    message_send(user1_token, ch1, "message1")
+    message_send(user1_token, ch1, "message2")
+    changes = channel_changes(user1_token, ch1, seq)
+    assert changes["reset"]
+    assert changes["seq"] != seq
+
+def test_channel_changes_invalid():
+    """
+    A test for the channel_changes() function under invalid input.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    ch1 = chan1(user1_token)
+    with pytest.raises(AccessError):
+        channel_changes("invalid token", ch1, 0)
+    with pytest.raises(AccessError):
+        channel_changes(user2_token, ch1, 0)
+    with pytest.raises(InputError):
+        channel_changes(user1_token, ch1 + 1, 0)
+    with pytest.raises(InputError):
+        channel_changes(user1_token, ch1, -1)
+    with pytest.raises(InputError):
+        channel_changes(user1_token, ch1, "1")
+    with pytest.raises(InputError):
+        channel_changes(user1_token, ch1, "epoch:-1")
+
+def test_channel_events():
+    """
+    A test for the channel_events() function: changes made while the client
+    is not reading are sent together in the next event.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    ch1 = chan1(user1_token)
+    msg1 = message_send(user1_token, ch1, "message1")["message_id"]
+    events = channel_events(user1_token, ch1, 0)
+    event, changes = next(events)
+    assert event == "changes"
+    assert [message["message_id"] for message in changes["messages"]] == [msg1]
+
+    msg2 = message_send(user1_token, ch1, "message2")["message_id"]
+    message_remove(user1_token, msg1)
+    event, changes = next(events)
+    assert event == "changes"
+    assert [message["message_id"] for message in changes["messages"]] == [msg2]
+    assert changes["removed"] == [msg1]
+
+    ## Only members can follow a channel
+    with pytest.raises(AccessError):
+        channel_events(user2_token, ch1)
+
 
 ####################################################################
 ##                   Testing standup functions                    ##
@@ -535,6 +812,38 @@ steve: user3 msg1\n"""
         "end": -1
     }
 
+def test_standup_wait():
+    """
+    A test for the standup_wait() function waiting for a standup to end.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    ch1 = chan1(user1_token)
+
+    ## No standup has been run in the channel
+    assert standup_wait(user1_token, ch1, 1) == {
+        "is_active": False,
+        "time_finish": None,
+        "message_id": None
+    }
+
+    time_finish = standup_start(user1_token, ch1, 2)["time_finish"]
+    standup_send(user1_token, ch1, "user1 msg1")
+    ## The standup is still active when timeout passes
+    assert standup_wait(user1_token, ch1, 0.1) == {
+        "is_active": True,
+        "time_finish": time_finish,
+        "message_id": None
+    }
+
+    ## Returns as soon as the summary message has been sent
+    result = standup_wait(user1_token, ch1, 10)
+    assert not result["is_active"]
+    assert result["time_finish"] == time_finish
+    messages = channel_messages(user1_token, ch1, 0)["messages"]
+    assert messages[0]["message_id"] == result["message_id"]
+    assert messages[0]["message"] == "bob: user1 msg1\n"
+
 def test_standup_start_invalid():
     """
     A test for the standup_start() function under invalid inputs.
@@ -563,6 +872,28 @@ def test_standup_active_invalid():
     with pytest.raises(InputError):
         standup_active(user1_token, 1) ## 1 isn"t a valid id
 
+def test_standup_wait_invalid():
+    """
+    A test for the standup_wait() function under invalid inputs.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+
+    ## Channel does not exist
+    with pytest.raises(InputError):
+        standup_wait(user1_token, 1, 1)
+
+    ## Negative timeout
+    ch1 = chan1(user1_token)
+    with pytest.raises(InputError):
+        standup_wait(user1_token, ch1, -1)
+
+    ## Timeouts that are not finite
+    with pytest.raises(InputError):
+        standup_wait(user1_token, ch1, float("nan"))
+    with pytest.raises(InputError):
+        standup_wait(user1_token, ch1, float("inf"))
+
 def test_standup_send_invalid():
     """
     A test for the standup_send() function under invalid inputs.
@@ -682,6 +1013,25 @@ def test_admin_user_remove_valid():
     all_users = users_all(user1_token)["users"]
     assert all(user["u_id"] != user2_id for user in all_users)
 
+def test_admin_user_remove_tokens():
+    """
+    A test for the admin_user_remove() function to check that every active
+    token of the removed user is invalidated.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    user2_id, user2_token = user2()
+    login_token = auth_login("elon.musk@unsw.edu.au", "pword456")["token"]
+
+    admin_user_remove(user1_token, user2_id)
+
+    ## Neither of user2's sessions can be used
+    with pytest.raises(AccessError):
+        users_all(user2_token)
+    with pytest.raises(AccessError):
+        users_all(login_token)
+    assert users_all(user1_token)["users"]
+
 def test_admin_user_remove_invalid_input():
     """
     A test for the admin_user_remove() function under invalid inputs.
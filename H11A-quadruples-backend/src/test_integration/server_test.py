@@ -0,0 +1,79 @@
+"""
+Integration tests for the housekeeping and routes of server.py.
+H11A-quadruples, April 2020.
+"""
+
+import threading
+import time
+import server
+from funcs.message import message_send
+from funcs.other import workspace_reset
+from helpers.registers import user1, user2, chan1
+
+def test_data_save_regularly_survives_failures():
+    """
+    A test that the saver thread keeps compacting after collect_photos()
+    raises an error that is not an OSError.
+    """
+    calls = {"compact": 0, "collect": 0}
+
+    def compact():
+        calls["compact"] += 1
+
+    def collect():
+        calls["collect"] += 1
+        raise ValueError("collect_photos failed")
+
+    saved = server.SAVE_INTERVAL, server.data_compact, server.collect_photos
+    server.SAVE_INTERVAL, server.data_compact, server.collect_photos = 0.01, compact, collect
+    stop = threading.Event()
+    saver = threading.Thread(target=server.data_save_regularly, args=(stop,), daemon=True)
+    saver.start()
+    try:
+        for _ in range(100):
+            if calls["compact"] >= 3:
+                break
+            time.sleep(0.05)
+        assert saver.is_alive()
+        assert calls["compact"] >= 3
+        assert calls["collect"] >= 2
+    finally:
+        stop.set()
+        saver.join(timeout=5)
+        server.SAVE_INTERVAL, server.data_compact, server.collect_photos = saved
+    assert not saver.is_alive()
+
+def test_channel_messages_route():
+    """
+    A test that the channel/messages route pages a channel's messages from
+    most to least recent, and refuses a start past the oldest message and
+    users who are not members.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    _, user2_token = user2()
+    ch1 = chan1(user1_token)
+    m_ids = [
+        message_send(user1_token, ch1, f"message {number}")["message_id"] for number in range(52)
+    ]
+    client = server.APP.test_client()
+
+    page = client.get("/channel/messages", query_string={
+        "token": user1_token, "channel_id": ch1, "start": 0
+    }).get_json()
+    assert page["start"] == 0
+    assert page["end"] == 50
+    assert [message["message_id"] for message in page["messages"]] == m_ids[::-1][:50]
+
+    page = client.get("/channel/messages", query_string={
+        "token": user1_token, "channel_id": ch1, "start": 50
+    }).get_json()
+    assert page["end"] == -1
+    assert [message["message_id"] for message in page["messages"]] == [m_ids[1], m_ids[0]]
+
+    assert client.get("/channel/messages", query_string={
+        "token": user1_token, "channel_id": ch1, "start": 53
+    }).status_code != 200
+    assert client.get("/channel/messages", query_string={
+        "token": user2_token, "channel_id": ch1, "start": 0
+    }).status_code != 200
@@ -0,0 +1,370 @@
+"""
+Integration tests for the functions implemented in user_profile_uploadphoto.py.
+H11A-quadruples, April 2020.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import os
+import threading
+import time
+import pytest
+from PIL import Image
+from error import InputError, AccessError
+from funcs.user import user_profile
+from funcs import user_profile_uploadphoto as uploadphoto
+from funcs.user_profile_uploadphoto import (
+    user_profile_uploadphoto,
+    read_header,
+    admin_photos_usage,
+    collect_photos,
+    photo_code,
+    PHOTO_GRACE,
+    MAX_DOWNLOAD_BYTES,
+    MAX_PHOTO_PIXELS
+)
+from funcs.other import workspace_reset
+from helpers.registers import user1, user2
+from constants import PFP_FOLDER
+
+## Images served to the uploads by path: the status, content type and body
+IMAGES = {}
+## Paths whose body is sent a few bytes at a time
+TRICKLED = set()
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    Serves IMAGES, standing in for an image host on the Internet.
+    """
+
+    def do_GET(self):
+        status, content_type, body = IMAGES.get(self.path, (404, "text/plain", b"Not found"))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            if self.path in TRICKLED:
+                for start in range(0, len(body), 16):
+                    self.wfile.write(body[start:start + 16])
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            else:
+                self.wfile.write(body)
+        except ConnectionError:
+            ## The upload gave up part way, eg. on a download that is too large
+            pass
+
+    def log_message(self, *args):
+        pass
+
+SERVER = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+threading.Thread(target=SERVER.serve_forever, daemon=True).start()
+IMAGE_URL = f"http://127.0.0.1:{SERVER.server_port}"
+
+def serve_image(path, size=(600, 400), color="red", image_format="JPEG", content_type="image/jpeg"):
+    """
+    Serve a plain image of the given size at IMAGE_URL + path.
+
+    Returns:
+        The URL (str) of the image.
+    """
+    image = BytesIO()
+    Image.new("RGB", size, color).save(image, format=image_format)
+    IMAGES[path] = (200, content_type, image.getvalue())
+    return f"{IMAGE_URL}{path}"
+
+def serve_header(path, size):
+    """
+    Serve a small JPG whose header claims that it is of the given size,
+    standing in for a huge image, which is refused before it is decoded.
+
+    Returns:
+        The URL (str) of the image.
+    """
+    image = BytesIO()
+    Image.new("RGB", (16, 16), "red").save(image, format="JPEG")
+    body = bytearray(image.getvalue())
+    ## The start of frame segment holds the height then the width, after
+    ## its marker, length and sample precision
+    frame = body.index(b"\xff\xc0")
+    body[frame + 5:frame + 9] = size[1].to_bytes(2, "big") + size[0].to_bytes(2, "big")
+    IMAGES[path] = (200, "image/jpeg", bytes(body))
+    return f"{IMAGE_URL}{path}"
+
+def wait_for_photo(token, u_id, old_url):
+    """
+    Returns:
+        The user's profile_img_url (str) once an upload has changed it.
+    """
+    for _ in range(100):
+        url = user_profile(token, u_id)["user"]["profile_img_url"]
+        if url != old_url:
+            return url
+        time.sleep(0.1)
+    raise AssertionError("profile_img_url did not change")
+
+def photo_paths(profile_img_url):
+    """
+    Returns:
+        The paths (list of str) of every file stored for a profile picture.
+    """
+    img_code = photo_code(profile_img_url)
+    return [
+        os.path.join(PFP_FOLDER, img_name)
+        for img_name in os.listdir(PFP_FOLDER)
+        if photo_code(img_name) == img_code
+    ]
+
+def age_photo(profile_img_url, seconds):
+    """
+    Make every file of a stored photo look as if it was stored seconds ago.
+    """
+    when = time.time() - seconds
+    for img_path in photo_paths(profile_img_url):
+        os.utime(img_path, (when, when))
+
+####################################################################
+##                Testing user_profile_uploadphoto                ##
+####################################################################
+
+def test_user_profile_uploadphoto_valid():
+    """
+    A test for the user_profile_uploadphoto() function under VALID inputs:
+    the profile picture changes once the photo has been stored.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    old_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    img_url = serve_image("/valid.jpg")
+    assert user_profile_uploadphoto(user1_token, img_url, 0, 0, 300, 300) == {}
+    new_url = wait_for_photo(user1_token, user1_id, old_url)
+    assert new_url.endswith(".jpg")
+    assert "/imgurl/" in new_url
+
+def test_user_profile_uploadphoto_bad_url():
+    """
+    A test that user_profile_uploadphoto() raises an InputError before
+    returning when img_url does not return a 200 HTTP status or cannot be
+    downloaded at all.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, f"{IMAGE_URL}/missing.jpg", 0, 0, 10, 10)
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, "http://127.0.0.1:1/closed.jpg", 0, 0, 10, 10)
+
+def test_user_profile_uploadphoto_not_jpg():
+    """
+    A test that user_profile_uploadphoto() raises an InputError before
+    returning when the image is not a JPG, whether the content type or the
+    content gives it away.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    IMAGES["/page.jpg"] = (200, "text/html", b"<html>Not an image</html>")
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, f"{IMAGE_URL}/page.jpg", 0, 0, 10, 10)
+    png_url = serve_image("/image.png", image_format="PNG", content_type="image/png")
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, png_url, 0, 0, 10, 10)
+    ## Served as plain bytes, so only the content shows it is a PNG
+    disguised_url = serve_image(
+        "/disguised.jpg", image_format="PNG", content_type="application/octet-stream"
+    )
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, disguised_url, 0, 0, 10, 10)
+
+def test_user_profile_uploadphoto_bounds():
+    """
+    A test that user_profile_uploadphoto() raises an InputError before
+    returning when the bounds are not within the image, which is only
+    downloaded as far as its header to check.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    old_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    img_url = serve_image("/bounds.jpg", size=(600, 400))
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, img_url, 0, 0, 601, 400)
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, img_url, 0, 0, 600, 401)
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, img_url, -1, 0, 100, 100)
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, img_url, 100, 100, 100, 200)
+    ## The whole image is within bounds
+    user_profile_uploadphoto(user1_token, img_url, 0, 0, 600, 400)
+    assert wait_for_photo(user1_token, user1_id, old_url) != old_url
+
+def test_user_profile_uploadphoto_too_large():
+    """
+    A test that user_profile_uploadphoto() raises an InputError before
+    returning when the image is larger than MAX_DOWNLOAD_BYTES.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    old_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    img_url = serve_image("/large.jpg")
+    status, content_type, body = IMAGES["/large.jpg"]
+    IMAGES["/large.jpg"] = (status, content_type, body + bytes(MAX_DOWNLOAD_BYTES))
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, img_url, 0, 0, 10, 10)
+    assert user_profile(user1_token, user1_id)["user"]["profile_img_url"] == old_url
+
+def test_user_profile_uploadphoto_too_many_pixels():
+    """
+    A test that user_profile_uploadphoto() raises an InputError before
+    returning when the image has more than MAX_PHOTO_PIXELS pixels, or so
+    many that PIL refuses to open it, without decoding the image.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    img_url = serve_header("/pixels.jpg", (MAX_PHOTO_PIXELS // 1000 + 1, 1000))
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, img_url, 0, 0, 10, 10)
+    bomb_url = serve_header("/bomb.jpg", (65000, 65000))
+    with pytest.raises(InputError):
+        user_profile_uploadphoto(user1_token, bomb_url, 0, 0, 10, 10)
+
+def test_user_profile_uploadphoto_deadline():
+    """
+    A test that user_profile_uploadphoto() gives up with an InputError once
+    DOWNLOAD_DEADLINE passes, even though the host never stops sending.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    img_url = serve_image("/trickle.jpg")
+    TRICKLED.add("/trickle.jpg")
+    deadline = uploadphoto.DOWNLOAD_DEADLINE
+    uploadphoto.DOWNLOAD_DEADLINE = 1
+    started = time.monotonic()
+    try:
+        with pytest.raises(InputError):
+            user_profile_uploadphoto(user1_token, img_url, 0, 0, 10, 10)
+    finally:
+        uploadphoto.DOWNLOAD_DEADLINE = deadline
+        TRICKLED.discard("/trickle.jpg")
+    assert time.monotonic() - started < 5
+
+def test_user_profile_uploadphoto_wait():
+    """
+    A test that user_profile_uploadphoto() stores the photo before
+    returning when asked to wait.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    old_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    img_url = serve_image("/wait.jpg", color="white")
+    user_profile_uploadphoto(user1_token, img_url, 0, 0, 300, 300, wait=True)
+    new_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    assert new_url != old_url
+    assert photo_paths(new_url)
+
+def test_read_header_many_chunks():
+    """
+    A test that read_header() parses a large header arriving a few bytes at
+    a time only a few times, rather than once per chunk.
+    """
+    image = BytesIO()
+    Image.new("RGB", (40, 30), "red").save(image, format="JPEG")
+    body = image.getvalue()
+    ## A comment segment of 60000 bytes straight after the start of image
+    comment = b"\xff\xfe" + (60002).to_bytes(2, "big") + bytes(60000)
+    body = body[:2] + comment + body[2:]
+    opens = []
+    image_open = Image.open
+    def counting_open(*args, **kwargs):
+        opens.append(args)
+        return image_open(*args, **kwargs)
+    Image.open = counting_open
+    try:
+        chunks = (body[start:start + 16] for start in range(0, len(body), 16))
+        assert read_header(BytesIO(), chunks) == (40, 30)
+    finally:
+        Image.open = image_open
+    assert len(opens) < 20
+
+def test_user_profile_uploadphoto_access_error():
+    """
+    A test that user_profile_uploadphoto() raises an AccessError when
+    passed an invalid token.
+    """
+    workspace_reset()
+    img_url = serve_image("/access.jpg")
+    with pytest.raises(AccessError):
+        user_profile_uploadphoto("invalid token", img_url, 0, 0, 10, 10)
+
+####################################################################
+##                  Testing stored photo files                    ##
+####################################################################
+
+def test_photos_shared():
+    """
+    A test that two users uploading the same photo share one set of files,
+    which admin_photos_usage() reports as one shared photo.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    user2_id, user2_token = user2()
+    old_url1 = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    old_url2 = user_profile(user2_token, user2_id)["user"]["profile_img_url"]
+    img_url = serve_image("/shared.jpg", color="green")
+    user_profile_uploadphoto(user1_token, img_url, 0, 0, 200, 200)
+    url1 = wait_for_photo(user1_token, user1_id, old_url1)
+    stored = sorted(os.listdir(PFP_FOLDER))
+    user_profile_uploadphoto(user2_token, img_url, 0, 0, 200, 200)
+    url2 = wait_for_photo(user2_token, user2_id, old_url2)
+    ## The second upload refers to the first one's files, and stores none
+    assert url1 == url2
+    assert os.path.join(PFP_FOLDER, f"{photo_code(url1)}.jpg") in photo_paths(url1)
+    assert sorted(os.listdir(PFP_FOLDER)) == stored
+    usage = admin_photos_usage(user1_token)
+    assert usage["shared_photos"] == 1
+    assert usage["referenced_photos"] >= 1
+    ## Only Slackr owners can see the report
+    with pytest.raises(AccessError):
+        admin_photos_usage(user2_token)
+    with pytest.raises(AccessError):
+        admin_photos_usage("invalid token")
+
+def test_photos_replaced_kept_during_grace():
+    """
+    A test that a photo nobody has any more is kept until it is PHOTO_GRACE
+    seconds old, eg. while another upload of it is still finishing.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    old_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    user_profile_uploadphoto(user1_token, serve_image("/first.jpg", color="blue"), 0, 0, 200, 200)
+    first_url = wait_for_photo(user1_token, user1_id, old_url)
+    user_profile_uploadphoto(user1_token, serve_image("/second.jpg", color="yellow"), 0, 0, 200, 200)
+    second_url = wait_for_photo(user1_token, user1_id, first_url)
+    assert first_url != second_url
+    ## Replacing the photo tries to collect the old one, which is too new
+    assert photo_paths(first_url)
+    age_photo(first_url, PHOTO_GRACE - 60)
+    collect_photos()
+    assert photo_paths(first_url)
+    assert photo_paths(second_url)
+
+def test_photos_collected_after_grace():
+    """
+    A test that collect_photos() removes every file of a photo nobody has
+    once it is PHOTO_GRACE seconds old, and keeps photos that are in use.
+    """
+    workspace_reset()
+    user1_id, user1_token = user1()
+    old_url = user_profile(user1_token, user1_id)["user"]["profile_img_url"]
+    user_profile_uploadphoto(user1_token, serve_image("/old.jpg", color="purple"), 0, 0, 200, 200)
+    first_url = wait_for_photo(user1_token, user1_id, old_url)
+    user_profile_uploadphoto(user1_token, serve_image("/new.jpg", color="orange"), 0, 0, 200, 200)
+    second_url = wait_for_photo(user1_token, user1_id, first_url)
+    freed = sum(os.path.getsize(img_path) for img_path in photo_paths(first_url))
+    age_photo(first_url, PHOTO_GRACE + 1)
+    ## The photo in use is just as old, but is kept
+    age_photo(second_url, PHOTO_GRACE + 1)
+    assert collect_photos() >= freed > 0
+    assert not photo_paths(first_url)
+    assert photo_paths(second_url)
@@ -0,0 +1,131 @@
+"""
+Integration tests for sharing the databases between processes (workers.py).
+H11A-quadruples, April 2020.
+"""
+
+import multiprocessing
+import time
+from funcs.channel import channel_messages
+from funcs.message import message_send
+from funcs.other import workspace_reset
+from database.backends import get_backend
+from database.workers import WORKERS
+from helpers.registers import user1, chan1, chan2
+
+MESSAGES_EACH = 20
+
+def send_and_read(token, channel_id, channel_ids, barrier, results):
+    """
+    Run in a forked worker: send messages to one channel while the other
+    worker sends to another, then read both channels.
+    """
+    WORKERS.start(get_backend("memory"))
+    for number in range(MESSAGES_EACH):
+        with WORKERS.exclusive("channels", "messages"):
+            message_send(token, channel_id, f"{channel_id} {number}")
+    barrier.wait()
+    WORKERS.catch_up()
+    results.put(sorted(
+        message["message"]
+        for other_id in channel_ids
+        for message in channel_messages(token, other_id, 0)["messages"]
+    ))
+
+def hold_table(table, held, release):
+    """
+    Run in a forked worker: hold one table until told to let it go.
+    """
+    WORKERS.start(get_backend("memory"))
+    with WORKERS.exclusive(table):
+        held.set()
+        release.wait(30)
+
+def time_table(table, ready, go, results):
+    """
+    Run in a forked worker: once told to, report how long it took to get
+    hold of a table.
+    """
+    WORKERS.start(get_backend("memory"))
+    ready.set()
+    go.wait(30)
+    started = time.time()
+    with WORKERS.exclusive(table):
+        results.put(time.time() - started)
+
+####################################################################
+##                   Testing WorkerSync                           ##
+####################################################################
+
+def test_workers_see_each_others_messages():
+    """
+    A test that two worker processes sending messages at once each see
+    every message sent by both once they have caught up.
+    """
+    workspace_reset()
+    _, user1_token = user1()
+    channel_ids = [chan1(user1_token), chan2(user1_token)]
+    storage = get_backend("memory")
+    storage.save()
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(len(channel_ids))
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=send_and_read,
+            args=(user1_token, channel_id, channel_ids, barrier, results)
+        )
+        for channel_id in channel_ids
+    ]
+    for worker in workers:
+        worker.start()
+    seen = [results.get(timeout=30) for _ in workers]
+    for worker in workers:
+        worker.join(timeout=30)
+        assert worker.exitcode == 0
+    expected = sorted(
+        f"{channel_id} {number}" for channel_id in channel_ids for number in range(MESSAGES_EACH)
+    )
+    assert seen == [expected, expected]
+    ## Leave nothing of the workers' journal behind for later tests
+    workspace_reset()
+    storage.save()
+
+def test_workers_lock_tables_separately():
+    """
+    A test that one worker changing a table does not hold up another
+    worker changing a different table, but does hold up a worker changing
+    the same table.
+    """
+    workspace_reset()
+    get_backend("memory").save()
+    context = multiprocessing.get_context("fork")
+    held, release = context.Event(), context.Event()
+    results = context.Queue()
+    ## Workers take every table while starting, so start them all first
+    timers = {}
+    for table in ("channels", "registered_users"):
+        ready, go = context.Event(), context.Event()
+        timer = context.Process(target=time_table, args=(table, ready, go, results))
+        timer.start()
+        assert ready.wait(30)
+        timers[table] = (timer, go)
+    holder = context.Process(target=hold_table, args=("registered_users", held, release))
+    holder.start()
+    try:
+        assert held.wait(30)
+        timer, go = timers["channels"]
+        go.set()
+        assert results.get(timeout=30) < 1
+        timer.join(timeout=30)
+        timer, go = timers["registered_users"]
+        go.set()
+        time.sleep(0.5)
+        release.set()
+        assert results.get(timeout=30) >= 0.5
+        timer.join(timeout=30)
+    finally:
+        release.set()
+        for timer, go in timers.values():
+            go.set()
+            timer.join(timeout=30)
+        holder.join(timeout=30)
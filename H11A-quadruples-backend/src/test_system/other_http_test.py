@@ -183,6 +183,36 @@ def test_users_all_other():
         ]
     }
 
+def test_users_all_not_modified():
+    """
+    A test for revalidating the users/all route with its ETag.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    _, user1_token = user1(PORT)
+    response = requests.get(f"{BASE_URL}/users/all", params={
+        "token": user1_token
+    })
+    etag = response.headers["ETag"]
+
+    ## Nothing has changed, so the users are not sent again
+    response = requests.get(f"{BASE_URL}/users/all", params={
+        "token": user1_token
+    }, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    requests.put(f"{BASE_URL}/user/profile/setname", json={
+        "token": user1_token,
+        "name_first": "Ross",
+        "name_last": "Bob"
+    })
+    response = requests.get(f"{BASE_URL}/users/all", params={
+        "token": user1_token
+    }, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["users"][0]["name_first"] == "Ross"
+
 def test_users_all_invalid():
     """
     A test for the users/all route under invalid input.
@@ -297,6 +327,47 @@ def test_search_empty_result():
     list_messages = result['messages']
     assert list_messages == []
 
+def test_search_paginated():
+    """
+    A test for the search route when results are requested a page at a
+    time, and when they are streamed.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    _, user1_token = user1(PORT)
+    channel_id1 = chan1(PORT, user1_token)
+    for message in ["Hello one", "Hello two", "Hello three"]:
+        requests.post(f"{BASE_URL}/message/send", json={
+            "token": user1_token,
+            "channel_id": channel_id1,
+            "message": message
+        })
+
+    ## Page through the results two at a time
+    page1 = requests.get(f"{BASE_URL}/search", params={
+        "token": user1_token,
+        "query_str": "hello",
+        "limit": 2
+    }).json()
+    assert [msg["message"] for msg in page1["messages"]] == ["Hello three", "Hello two"]
+    page2 = requests.get(f"{BASE_URL}/search", params={
+        "token": user1_token,
+        "query_str": "hello",
+        "limit": 2,
+        "cursor": page1["next_cursor"]
+    }).json()
+    assert [msg["message"] for msg in page2["messages"]] == ["Hello one"]
+    assert page2["next_cursor"] is None
+
+    ## Stream the results as newline delimited JSON
+    response = requests.get(f"{BASE_URL}/search", params={
+        "token": user1_token,
+        "query_str": "hello",
+        "stream": "true"
+    })
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    lines = [line for line in response.text.split("\n") if line]
+    assert len(lines) == 3
+
 def test_search_invalid():
     """
     A test for the search route under invalid input.
@@ -309,6 +380,122 @@ def test_search_invalid():
             "query_str": "COMP1531"
         }).raise_for_status()
 
+    ## Errors for limits that are not numbers
+    _, user1_token = user1(PORT)
+    response = requests.get(f"{BASE_URL}/search", params={
+        "token": user1_token,
+        "query_str": "COMP1531",
+        "limit": "ten"
+    })
+    assert response.status_code == 400
+
+
+####################################################################
+##                     Testing channel/changes                    ##
+####################################################################
+
+def test_channel_changes():
+    """
+    A test for the channel/changes route as messages are sent and removed.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    _, user1_token = user1(PORT)
+    ch1 = chan1(PORT, user1_token)
+    m_id = requests.post(f"{BASE_URL}/message/send", json={
+        "token": user1_token,
+        "channel_id": ch1,
+        "message": "Hello world"
+    }).json()["message_id"]
+    changes = requests.get(f"{BASE_URL}/channel/changes", params={
+        "token": user1_token,
+        "channel_id": ch1,
+        "since": 0
+    }).json()
+    assert [message["message_id"] for message in changes["messages"]] == [m_id]
+    assert not changes["reset"]
+
+    ## The removed message is sent as a tombstone
+    requests.delete(f"{BASE_URL}/message/remove", json={
+        "token": user1_token,
+        "message_id": m_id
+    })
+    changes = requests.get(f"{BASE_URL}/channel/changes", params={
+        "token": user1_token,
+        "channel_id": ch1,
+        "since": changes["seq"]
+    }).json()
+    assert changes["messages"] == []
+    assert changes["removed"] == [m_id]
+
+def test_channel_changes_invalid():
+    """
+    A test for the channel/changes route under invalid input.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    _, user1_token = user1(PORT)
+    ch1 = chan1(PORT, user1_token)
+    with pytest.raises(HTTPError):
+        requests.get(f"{BASE_URL}/channel/changes", params={
+            "token": "11111",
+            "channel_id": ch1,
+            "since": 0
+        }).raise_for_status()
+    with pytest.raises(HTTPError):
+        requests.get(f"{BASE_URL}/channel/changes", params={
+            "token": user1_token,
+            "channel_id": ch1,
+            "since": -1
+        }).raise_for_status()
+
+def test_channel_events_busy():
+    """
+    A test for the channel/events route turning streams away with a 503
+    once the server holds as many as it allows, and taking them again once
+    some are closed.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    _, user1_token = user1(PORT)
+    ch1 = chan1(PORT, user1_token)
+    params = {"token": user1_token, "channel_id": ch1}
+
+    ## Open streams until one is turned away
+    streams = []
+    for _ in range(256):
+        response = requests.get(f"{BASE_URL}/channel/events", params=params, stream=True)
+        if response.status_code != 200:
+            break
+        streams.append(response)
+    try:
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) > 0
+        assert streams
+
+        ## Standup long-polls hold a thread too, so are also turned away
+        busy = requests.get(f"{BASE_URL}/standup/active", params={
+            "token": user1_token,
+            "channel_id": ch1,
+            "wait": 1
+        })
+        assert busy.status_code == 503
+    finally:
+        for stream in streams:
+            stream.close()
+
+    ## The server finds the closed streams once it next writes to them
+    deadline = time.monotonic() + 10
+    while True:
+        requests.post(f"{BASE_URL}/message/send", json={
+            "token": user1_token,
+            "channel_id": ch1,
+            "message": "Hello"
+        })
+        response = requests.get(f"{BASE_URL}/channel/events", params=params, stream=True)
+        response.close()
+        if response.status_code == 200 or time.monotonic() > deadline:
+            break
+        time.sleep(0.2)
+    assert response.status_code == 200
+
 
 ####################################################################
 ##                       Testing standup/*                        ##
@@ -426,6 +613,34 @@ steve: user3 msg1\n"""
         "end": -1
     }
 
+def test_standup_active_wait():
+    """
+    A test for long-polling the standup/active route until a standup ends.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    _, user1_token = user1(PORT)
+    channel_id1 = chan1(PORT, user1_token)
+    time_finish = requests.post(f"{BASE_URL}/standup/start", json={
+        "token": user1_token,
+        "channel_id": channel_id1,
+        "length": 2
+    }).json()["time_finish"]
+
+    ## The request is answered once the summary message has been sent
+    response = requests.get(f"{BASE_URL}/standup/active", params={
+        "token": user1_token,
+        "channel_id": channel_id1,
+        "wait": 10
+    }).json()
+    assert not response["is_active"]
+    assert response["time_finish"] == time_finish
+    messages = requests.get(f"{BASE_URL}/channel/messages", params={
+        "token": user1_token,
+        "channel_id": channel_id1,
+        "start": 0
+    }).json()["messages"]
+    assert messages[0]["message_id"] == response["message_id"]
+
 def test_standup_start_invalid():
     """
     A test for the standup/start route under invalid inputs.
@@ -486,6 +701,15 @@ def test_standup_active_invalid():
             "channel_id": ch1
         }).raise_for_status()
 
+    ## Waits that are not a finite number of seconds
+    for wait in ["nan", "inf", "soon"]:
+        response = requests.get(f"{BASE_URL}/standup/active", params={
+            "token": user1_token,
+            "channel_id": ch1,
+            "wait": wait
+        })
+        assert response.status_code == 400
+
 def test_standup_send_invalid():
     """
     A test for the standup/send route under invalid inputs.
@@ -3,11 +3,16 @@ System tests for the user routes in server.py.
 H11A-quadruples, April 2020.
 """
 
+import os
+import time
+from io import BytesIO
 import requests
 from requests.exceptions import HTTPError
 import pytest
+from PIL import Image
 from helpers.registers_http import user1, user2, chan1
 from port_settings import PORT, BASE_URL
+from constants import PFP_FOLDER
 
 ####################################################################
 ##                      Testing user/profile                      ##
@@ -333,3 +338,83 @@ def test_user_profile_sethandle_invalid():
             "token": "11111",
             "handle_str": "bobby"
         }).raise_for_status()
+
+
+####################################################################
+##                        Testing imgurl                          ##
+####################################################################
+
+def get_default_photo(**kwargs):
+    """
+    Returns:
+        The response to a request for the default profile picture, once it
+        has been stored for the first user to register.
+    """
+    for _ in range(100):
+        response = requests.get(f"{BASE_URL}/imgurl/default.jpg", **kwargs)
+        if response.status_code != 404:
+            return response
+        time.sleep(0.1)
+    return response
+
+def test_imgurl_cached():
+    """
+    A test that the imgurl route lets clients cache photos, and sends a
+    304 with no body when the client's copy is still current.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    user1(PORT)
+    response = get_default_photo()
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "image/jpeg"
+    assert response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+    assert "public" in response.headers["Cache-Control"]
+    assert "max-age" in response.headers["Cache-Control"]
+    assert "Accept" in response.headers["Vary"]
+
+    ## The client's copy matches, by ETag or by date
+    cached = get_default_photo(headers={"If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert cached.headers["ETag"] == response.headers["ETag"]
+    cached = get_default_photo(headers={"If-Modified-Since": response.headers["Last-Modified"]})
+    assert cached.status_code == 304
+
+    ## The client's copy is out of date
+    changed = get_default_photo(headers={"If-None-Match": '"0123456789abcdef"'})
+    assert changed.status_code == 200
+    assert changed.content == response.content
+
+def test_imgurl_not_found():
+    """
+    A test that the imgurl route gives a 404 for a name that is not a
+    stored photo, without looking outside the photos folder.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    user1(PORT)
+    for img_name in ["..", "%2e%2e", "server.py", "default", "default.png", "0" * 20 + ".jpg"]:
+        assert requests.get(f"{BASE_URL}/imgurl/{img_name}").status_code == 404
+
+def test_imgurl_legacy_name():
+    """
+    A test that the imgurl route still serves a photo stored before photos
+    were named by hash, under a code from generate_code(), which has no
+    thumbnails so is served whole at any size.
+    """
+    requests.post(f"{BASE_URL}/workspace/reset")
+    user1(PORT)
+    image = BytesIO()
+    Image.new("RGB", (100, 100), "red").save(image, format="JPEG")
+    img_path = os.path.join(PFP_FOLDER, "jdH5ixbma3.jpg")
+    with open(img_path, "wb") as file:
+        file.write(image.getvalue())
+    try:
+        response = requests.get(f"{BASE_URL}/imgurl/jdH5ixbma3.jpg")
+        assert response.status_code == 200
+        assert response.content == image.getvalue()
+        response = requests.get(f"{BASE_URL}/imgurl/jdH5ixbma3.jpg", params={"size": 48})
+        assert response.status_code == 200
+        assert response.content == image.getvalue()
+    finally:
+        os.remove(img_path)
@@ -0,0 +1,103 @@
+"""
+WSGI entry point for serving Slackr from several worker processes, eg.
+`gunicorn --config gunicorn.conf.py wsgi:APP` run from src.
+H11A-quadruples, April 2020.
+"""
+
+import os
+import sys
+import threading
+import time
+import types
+
+## The funcs read BASE_URL from port_settings, which server.py rewrites
+## whenever it starts. Workers leave the file alone: the public URL comes
+## from SLACKR_BASE_URL if it is set, else from the existing file.
+if "SLACKR_BASE_URL" in os.environ:
+    PORT_SETTINGS = types.ModuleType("port_settings")
+    PORT_SETTINGS.BASE_URL = os.environ["SLACKR_BASE_URL"]
+    PORT_SETTINGS.PORT = int(PORT_SETTINGS.BASE_URL.rsplit(":", 1)[-1])
+    sys.modules["port_settings"] = PORT_SETTINGS
+
+from server import APP, STORAGE, data_save_regularly
+from funcs.message import requeue_sendlater
+from database.workers import WORKERS
+
+## Requests with these methods never change the databases
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+## The tables that requests to routes starting with each prefix change, most
+## specific prefix first. A request to any other route changes every table
+ROUTE_TABLES = (
+    ("/auth/register", ("registered_users", "active_tokens")),
+    ("/auth/passwordreset", ("registered_users", "active_tokens")),
+    ("/auth/", ("active_tokens",)),
+    ("/channel/", ("channels",)),
+    ("/channels/", ("channels",)),
+    ("/message/", ("channels", "messages")),
+    ("/user/profile", ("registered_users", "channels")),
+    ("/standup/send", ("channels",)),
+    ("/standup/start", ("channels", "messages")),
+    ("/admin/userpermission", ("registered_users", "channels")),
+)
+
+## Seconds between catching up with the other workers when no request has
+FOLLOW_INTERVAL = 0.5
+
+def share_databases(app):
+    """
+    Wrap a WSGI app so that every request sees the changes made by other
+    workers, and requests that change the same tables are made by one
+    worker at a time (see WorkerSync).
+
+    Args:
+        app (function): The WSGI app.
+    Returns:
+        The wrapped WSGI app (function).
+    """
+    def shared_app(environ, start_response):
+        if environ["REQUEST_METHOD"] in READ_METHODS:
+            WORKERS.catch_up()
+            return app(environ, start_response)
+        with WORKERS.exclusive(*route_tables(environ["PATH_INFO"])):
+            ## Finish the response before letting other workers change anything
+            response = app(environ, start_response)
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, "close"):
+                    response.close()
+    return shared_app
+
+def route_tables(path):
+    """
+    Args:
+        path (str): The path of a request that changes the databases.
+    Returns:
+        The names (from TABLES) of the tables it may change, or () if it
+        may change any of them.
+    """
+    for prefix, tables in ROUTE_TABLES:
+        if path.startswith(prefix):
+            return tables
+    return ()
+
+def follow_journal():
+    """
+    Keep catching up with the changes made by other workers, so that
+    channel event streams (which wait for changes, not requests) hear
+    about them promptly.
+    """
+    while True:
+        time.sleep(FOLLOW_INTERVAL)
+        WORKERS.catch_up()
+
+## Each worker loads the databases itself after it is forked, then follows
+## the journal, so the app must not be preloaded by the master process
+WORKERS.start(STORAGE)
+with WORKERS.exclusive():
+    ## After the other workers' jobs, so each message is only requeued once
+    requeue_sendlater()
+threading.Thread(target=data_save_regularly, daemon=True).start()
+threading.Thread(target=follow_journal, daemon=True).start()
+APP.wsgi_app = share_databases(APP.wsgi_app)